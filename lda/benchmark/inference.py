@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+学習済みモデルによる推論だけを実行する（stages.pyから呼び出す）
+- チェックポイントを読み込み専用でmemory-mapし、preprocessの出力したデータセットのトピック分布を推論
+"""
+
+import os
+import argparse
+from common.storage import get_storage
+from common.artifacts import artifact_file, read_frame
+from common.checkpoint import load_model
+from common.encoder import build_lookup, encode_decks, to_corpus
+from common.inference import infer_topics, infer_topics_dedup
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--preprocess_output',
+        help='Preprocess output',
+        required=True
+    )
+    parser.add_argument(
+        '--model_dir',
+        help='Directory of the model checkpoint',
+        required=True
+    )
+    parser.add_argument(
+        '--bucket',
+        help='GCS bucket name',
+        required=True
+    )
+    parser.add_argument(
+        '--dataset_file',
+        help='Dataset file name',
+        default='dataset'
+    )
+    parser.add_argument(
+        '--chunk_size',
+        help='Number of documents per inference chunk',
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        '--infer_workers',
+        help='Number of processes used for topic inference',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--no_dedup_inference',
+        help='Infer every document even if the same deck appears more than once',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--tmp_dir',
+        help='Directory for temporal files',
+        default='/tmp'
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS',
+        required=True
+    )
+
+    args = parser.parse_args()
+    return args.__dict__
+
+
+def main(args):
+    store = get_storage(None, args['bucket'], storage_dir=args['storage_dir'])
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+
+    lda = load_model(store, args['model_dir'], args['tmp_dir'], mmap='r')
+
+    cols = ['id', 'hero0', 'hero1', 'hero2', 'hero3']
+    gcs_file = os.path.join(args['preprocess_output'], artifact_file(args['dataset_file'], args['artifact_format']))
+    data_raw = read_frame(store, gcs_file, cols, args['artifact_format'])
+    corpus_deck = to_corpus(encode_decks(data_raw.drop('id', axis=1), build_lookup(lda.id2word)))
+
+    if args['no_dedup_inference']:
+        topic_prob = infer_topics(lda, corpus_deck, chunk_docs=args['chunk_size'], processes=args['infer_workers'])
+    else:
+        topic_prob, dedup_ratio = infer_topics_dedup(
+            lda, corpus_deck, chunk_docs=args['chunk_size'], processes=args['infer_workers'])
+        print('Inference dedup ratio: {:.2f}'.format(dedup_ratio))
+    print('{} documents inferred'.format(topic_prob.shape[0]))
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
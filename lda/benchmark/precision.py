@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+float32とfloat64のモデルを同じ合成データ・同じ乱数シードで学習し、精度の違いによる影響を比較する
+- 学習・推論の経過時間とチェックポイントのサイズ
+- inference: float64のモデルをfloat32に変換して推論した結果と、float64のままの推論結果の一致
+- training:  float32とfloat64で学習したモデルの一致（比較のため、乱数シードだけ変えたfloat64のモデルの一致も計測）
+- 一致の指標
+  - トピック: 2つのモデルのトピック（単語分布）をHellinger距離で1対1に対応づけ、その距離
+  - 文書:     対応づけたトピックで、各文書の最大のトピックが一致する割合と、トピック分布の差の平均
+結果をjsonで保存し、推論の一致率が--min_agreementを下回った場合か、学習の一致率が乱数シードの違いによる
+一致率を下回った場合はエラー終了する
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+# stagesのimport時にpipelineのディレクトリがsys.pathに追加される
+from stages import make_names, make_decks
+
+PRECISIONS = ['float64', 'float32']
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--rows',
+        help='Number of documents in the dataset',
+        type=int,
+        default=100000
+    )
+    parser.add_argument(
+        '--vocab',
+        help='Number of words in the dictionary',
+        type=int,
+        default=500
+    )
+    parser.add_argument(
+        '--dup_ratio',
+        help='Ratio of documents that repeat a deck seen before',
+        type=float,
+        default=0.3
+    )
+    parser.add_argument(
+        '--num_topics',
+        help='Number of topics',
+        type=int,
+        default=6
+    )
+    parser.add_argument(
+        '--num_pass',
+        help='Number of training passes',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--chunk_size',
+        help='Number of documents per training / inference chunk',
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of training worker processes',
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        '--infer_workers',
+        help='Number of processes used for topic inference',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--seed',
+        help='Random seed of the synthetic data',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--min_agreement',
+        help='Minimum ratio of documents whose most probable topic agrees between float32 and float64 inference',
+        type=float,
+        default=0.99
+    )
+    parser.add_argument(
+        '--output',
+        help='JSON file for the results',
+        default='precision.json'
+    )
+
+    args = parser.parse_args()
+    return args.__dict__
+
+
+def infer(lda, corpus, args):
+    from common.inference import infer_topics_dedup
+    topic_prob, _ = infer_topics_dedup(lda, corpus, chunk_docs=args['chunk_size'],
+                                       processes=args['infer_workers'], dtype=lda.dtype)
+    return topic_prob
+
+
+def run_precision(precision, corpus, dict_deck, args, work_dir, random_state=1):
+    """precisionでモデルを学習してチェックポイントに保存し、読み込んだモデルで推論する"""
+    from gensim import models
+    from common.checkpoint import save_checkpoint, load_checkpoint
+
+    dtype = np.dtype(precision)
+    begin = time.time()
+    lda = models.ldamulticore.LdaMulticore(
+        corpus=corpus,
+        workers=args['workers'],
+        id2word=dict_deck,
+        num_topics=args['num_topics'],
+        chunksize=args['chunk_size'],
+        passes=args['num_pass'],
+        minimum_probability=0.,
+        random_state=random_state,
+        dtype=dtype
+    )
+    train_sec = time.time() - begin
+
+    archive_file = os.path.join(work_dir, '{}_{}.ckpt'.format(precision, random_state))
+    save_checkpoint(lda, archive_file, work_dir)
+    lda = load_checkpoint(archive_file, mmap='r')
+
+    begin = time.time()
+    topic_prob = infer(lda, corpus, args)
+    infer_sec = time.time() - begin
+
+    values = {
+        'train_sec': train_sec,
+        'infer_sec': infer_sec,
+        'checkpoint_bytes': os.path.getsize(archive_file),
+        'model_dtype': str(lda.expElogbeta.dtype),
+        'result_dtype': str(topic_prob.dtype)
+    }
+    return lda, topic_prob, values
+
+
+def match_topics(reference, other):
+    """
+    - referenceの各トピックに対応するotherのトピックの番号と、そのHellinger距離を返す
+    - 距離の合計が最小になるように1対1で対応づける
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    a = np.sqrt(reference.astype(np.float64))
+    b = np.sqrt(other.astype(np.float64))
+    distance = np.sqrt(np.maximum(0., 1. - a.dot(b.T)))
+    rows, cols = linear_sum_assignment(distance)
+    order = np.argsort(rows)
+    return cols[order], distance[rows[order], cols[order]]
+
+
+def compare(reference, other):
+    """2つの（モデル, トピック分布）のトピックと文書のトピック分布を比較"""
+    ref_lda, ref_prob = reference
+    other_lda, other_prob = other
+    mapping, distance = match_topics(ref_lda.get_topics(), other_lda.get_topics())
+    aligned = other_prob[:, mapping].astype(np.float64)
+    return {
+        'topic_hellinger_mean': float(distance.mean()),
+        'topic_hellinger_max': float(distance.max()),
+        'doc_argmax_agreement': float(np.mean(ref_prob.argmax(axis=1) == aligned.argmax(axis=1))),
+        'doc_prob_mean_abs_diff': float(np.abs(ref_prob - aligned).mean())
+    }
+
+
+def main(args):
+    from gensim import corpora
+    from common.encoder import build_lookup, encode_decks, to_corpus
+    from common.checkpoint import load_checkpoint, cast_model
+
+    work_dir = tempfile.mkdtemp(prefix='lda_precision_')
+    try:
+        print('Generating synthetic data ({} rows, {} words)....'.format(args['rows'], args['vocab']))
+        dict_deck = corpora.Dictionary([[name] for name in make_names(args['vocab'])])
+        decks = make_decks(args['rows'], args['vocab'], args['dup_ratio'], seed=args['seed'])
+        corpus = to_corpus(encode_decks(decks.drop('id', axis=1), build_lookup(dict_deck)))
+
+        results = {'config': {k: v for k, v in args.items() if k not in ('output', 'min_agreement')},
+                   'precisions': {}}
+        outputs = {}
+        for precision in PRECISIONS:
+            lda, topic_prob, values = run_precision(precision, corpus, dict_deck, args, work_dir)
+            outputs[precision] = (lda, topic_prob)
+            results['precisions'][precision] = values
+            print('{:8s} train {:8.3f}s  infer {:8.3f}s  checkpoint {:>12,d}B'.format(
+                precision, values['train_sec'], values['infer_sec'], values['checkpoint_bytes']))
+
+        # float64のモデルをfloat32に変換して推論（学習済みの旧形式のモデルを使う場合と同じ）
+        lda = cast_model(load_checkpoint(os.path.join(work_dir, 'float64_1.ckpt'), mmap=None), 'float32')
+        cast = (lda, infer(lda, corpus, args))
+
+        # 乱数シードだけ変えたfloat64のモデル
+        reseeded = run_precision('float64', corpus, dict_deck, args, work_dir, random_state=2)[:2]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results['agreement'] = {
+        'inference': compare(outputs['float64'], cast),
+        'training': compare(outputs['float64'], outputs['float32']),
+        'seed': compare(outputs['float64'], reseeded)
+    }
+    for check, values in sorted(results['agreement'].items()):
+        print('{:10s} '.format(check) + '  '.join(
+            '{} {:.6f}'.format(name, value) for name, value in sorted(values.items())))
+
+    with open(args['output'], 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    failed = False
+    inference = results['agreement']['inference']['doc_argmax_agreement']
+    if inference < args['min_agreement']:
+        print('Inference agreement {:.4f} is below {:.4f}'.format(inference, args['min_agreement']))
+        failed = True
+    training = results['agreement']['training']['doc_argmax_agreement']
+    seed = results['agreement']['seed']['doc_argmax_agreement']
+    if training < seed:
+        print('Training agreement {:.4f} is below the agreement between random seeds {:.4f}'.format(training, seed))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
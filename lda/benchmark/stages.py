@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+合成データで各ステップの性能を計測する
+- 実データと同じスキーマの合成データを作成
+  - NAMES:        ワードのマスターデータ（vocab件）
+  - DUMMY:        id, hero0..hero3 のデータセット（rows件、dup_ratioの割合は既出のデッキの重複）
+  - TOPIC_RESULT: postprocessの入力（trainの出力と同じレイアウト）
+- GCS・BigQueryの代わりにローカルディレクトリ（--storage_dir, --sink_dir）とSQLite（--query_backend sqlite）を使う
+- preprocess -> train (reset) -> train (update) -> inference -> visualize -> postprocess を
+  それぞれ別プロセスで実行し、経過時間・CPU時間・最大メモリ使用量（peak RSS）・ストレージと送受信したバイト数を計測
+結果をjsonで保存し、--baselineを指定した場合は同じ条件の結果と比較して遅くなっていればエラー終了する
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+
+LDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_DIR = os.path.join(LDA_DIR, 'pipeline')
+BENCHMARK_DIR = os.path.join(LDA_DIR, 'benchmark')
+sys.path.insert(0, PIPELINE_DIR)
+
+BUCKET = 'benchmark'
+OUTPUT = 'gs://{}/output'.format(BUCKET)
+TABLE = 'TOPIC_RESULT'
+DATE = '2020-01-01'
+NEXT_DATE = '2020-01-02'
+STAGES = ['preprocess', 'train_reset', 'train_update', 'inference', 'visualize', 'postprocess']
+COMPARED = ['wall_sec', 'peak_rss_mb']
+
+# 子プロセスでステップを実行し、終了時にストレージと送受信したバイト数を保存する
+DRIVER = '''
+import sys, json, atexit, runpy
+from common import storage
+
+stats_file, script = sys.argv[1], sys.argv[2]
+
+def dump():
+    with open(stats_file, 'w') as f:
+        json.dump(storage.transferred(), f)
+
+atexit.register(dump)
+sys.argv = [script] + sys.argv[3:]
+sys.path.insert(0, __import__('os').path.dirname(script))
+runpy.run_path(script, run_name='__main__')
+'''
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--rows',
+        help='Number of documents in the dataset',
+        type=int,
+        default=100000
+    )
+    parser.add_argument(
+        '--vocab',
+        help='Number of words in the dictionary',
+        type=int,
+        default=500
+    )
+    parser.add_argument(
+        '--dup_ratio',
+        help='Ratio of documents that repeat a deck seen before',
+        type=float,
+        default=0.3
+    )
+    parser.add_argument(
+        '--num_topics',
+        help='Number of topics',
+        type=int,
+        default=6
+    )
+    parser.add_argument(
+        '--num_pass',
+        help='Number of training passes',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of training worker processes',
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        '--infer_workers',
+        help='Number of processes used for topic inference',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--sample_size',
+        help='Number of documents sampled for the visualization',
+        type=int,
+        default=10000
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--seed',
+        help='Random seed of the synthetic data',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--skip',
+        help='Comma separated stages that are not run (e.g. "visualize")',
+        default=''
+    )
+    parser.add_argument(
+        '--work_dir',
+        help='Directory for the synthetic data and the outputs (default: temporal directory)'
+    )
+    parser.add_argument(
+        '--keep',
+        help='Keep the work directory after the benchmark',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--output',
+        help='JSON file where the results are saved',
+        default='stages.json'
+    )
+    parser.add_argument(
+        '--baseline',
+        help='JSON file of previous results to compare with'
+    )
+    parser.add_argument(
+        '--tolerance',
+        help='Allowed slowdown ratio against the baseline',
+        type=float,
+        default=1.5
+    )
+
+    args = parser.parse_args()
+    return args.__dict__
+
+
+def make_names(vocab):
+    """ワードのマスターデータ"""
+    return ['hero{:05d}'.format(i) for i in range(vocab)]
+
+
+def make_decks(rows, vocab, dup_ratio, seed=1):
+    """
+    - id, hero0..hero3 のデータセット
+    - ワードの出現頻度はZipf分布に従い、dup_ratioの割合の行は既出のデッキを繰り返す
+    """
+    import pandas as pd
+
+    rng = np.random.RandomState(seed)
+    names = np.array(make_names(vocab))
+    weights = 1.0 / np.arange(1, vocab + 1)
+    weights /= weights.sum()
+
+    n_unique = max(1, int(round(rows * (1 - dup_ratio))))
+    unique = rng.choice(vocab, size=(n_unique, 4), p=weights)
+    repeated = unique[rng.randint(0, n_unique, rows - n_unique)]
+    decks = np.vstack([unique, repeated])[rng.permutation(rows)]
+
+    df = pd.DataFrame(names[decks], columns=['hero0', 'hero1', 'hero2', 'hero3'])
+    df.insert(0, 'id', np.arange(rows))
+    return df
+
+
+def make_topic_result(decks, num_topics, seed=1):
+    """trainの出力（TOPIC_RESULT）と同じレイアウトの結果"""
+    from common.artifacts import result_columns
+
+    rng = np.random.RandomState(seed)
+    df = decks.rename(columns={'hero{}'.format(i): 'name{}'.format(i) for i in range(4)})
+    df.insert(0, 'date', DATE)
+    topic_prob = rng.dirichlet(np.full(num_topics, 0.1), len(df)).astype(np.float32)
+    for i in range(num_topics):
+        df['topic{}'.format(i)] = topic_prob[:, i]
+    df['execution_time'] = '2020-01-01 00:00:00'
+    df['pipeline_version'] = 'benchmark'
+    return df.loc[:, result_columns(num_topics)]
+
+
+def prepare(args, work_dir):
+    """合成データをSQLiteとローカルストレージに作成"""
+    import pandas as pd
+    from common.storage import get_storage
+    from common.artifacts import artifact_file, write_frame, write_schema
+
+    decks = make_decks(args['rows'], args['vocab'], args['dup_ratio'], args['seed'])
+    db_file = os.path.join(work_dir, 'query.db')
+    conn = sqlite3.connect(db_file)
+    try:
+        pd.DataFrame({'name': make_names(args['vocab'])}).to_sql('NAMES', conn, index=False)
+        decks.to_sql('DUMMY', conn, index=False)
+    finally:
+        conn.close()
+
+    # postprocessの入力はtrainの結果に依存しないように合成する
+    tmp_dir = os.path.join(work_dir, 'tmp')
+    os.mkdir(tmp_dir)
+    store = get_storage(None, BUCKET, storage_dir=os.path.join(work_dir, 'storage'))
+    result_dir = os.path.join(OUTPUT, 'synthetic')
+    res_name = artifact_file(TABLE, args['artifact_format'])
+    local_file = os.path.join(tmp_dir, res_name)
+    write_frame(make_topic_result(decks, args['num_topics'], args['seed']), local_file, args['artifact_format'])
+    store.upload(local_file, os.path.join(result_dir, res_name))
+    write_schema(store, os.path.join(tmp_dir, 'schema.json'), result_dir, args['num_topics'])
+    return db_file, result_dir
+
+
+def stage_commands(args, work_dir, db_file, result_dir):
+    """各ステップのスクリプトと引数"""
+    storage_dir = os.path.join(work_dir, 'storage')
+    common = [
+        '--bucket', BUCKET,
+        '--tmp_dir', os.path.join(work_dir, 'tmp'),
+        '--artifact_format', args['artifact_format'],
+        '--storage_dir', storage_dir
+    ]
+    preprocess_output = os.path.join(OUTPUT, 'workflow_' + DATE, 'preprocess')
+    train = [
+        '--project', BUCKET,
+        '--preprocess_output', preprocess_output,
+        '--table', TABLE,
+        '--num_topics', str(args['num_topics']),
+        '--num_pass', str(args['num_pass']),
+        '--workers', str(args['workers']),
+        '--infer_workers', str(args['infer_workers']),
+        '--pipeline_version', 'benchmark',
+        '--step_cache', 'off',
+        '--output', OUTPUT
+    ]
+    return {
+        'preprocess': (os.path.join(PIPELINE_DIR, 'preprocess', 'preprocess.py'), common + [
+            '--project', BUCKET,
+            '--date', DATE,
+            '--query_backend', 'sqlite',
+            '--sqlite_db', db_file,
+            '--output', OUTPUT
+        ]),
+        'train_reset': (os.path.join(PIPELINE_DIR, 'train', 'train.py'), common + train + [
+            '--prev_date', '',
+            '--date', DATE,
+            '--learning_type', 'reset'
+        ]),
+        'train_update': (os.path.join(PIPELINE_DIR, 'train', 'train.py'), common + train + [
+            '--prev_date', DATE,
+            '--date', NEXT_DATE,
+            '--learning_type', 'update'
+        ]),
+        'inference': (os.path.join(BENCHMARK_DIR, 'inference.py'), common + [
+            '--preprocess_output', preprocess_output,
+            '--model_dir', os.path.join(OUTPUT, 'workflow_' + NEXT_DATE, 'model'),
+            '--infer_workers', str(args['infer_workers'])
+        ]),
+        'visualize': (os.path.join(PIPELINE_DIR, 'visualize', 'visualize.py'), common + [
+            '--project', BUCKET,
+            '--training_output', os.path.join(OUTPUT, 'workflow_' + NEXT_DATE, 'train'),
+            '--table', TABLE,
+            '--date', NEXT_DATE,
+            '--sample_size', str(args['sample_size']),
+            '--step_cache', 'off',
+            '--output', OUTPUT
+        ]),
+        'postprocess': (os.path.join(PIPELINE_DIR, 'postprocess', 'postprocess.py'), common + [
+            '--project', BUCKET,
+            '--training_output', result_dir,
+            '--table', TABLE,
+            '--date', DATE,
+            '--load_mode', 'partition',
+            '--sink_dir', os.path.join(work_dir, 'sink'),
+            '--step_cache', 'off',
+            '--output', OUTPUT
+        ])
+    }
+
+
+def run_stage(name, script, argv, work_dir):
+    """ステップを子プロセスで実行し、計測値を返す"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([PIPELINE_DIR, env.get('PYTHONPATH', '')])
+    stats_file = os.path.join(work_dir, name + '.stats.json')
+    log_file = os.path.join(work_dir, name + '.log')
+
+    start = time.time()
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen([sys.executable, '-c', DRIVER, stats_file, script] + argv,
+                                env=env, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    wall = time.time() - start
+    if proc.returncode != 0:
+        with open(log_file) as log:
+            sys.stderr.write(log.read())
+        raise RuntimeError('{} failed (see {})'.format(name, log_file))
+
+    with open(stats_file) as f:
+        transferred = json.load(f)
+    result = {
+        'wall_sec': wall,
+        'cpu_sec': usage.ru_utime + usage.ru_stime,
+        # Linuxのru_maxrssはKB単位
+        'peak_rss_mb': usage.ru_maxrss / 1024.0
+    }
+    result.update(transferred)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=LDA_DIR,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def config_of(args):
+    """結果の比較に使う条件"""
+    keys = ['rows', 'vocab', 'dup_ratio', 'num_topics', 'num_pass', 'workers', 'infer_workers',
+            'sample_size', 'artifact_format', 'seed']
+    return {k: args[k] for k in keys}
+
+
+def compare(results, baseline, tolerance):
+    """baselineよりtolerance倍以上悪くなった計測値を返す"""
+    regressions = []
+    for stage, values in results['stages'].items():
+        for key in COMPARED:
+            base = baseline['stages'].get(stage, {}).get(key)
+            if base and values[key] > base * tolerance:
+                regressions.append('{} {}: {:.3f} (baseline {:.3f})'.format(stage, key, values[key], base))
+    return regressions
+
+
+def main(args):
+    work_dir = args.get('work_dir') or tempfile.mkdtemp(prefix='lda_benchmark_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    skip = [stage for stage in args['skip'].split(',') if stage]
+
+    try:
+        print('Generating synthetic data ({} rows, {} words)....'.format(args['rows'], args['vocab']))
+        db_file, result_dir = prepare(args, work_dir)
+        commands = stage_commands(args, work_dir, db_file, result_dir)
+
+        results = {
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'config': config_of(args),
+            'stages': {}
+        }
+        for stage in STAGES:
+            if stage in skip:
+                continue
+            script, argv = commands[stage]
+            values = run_stage(stage, script, argv, work_dir)
+            results['stages'][stage] = values
+            print('{:13s} wall {:8.3f}s  cpu {:8.3f}s  rss {:8.1f}MB  up {:>12,d}B  down {:>12,d}B'.format(
+                stage, values['wall_sec'], values['cpu_sec'], values['peak_rss_mb'],
+                values['bytes_uploaded'], values['bytes_downloaded']))
+    finally:
+        if not args['keep'] and not args.get('work_dir'):
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args['output'], 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.get('baseline'):
+        with open(args['baseline']) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print('Baseline was measured with a different config: {}'.format(baseline.get('config')))
+            sys.exit(1)
+        regressions = compare(results, baseline, args['tolerance'])
+        if regressions:
+            print('Stage regressions:')
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+各ステップの起動時間を計測する
+- import:  モジュールのimportにかかる時間
+- help:    `python <step>.py --help` の実行時間（引数エラー時も同程度）
+結果をjsonで保存し、--baselineを指定した場合は比較して遅くなっていればエラー終了する
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+LDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_DIR = os.path.join(LDA_DIR, 'pipeline')
+STEPS = ['preprocess', 'train', 'postprocess']
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--repeat',
+        help='Number of measurements per step (the median is recorded)',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--output',
+        help='JSON file where the results are saved',
+        default='startup.json'
+    )
+    parser.add_argument(
+        '--baseline',
+        help='JSON file of previous results to compare with'
+    )
+    parser.add_argument(
+        '--tolerance',
+        help='Allowed slowdown ratio against the baseline',
+        type=float,
+        default=1.5
+    )
+
+    args = parser.parse_args()
+    return args.__dict__
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run_python(code_or_args):
+    """新しいインタプリタで実行し、経過時間（秒）を返す"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([PIPELINE_DIR, env.get('PYTHONPATH', '')])
+    start = time.time()
+    subprocess.run([sys.executable] + code_or_args, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - start
+
+
+def measure(step, repeat):
+    step_dir = os.path.join(PIPELINE_DIR, step)
+    script = os.path.join(step_dir, step + '.py')
+    code = 'import sys; sys.path.insert(0, {!r}); import {}'.format(step_dir, step)
+    return {
+        'import_sec': median([run_python(['-c', code]) for _ in range(repeat)]),
+        'help_sec': median([run_python([script, '--help']) for _ in range(repeat)])
+    }
+
+
+def compare(results, baseline, tolerance):
+    """baselineよりtolerance倍以上遅くなった計測値を返す"""
+    regressions = []
+    for step, values in results.items():
+        for key, value in values.items():
+            base = baseline.get(step, {}).get(key)
+            if base and value > base * tolerance:
+                regressions.append('{} {}: {:.3f}s (baseline {:.3f}s)'.format(step, key, value, base))
+    return regressions
+
+
+def main(args):
+    results = {}
+    for step in STEPS:
+        results[step] = measure(step, args['repeat'])
+        print('{:12s} import {:.3f}s  --help {:.3f}s'.format(
+            step, results[step]['import_sec'], results[step]['help_sec']))
+
+    with open(args['output'], 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.get('baseline'):
+        with open(args['baseline']) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args['tolerance'])
+        if regressions:
+            print('Startup regressions:')
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
@@ -21,16 +21,19 @@ def preprocess_op(project: 'GcpProject', bucket, date, dict_file, dataset_file,
             '--tmp_dir',      tmp_dir,
             '--output',       preprocess_output
         ],
-        file_outputs = {'preprocess': '/output.txt'}
+        file_outputs = {
+            'preprocess': '/output.txt',
+            'mlpipeline-metrics': '/mlpipeline-metrics.json'
+        }
     )
 
 
 def training_op(preprocess_output: 'GcsUri[Directory]', project: 'GcpProject', bucket, table, 
-                prev_date, date, dict_file, dataset_file, learning_type, pipeline_version, tmp_dir, 
-                training_output: 'GcsUri[Directory]', step_name='train'):
+                prev_date, date, dict_file, dataset_file, learning_type, update_mode, pipeline_version, tmp_dir,
+                step_cache, training_output: 'GcsUri[Directory]', step_name='train'):
     return dsl.ContainerOp(
         name = step_name,
-        image = 'gcr.io/{}/kfp/train:latest'.format(PROJECT_ID,
+        image = 'gcr.io/{}/kfp/train:latest'.format(PROJECT_ID),
         arguments = [
             '--preprocess_output', preprocess_output,
             '--project',           project,
@@ -41,28 +44,94 @@ def training_op(preprocess_output: 'GcsUri[Directory]', project: 'GcpProject', b
             '--dict_file',         dict_file,
             '--dataset_file',      dataset_file,
             '--learning_type',     learning_type,
+            '--update_mode',       update_mode,
             '--pipeline_version',  pipeline_version,
             '--tmp_dir',           tmp_dir,
+            '--step_cache',        step_cache,
             '--output',            training_output
         ],
-        file_outputs = {'train': '/output.txt'}
+        file_outputs = {
+            'train': '/output.txt',
+            'mlpipeline-metrics': '/mlpipeline-metrics.json'
+        }
     )
 
 
-def postprocess_op(training_output: 'GcsUri[Directory]', project: 'GcpProject', bucket, table, date, 
-                   postprocess_output: 'GcsUri[Directory]', step_name='postprocess'):
+def distributed_op(preprocess_output: 'GcsUri[Directory]', project: 'GcpProject', bucket, table, date,
+                   dict_file, dataset_file, pipeline_version, num_shards, num_pass, dist_role, shard, pass_no,
+                   training_output: 'GcsUri[Directory]', step_name='train'):
     return dsl.ContainerOp(
         name = step_name,
-        image = 'gcr.io/{}/kfp/post:latest'.format(PROJECT_ID,
+        image = 'gcr.io/{}/kfp/train:latest'.format(PROJECT_ID),
+        arguments = [
+            '--preprocess_output', preprocess_output,
+            '--project',           project,
+            '--bucket',            bucket,
+            '--table',             table,
+            '--prev_date',         '',
+            '--date',              date,
+            '--dict_file',         dict_file,
+            '--dataset_file',      dataset_file,
+            '--learning_type',     'reset',
+            '--num_pass',          num_pass,
+            '--dist_role',         dist_role,
+            '--num_shards',        num_shards,
+            '--shard',             shard,
+            '--pass_no',           pass_no,
+            '--pipeline_version',  pipeline_version,
+            '--tmp_dir',           '/tmp',
+            '--output',            training_output
+        ],
+        file_outputs = {
+            'train': '/output.txt',
+            'shards': '/shards.json',
+            'next-pass': '/next_pass.txt',
+            'mlpipeline-metrics': '/mlpipeline-metrics.json'
+        }
+    )
+
+
+def postprocess_op(training_output: 'GcsUri[Directory]', project: 'GcpProject', bucket, table, date, load_mode,
+                   step_cache, postprocess_output: 'GcsUri[Directory]', step_name='postprocess'):
+    return dsl.ContainerOp(
+        name = step_name,
+        image = 'gcr.io/{}/kfp/post:latest'.format(PROJECT_ID),
         arguments = [
             '--training_output', training_output,
             '--project',         project,
             '--bucket',          bucket,
             '--table',           table,
             '--date',            date,
+            '--load_mode',       load_mode,
+            '--step_cache',      step_cache,
             '--output',          postprocess_output
         ],
-        file_outputs = {'postprocess': '/output.txt'}
+        file_outputs = {
+            'postprocess': '/output.txt',
+            'mlpipeline-metrics': '/mlpipeline-metrics.json'
+        }
+    )
+
+
+def visualize_op(training_output: 'GcsUri[Directory]', project: 'GcpProject', bucket, table, date, sample_size,
+                 step_cache, visualize_output: 'GcsUri[Directory]', step_name='visualize'):
+    return dsl.ContainerOp(
+        name = step_name,
+        image = 'gcr.io/{}/kfp/vis:latest'.format(PROJECT_ID),
+        arguments = [
+            '--training_output', training_output,
+            '--project',         project,
+            '--bucket',          bucket,
+            '--table',           table,
+            '--date',            date,
+            '--sample_size',     sample_size,
+            '--step_cache',      step_cache,
+            '--output',          visualize_output
+        ],
+        file_outputs = {
+            'visualize': '/output.txt',
+            'mlpipeline-metrics': '/mlpipeline-metrics.json'
+        }
     )
 
 
@@ -73,26 +142,88 @@ def postprocess_op(training_output: 'GcsUri[Directory]', project: 'GcpProject',
 def kubeflow_training(
     output:        dsl.PipelineParam, 
     project:       dsl.PipelineParam,
-    bucket:        dsl.PipelineParam=dsl.PipelineParam(name='bucket',          value=bucket),
+    bucket:        dsl.PipelineParam=dsl.PipelineParam(name='bucket',          value=BUCKET),
     table:         dsl.PipelineParam=dsl.PipelineParam(name='table',           value='TOPIC_TRY'),
     prev_date:     dsl.PipelineParam=dsl.PipelineParam(name='prev-date',       value=''),
     date:          dsl.PipelineParam=dsl.PipelineParam(name='date',            value=''),
     dict_file:     dsl.PipelineParam=dsl.PipelineParam(name='dictionary-file', value='dict'),
     dataset_file:  dsl.PipelineParam=dsl.PipelineParam(name='dataset-file',    value='dataset'),
-    learning_type: dsl.PipelineParam=dsl.PipelineParam(name='learning-type',   value='update')):
+    learning_type: dsl.PipelineParam=dsl.PipelineParam(name='learning-type',   value='update'),
+    update_mode:   dsl.PipelineParam=dsl.PipelineParam(name='update-mode',     value='batch'),
+    sample_size:   dsl.PipelineParam=dsl.PipelineParam(name='vis-sample-size', value='10000'),
+    load_mode:     dsl.PipelineParam=dsl.PipelineParam(name='load-mode',       value='partition'),
+    step_cache:    dsl.PipelineParam=dsl.PipelineParam(name='step-cache',      value='on')):
 
 
     # TODO: use the argo job name as the workflow
     #workflow = '{{workflow.name}}'
     pipeline_version = __file__
 
-    # Make pipeline
+    # Make pipeline（各ステップはメトリクスも出力するので、出力先は.outputs[<step>]で受け渡す）
     preprocess = preprocess_op(project, bucket, date, dict_file, dataset_file, '/tmp', output)
-    training = training_op(preprocess.output, project, bucket, table, prev_date, date, 
-                           dict_file, dataset_file, learning_type, pipeline_version, '/tmp', output)
-    postprocess = postprocess_op(training.output, project, bucket, table, date, output)
+    training = training_op(preprocess.outputs['preprocess'], project, bucket, table, prev_date, date, 
+                           dict_file, dataset_file, learning_type, update_mode, pipeline_version, '/tmp', step_cache, output)
+    postprocess = postprocess_op(training.outputs['train'], project, bucket, table, date, load_mode, step_cache, output)
+
+    # pyLDAvisのレポートはpostprocessと並行して作成
+    visualize = visualize_op(training.outputs['train'], project, bucket, table, date, sample_size, step_cache, output)
+
+
+@dsl.graph_component
+def distributed_pass(preprocess_output, project, bucket, table, date, dict_file, dataset_file, pipeline_version,
+                     num_shards, num_pass, shards, pass_no, output):
+    """
+    - 1つのpass: 全shardのE-stepを並行して実行してから、reducerでM-stepを行う
+    - pass数はパイプラインの引数なので、reducerが次のpass番号を返す間は再帰して続ける
+    """
+    with dsl.ParallelFor(shards) as shard:
+        shard_step = distributed_op(preprocess_output, project, bucket, table, date, dict_file, dataset_file,
+                                    pipeline_version, num_shards, num_pass, 'shard', shard, pass_no,
+                                    output, step_name='shard')
+    reducer = distributed_op(preprocess_output, project, bucket, table, date, dict_file, dataset_file,
+                             pipeline_version, num_shards, num_pass, 'reduce', '0', pass_no,
+                             output, step_name='reduce')
+    reducer.after(shard_step)
+    with dsl.Condition(reducer.outputs['next-pass'] != 'done'):
+        distributed_pass(preprocess_output, project, bucket, table, date, dict_file, dataset_file, pipeline_version,
+                         num_shards, num_pass, shards, reducer.outputs['next-pass'], output)
+
+
+@dsl.pipeline(
+    name='LDA distributed reset pipeline',
+    description='LDA pipeline resetting the model with data-parallel shards'
+)
+def kubeflow_distributed_training(
+    output:        dsl.PipelineParam, 
+    project:       dsl.PipelineParam,
+    bucket:        dsl.PipelineParam=dsl.PipelineParam(name='bucket',          value=BUCKET),
+    table:         dsl.PipelineParam=dsl.PipelineParam(name='table',           value='TOPIC_TRY'),
+    date:          dsl.PipelineParam=dsl.PipelineParam(name='date',            value=''),
+    dict_file:     dsl.PipelineParam=dsl.PipelineParam(name='dictionary-file', value='dict'),
+    dataset_file:  dsl.PipelineParam=dsl.PipelineParam(name='dataset-file',    value='dataset'),
+    num_shards:    dsl.PipelineParam=dsl.PipelineParam(name='dist-shards',     value='4'),
+    num_pass:      dsl.PipelineParam=dsl.PipelineParam(name='dist-passes',     value='30'),
+    sample_size:   dsl.PipelineParam=dsl.PipelineParam(name='vis-sample-size', value='10000'),
+    load_mode:     dsl.PipelineParam=dsl.PipelineParam(name='load-mode',       value='partition'),
+    step_cache:    dsl.PipelineParam=dsl.PipelineParam(name='step-cache',      value='on')):
+
+    pipeline_version = __file__
+
+    # splitでデータセットを1回だけ読み込み、shardごとのコーパスに分ける（shardの一覧と学習結果の出力先を返す）
+    # passの繰り返しはreducerが'done'を返すまで再帰し、最後のpassのreducerが通常のtrainと同じくモデルと結果を出力する
+    preprocess = preprocess_op(project, bucket, date, dict_file, dataset_file, '/tmp', output)
+    split = distributed_op(preprocess.outputs['preprocess'], project, bucket, table, date, dict_file, dataset_file,
+                           pipeline_version, num_shards, num_pass, 'split', '0', '0', output, step_name='split')
+    passes = distributed_pass(preprocess.outputs['preprocess'], project, bucket, table, date, dict_file, dataset_file,
+                              pipeline_version, num_shards, num_pass, split.outputs['shards'], '0', output)
+
+    postprocess = postprocess_op(split.outputs['train'], project, bucket, table, date, load_mode, step_cache, output)
+    postprocess.after(passes)
+    visualize = visualize_op(split.outputs['train'], project, bucket, table, date, sample_size, step_cache, output)
+    visualize.after(passes)
 
 
 if __name__ == '__main__':
     compiler.Compiler().compile(kubeflow_training, __file__ + '.tar.gz')
+    compiler.Compiler().compile(kubeflow_distributed_training, __file__ + '.distributed.tar.gz')
 
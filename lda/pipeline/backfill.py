@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+期間を指定したバックフィル（start_date〜end_dateの各日を1つのプロセスで順に処理する）
+- データセットは1回のクエリで期間全体を取得し、date_columnの日付ごとに各日のpreprocessの成果物として保存
+- 各日のupdateを続けて実行し、前日のモデルはダウンロードせずにメモリ上で引き継ぐ
+- 各日のチェックポイントとTOPIC_RESULTは通常の実行と同じ場所に保存する
+- 行のない日は前日のモデルをその日のチェックポイントとして保存し、翌日以降の通常の実行が
+  --prev_dateにその日を指定しても読み込めるようにする
+- BigQueryへのロードは全ての日の学習が終わってから最後にまとめて行う
+"""
+
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+
+from common import handoff, metrics
+from common.storage import get_storage
+from common.checkpoint import load_model, save_model
+from common.query import get_backend, build_query, build_range_query
+from fused import step_arguments, build_argv
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--project',
+        help='GCP project ID',
+        required=True
+    )
+    parser.add_argument(
+        '--bucket',
+        help='GCS bucket name',
+        required=True
+    )
+    parser.add_argument(
+        '--table',
+        help='Table name',
+        required=True
+    )
+    parser.add_argument(
+        '--start_date',
+        help='First date of the backfill (yyyy-mm-dd)',
+        required=True
+    )
+    parser.add_argument(
+        '--end_date',
+        help='Last date of the backfill (yyyy-mm-dd, inclusive)',
+        required=True
+    )
+    parser.add_argument(
+        '--prev_date',
+        help='Date of the model updated on the first day (default: the day before start_date, "": reset)'
+    )
+    parser.add_argument(
+        '--date_column',
+        help='Date column of the dataset table used to split the rows into days',
+        default='date'
+    )
+    parser.add_argument(
+        '--pipeline_version',
+        help='Pipeline version',
+        default='backfill'
+    )
+    parser.add_argument(
+        '--tmp_dir',
+        help='Directory for temporal files',
+        required=True
+    )
+    parser.add_argument(
+        '--output',
+        help='Output directory',
+        required=True
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS (for offline benchmarks)'
+    )
+    parser.add_argument(
+        '--step_cache',
+        help='Skip train / postprocess / visualize when they already succeeded with the same inputs [ "on" | "off" ]',
+        default='on'
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--load_mode',
+        help='How the results are loaded into BigQuery [ "append" | "partition" ]',
+        default='partition'
+    )
+    parser.add_argument(
+        '--sink_dir',
+        help='Local directory used instead of BigQuery'
+    )
+    parser.add_argument(
+        '--preprocess_args',
+        help='Extra arguments passed to preprocess.py (e.g. "--query_backend sqlite --sqlite_db data.db")',
+        default=''
+    )
+    parser.add_argument(
+        '--train_args',
+        help='Extra arguments passed to train.py (e.g. "--update_mode stream")',
+        default=''
+    )
+    parser.add_argument(
+        '--postprocess_args',
+        help='Extra arguments passed to postprocess.py',
+        default=''
+    )
+    parser.add_argument(
+        '--visualize_args',
+        help='Extra arguments passed to visualize.py (e.g. "--sample_size 5000")',
+        default=''
+    )
+    parser.add_argument(
+        '--skip_visualize',
+        help='Do not build the pyLDAvis report of the last date',
+        action='store_true'
+    )
+
+    args = parser.parse_args()
+    params = args.__dict__
+
+    # 期間のチェック
+    if params['start_date'] > params['end_date']:
+        print('"--start_date" must not be after "--end_date".')
+        sys.exit()
+
+    # 初日に更新するモデルは前日のもの
+    if params['prev_date'] is None:
+        params['prev_date'] = shift_date(params['start_date'], -1)
+
+    return params
+
+
+def shift_date(date_str, days):
+    """'yyyy-mm-dd'の日付をdays日ずらす"""
+    shifted = datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=days)
+    return datetime.strftime(shifted, '%Y-%m-%d')
+
+
+def date_range(start_date, end_date):
+    """start_dateからend_dateまで（両端を含む）の日付のリスト"""
+    dates = [start_date]
+    while dates[-1] < end_date:
+        dates.append(shift_date(dates[-1], 1))
+    return dates
+
+
+def split_days(df, date_column):
+    """データセットをdate_columnの日付ごとに分け、{日付: date_columnを除いたdataframe} を返す"""
+    import pandas as pd
+
+    days = pd.to_datetime(df[date_column]).dt.strftime('%Y-%m-%d')
+    data = df.drop(date_column, axis=1)
+    return {day: frame.reset_index(drop=True) for day, frame in data.groupby(days)}
+
+
+def extract(args, preprocess, preprocess_args, store):
+    """期間全体のデータセットを1回のクエリで取得し、各日のpreprocessの成果物として保存"""
+    metrics.start('preprocess')
+    backend = get_backend(preprocess_args['query_backend'], args['project'], db_file=preprocess_args.get('sqlite_db'))
+
+    print('Loading dictionary data from BigQuery....')
+    with metrics.span('query'):
+        names = backend.read(build_query(preprocess.NAMES_TABLE))
+    metrics.add('dictionary_rows', len(names))
+
+    print('Loading dataset from {} to {}....'.format(args['start_date'], args['end_date']))
+    query = build_range_query(preprocess.DATASET_TABLE, args['date_column'], args['start_date'], args['end_date'])
+    with metrics.span('query'):
+        days = split_days(backend.read(query), args['date_column'])
+
+    for day, df in sorted(days.items()):
+        print('{}: {} rows'.format(day, len(df)))
+        output_dir = os.path.join(args['output'], 'workflow_' + day, 'preprocess')
+        day_args = dict(preprocess_args, date=day)
+        preprocess.save_names(store, names, day_args, output_dir)
+        preprocess.save_dataset(store, df, day_args, output_dir)
+        metrics.add('rows_processed', len(df))
+    metrics.write()
+    return sorted(days)
+
+
+def carry_forward(args, store, prev_date, date):
+    """行のない日のモデルとして、前日のモデルをその日のworkflowに保存"""
+    prev_dir = os.path.join(args['output'], 'workflow_' + prev_date, 'model')
+    model_dir = os.path.join(args['output'], 'workflow_' + date, 'model')
+    lda = load_model(store, prev_dir, args['tmp_dir'])
+    save_model(store, lda, model_dir, args['tmp_dir'])
+
+
+def main(args):
+    """期間の各日のモデルを続けて更新し、最後に結果をまとめてロード"""
+    import preprocess
+    import train
+    import postprocess
+    import visualize
+
+    def options(date):
+        return [
+            ('project', args['project']),
+            ('bucket', args['bucket']),
+            ('date', date),
+            ('tmp_dir', args['tmp_dir']),
+            ('output', args['output']),
+            ('storage_dir', args.get('storage_dir')),
+            ('artifact_format', args['artifact_format'])
+        ]
+
+    store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
+    handoff.enable()
+    try:
+        preprocess_args = step_arguments(preprocess, build_argv(options(args['start_date']), args['preprocess_args']))
+        days = extract(args, preprocess, preprocess_args, store)
+
+        # 前日のモデルをメモリ上で引き継いで各日のモデルを更新
+        prev_date = args['prev_date']
+        trained = []
+        for day in date_range(args['start_date'], args['end_date']):
+            if day not in days:
+                if not prev_date:
+                    print('No rows on {} and no model to carry forward.'.format(day))
+                    continue
+                print('No rows on {}, carrying forward the model of {}.'.format(day, prev_date))
+                carry_forward(args, store, prev_date, day)
+                handoff.discard(os.path.join(args['output'], 'workflow_' + prev_date) + '/')
+                prev_date = day
+                continue
+            train_args = step_arguments(train, build_argv(options(day) + [
+                ('preprocess_output', os.path.join(args['output'], 'workflow_' + day, 'preprocess')),
+                ('table', args['table']),
+                ('prev_date', prev_date),
+                ('learning_type', 'update' if prev_date else 'reset'),
+                ('pipeline_version', args['pipeline_version']),
+                ('step_cache', args['step_cache'])
+            ], args['train_args']))
+            train.main(train_args)
+
+            # 前日の成果物はもう使わないので、メモリから破棄
+            if prev_date:
+                handoff.discard(os.path.join(args['output'], 'workflow_' + prev_date) + '/')
+            prev_date = day
+            trained.append(day)
+
+        # 全ての日の結果をまとめてロード
+        print('Loading {} days of results....'.format(len(trained)))
+        for day in trained:
+            postprocess_args = step_arguments(postprocess, build_argv(options(day) + [
+                ('training_output', os.path.join(args['output'], 'workflow_' + day, 'train')),
+                ('table', args['table']),
+                ('step_cache', args['step_cache']),
+                ('load_mode', args['load_mode']),
+                ('sink_dir', args.get('sink_dir'))
+            ], args['postprocess_args']))
+            postprocess.main(postprocess_args)
+
+        # pyLDAvisは最終日のモデルについてのみ作成
+        if trained and not args['skip_visualize']:
+            visualize_args = step_arguments(visualize, build_argv(options(trained[-1]) + [
+                ('training_output', os.path.join(args['output'], 'workflow_' + trained[-1], 'train')),
+                ('table', args['table']),
+                ('step_cache', args['step_cache'])
+            ], args['visualize_args']))
+            visualize.main(visualize_args)
+    finally:
+        # 成果物のアップロードの完了を待つ
+        handoff.disable()
+
+    print('Backfill done.')
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
@@ -0,0 +1,2 @@
+# coding: utf-8
+"""パイプラインの各ステップで共有するモジュール"""
@@ -0,0 +1,163 @@
+# coding: utf-8
+"""
+ステップ間で受け渡すデータ（dictionary, dataset, TOPIC_RESULT）の読み書き
+- csv:     ヘッダなしのCSV（従来の形式）
+- parquet: スキーマ付きの列指向形式。float32のカラムやcategoryの文字列カラムを
+           そのまま受け渡せるので、読み込み時の再パースやキャストが不要
+"""
+
+import os
+import json
+from common import handoff
+from common.storage import read_csv
+
+
+FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet'
+}
+
+SCHEMA_FILE = 'schema.json'
+
+
+def artifact_file(name, fmt):
+    """拡張子付きのファイル名を返す"""
+    return name + FORMATS[fmt]
+
+
+def write_frame(df, local_file, fmt='csv', row_group_size=None):
+    """
+    - dataframeをファイルに保存
+    (Input)
+    df:             Dataframe
+    local_file:     File name located in the instance
+    fmt:            [ 'csv' | 'parquet' ]
+    row_group_size: Number of rows per row group (parquet)
+    """
+    if fmt == 'csv':
+        df.to_csv(local_file, header=False, index=False)
+    elif fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, local_file, row_group_size=row_group_size)
+    else:
+        raise ValueError('Unknown artifact format: {}'.format(fmt))
+
+
+def read_frame(store, remote_file, cols, fmt='csv', chunksize=None, dtype=None):
+    """
+    - ストレージ上のファイルをdataframeとして読み込む
+    - カラム名は保存時の名前によらず、colsで上書きする
+    (Input)
+    store:       Shared storage
+    remote_file: GCS file name
+    cols:        Column names of dataframe
+    fmt:         [ 'csv' | 'parquet' ]
+    chunksize:   Number of rows per chunk (None: read all rows)
+    dtype:       dtype of each column (csv)
+    """
+    if fmt == 'csv':
+        return read_csv(store, remote_file, cols, chunksize=chunksize, dtype=dtype)
+    elif fmt == 'parquet':
+        if chunksize is None:
+            with store.open_read(remote_file) as f:
+                return _read_parquet(f, cols)
+        return _iter_parquet(store.open_read(remote_file), cols, chunksize)
+    else:
+        raise ValueError('Unknown artifact format: {}'.format(fmt))
+
+
+def _read_parquet(f, cols):
+    import pyarrow.parquet as pq
+    df = pq.read_table(f).to_pandas()
+    df.columns = cols
+    return df
+
+
+def _iter_parquet(f, cols, chunksize):
+    # row groupごとに読み込み、chunksize行より大きいrow groupは分割する
+    import pyarrow.parquet as pq
+    with f:
+        parquet_file = pq.ParquetFile(f)
+        for i in range(parquet_file.num_row_groups):
+            df = parquet_file.read_row_group(i).to_pandas()
+            df.columns = cols
+            if len(df) <= chunksize:
+                yield df
+                continue
+            for start in range(0, len(df), chunksize):
+                yield df.iloc[start:start + chunksize]
+
+
+class FrameWriter(object):
+    """
+    - dataframeをchunkごとに1つのファイルへ追記する
+    - parquetの場合、chunkごとにrow groupになる
+      （スキーマは最初のchunkで決まるので、categoryのようにchunkごとに型が変わるカラムは使わない）
+    (Input)
+    local_file: File name located in the instance
+    fmt:        [ 'csv' | 'parquet' ]
+    """
+
+    def __init__(self, local_file, fmt='csv'):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown artifact format: {}'.format(fmt))
+        self.local_file = local_file
+        self.fmt = fmt
+        self.rows = 0
+        self._file = open(local_file, 'w') if fmt == 'csv' else None
+        self._writer = None
+
+    def write(self, df):
+        if self.fmt == 'csv':
+            df.to_csv(self._file, header=False, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.local_file, table.schema)
+            self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def constant_column(value, n):
+    """全行が同じ値のカラム（1行1byteのcategoryで、値の文字列を行数分持たない）"""
+    import numpy as np
+    import pandas as pd
+    return pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), [value])
+
+
+def result_columns(num_topics):
+    """TOPIC_RESULTのカラム名（トピック数に応じて変わる）"""
+    topic_cols = ['topic{}'.format(i) for i in range(num_topics)]
+    return ['date', 'id', 'name0', 'name1', 'name2', 'name3'] + topic_cols + ['execution_time', 'pipeline_version']
+
+
+def write_schema(store, tmp_dir, output_dir, num_topics):
+    """TOPIC_RESULTのスキーマ（トピック数とカラム名）を保存"""
+    local_file = handoff.local_file(tmp_dir, SCHEMA_FILE)
+    with open(local_file, 'w') as f:
+        json.dump({'num_topics': num_topics, 'columns': result_columns(num_topics)}, f)
+    handoff.upload(store, local_file, os.path.join(output_dir, SCHEMA_FILE), remove=True)
+
+
+def read_num_topics(store, output_dir, default=6):
+    """保存されたスキーマからトピック数を返す（ない場合はdefault）"""
+    remote_file = os.path.join(output_dir, SCHEMA_FILE)
+    if not store.exists(remote_file):
+        return default
+    return json.loads(store.read_bytes(remote_file).decode('utf-8'))['num_topics']
@@ -0,0 +1,26 @@
+# coding: utf-8
+"""
+認証キーの読み込み
+- 最初に使われた時点で生成し、プロセス内で使い回す（--helpや引数エラーの場合は生成しない）
+"""
+
+import threading
+
+
+_credentials = None
+_lock = threading.Lock()
+
+
+def get_credentials():
+    """認証キーを読み込み"""
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            print('loading credentials')
+            from google.oauth2 import service_account
+            _credentials = service_account.Credentials.from_service_account_info(
+                {
+                    """使用するGCPプロジェクトの認証キー情報を入れる"""
+                },
+            )
+        return _credentials
@@ -0,0 +1,199 @@
+# coding: utf-8
+"""
+結果ファイルを日付パーティション単位でテーブルにロードする
+- chunkごとにCSVファイルへ書き出し、まとめてアップロードしてからファイルベースのロードジョブを実行
+- ロードは対象パーティションの置き換え（WRITE_TRUNCATE）なので、リトライしても行が重複しない
+  - テーブルがない場合は日付パーティションのテーブルとして作成する
+  - pandas_gbqで作成した既存のテーブル（日付はSTRING・パーティションなし）には、その日付の行を削除してから追加する
+- テーブルへの追加（WRITE_APPEND）も全chunkを1つのロードジョブで行い、途中まで追加された状態を残さない
+- LocalSink: BigQueryの代わりにローカルディレクトリへ書き出す（テスト・ベンチマーク用）
+"""
+
+import os
+import shutil
+import tempfile
+from common.auth import get_credentials
+
+
+def bq_schema(cols, date_type='DATE'):
+    """カラム名からテーブルのスキーマ（カラム名, 型）を返す"""
+    schema = []
+    for col in cols:
+        if col == 'date':
+            schema.append((col, date_type))
+        elif col.startswith('topic'):
+            schema.append((col, 'FLOAT'))
+        else:
+            schema.append((col, 'STRING'))
+    return schema
+
+
+def partition_id(partition_date):
+    """'YYYY-mm-dd' -> 'YYYYmmdd'"""
+    return partition_date.replace('-', '')
+
+
+class BigQuerySink(object):
+    """ステージングしたファイルからBigQueryの日付パーティションにロードする"""
+
+    def __init__(self, project_name, store, staging_dir, credentials=None):
+        from google.cloud import bigquery
+        self.bigquery = bigquery
+        self.client = bigquery.Client(project_name, credentials=credentials or get_credentials())
+        self.store = store
+        self.staging_dir = staging_dir
+
+    def _stage(self, local_files):
+        """ステージング先に並列でアップロードし、ロードジョブに渡すURIを返す"""
+        remote_files = [os.path.join(self.staging_dir, os.path.basename(f)) for f in local_files]
+        self.store.upload_many(zip(local_files, remote_files))
+        return ['gs://{}/{}'.format(self.store.bucket_name, self.store.blob_name(f)) for f in remote_files]
+
+    def _load(self, uris, table_ref, job_config):
+        job = self.client.load_table_from_uri(uris, table_ref, job_config=job_config)
+        job.result()
+        return job.output_rows
+
+    def _table_ref(self, table):
+        dataset_id, table_id = table.split('.')
+        return self.client.dataset(dataset_id).table(table_id)
+
+    def _schema(self, cols, date_type='DATE'):
+        return [self.bigquery.SchemaField(name, field_type) for name, field_type in bq_schema(cols, date_type)]
+
+    def _get_or_create(self, table, cols):
+        """テーブルを返す（ない場合は日付パーティションのテーブルとして作成）"""
+        from google.cloud.exceptions import NotFound
+        bigquery = self.bigquery
+        try:
+            return self.client.get_table(self._table_ref(table))
+        except NotFound:
+            print('Creating the date-partitioned table {}'.format(table))
+            new_table = bigquery.Table(self._table_ref(table), schema=self._schema(cols))
+            new_table.time_partitioning = bigquery.TimePartitioning(field='date')
+            return self.client.create_table(new_table)
+
+    def _delete_date(self, table, partition_date):
+        """パーティションのないテーブルから、その日付の行を削除"""
+        bigquery = self.bigquery
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [bigquery.ScalarQueryParameter('date', 'STRING', partition_date)]
+        job = self.client.query('DELETE FROM `{}` WHERE date = @date'.format(table), job_config=job_config)
+        job.result()
+        return job.num_dml_affected_rows
+
+    def _append(self, uris, table, cols):
+        # 日付はpandas_gbqで作成した既存のテーブルと同じくSTRINGとしてロードする
+        bigquery = self.bigquery
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.CSV
+        job_config.schema = self._schema(cols, date_type='STRING')
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+        return self._load(uris, self._table_ref(table), job_config)
+
+    def load_partition(self, table, partition_date, local_files, cols):
+        """
+        - ファイルをアップロードし、1つのロードジョブでパーティションを置き換える
+        - 日付パーティションのないテーブル（pandas_gbqで作成した既存のテーブル）の場合は、
+          その日付の行を削除してから1つのロードジョブで追加する（リトライしても行は重複しない）
+        (Input)
+        table:          Destination table ('<dataset>.<table>')
+        partition_date: Partition date ('YYYY-mm-dd')
+        local_files:    Header-less CSV files located in the instance
+        cols:           Column names
+        """
+        bigquery = self.bigquery
+        uris = self._stage(local_files)
+
+        partitioning = self._get_or_create(table, cols).time_partitioning
+        if (partitioning is None) or (partitioning.field != 'date'):
+            deleted = self._delete_date(table, partition_date)
+            print('{} rows of {} deleted from {} (not partitioned by date)'.format(deleted, partition_date, table))
+            return self._append(uris, table, cols)
+
+        dataset_id, table_id = table.split('.')
+        table_ref = self.client.dataset(dataset_id).table('{}${}'.format(table_id, partition_id(partition_date)))
+
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.CSV
+        job_config.schema = self._schema(cols)
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        job_config.time_partitioning = bigquery.TimePartitioning(field='date')
+        return self._load(uris, table_ref, job_config)
+
+    def load_append(self, table, local_files, cols):
+        """
+        - ファイルをアップロードし、1つのロードジョブでテーブルに追加する
+        - 日付はpandas_gbqで作成した既存のテーブルと同じくSTRINGとしてロードする
+        (Input)
+        table:       Destination table ('<dataset>.<table>')
+        local_files: Header-less CSV files located in the instance
+        cols:        Column names
+        """
+        return self._append(self._stage(local_files), table, cols)
+
+
+class LocalSink(object):
+    """<root>/<table>/<YYYYmmdd>/ 以下にパーティションを書き出す"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def partition_dir(self, table, partition_date):
+        return os.path.join(self.root, table, partition_id(partition_date))
+
+    def load_partition(self, table, partition_date, local_files, cols):
+        # 一時ディレクトリに揃えてから置き換える
+        partition_dir = self.partition_dir(table, partition_date)
+        os.makedirs(os.path.dirname(partition_dir), exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=os.path.dirname(partition_dir))
+        rows = 0
+        for local_file in local_files:
+            shutil.copy(local_file, staging_dir)
+            with open(local_file) as f:
+                rows += sum(1 for _ in f)
+
+        if os.path.isdir(partition_dir):
+            shutil.rmtree(partition_dir)
+        os.rename(staging_dir, partition_dir)
+        return rows
+
+    def load_append(self, table, local_files, cols):
+        # 全てのファイルを1つのファイルにまとめてから、<root>/<table>/append/ に追加する
+        append_dir = os.path.join(self.root, table, 'append')
+        os.makedirs(append_dir, exist_ok=True)
+        fd, staging_file = tempfile.mkstemp(dir=append_dir, suffix='.partial')
+        rows = 0
+        with os.fdopen(fd, 'w') as out:
+            for local_file in local_files:
+                with open(local_file) as f:
+                    for line in f:
+                        out.write(line)
+                        rows += 1
+        os.rename(staging_file, staging_file[:-len('.partial')] + '.csv')
+        return rows
+
+
+def get_sink(project_name, store, staging_dir, credentials=None, sink_dir=None):
+    """
+    - ロード先を返す
+    (Input)
+    project_name: GCP project ID
+    store:        Shared storage (used for staging files)
+    staging_dir:  GCS directory where the files are staged
+    credentials:  GCP credentials
+    sink_dir:     Local directory used instead of BigQuery
+    """
+    if sink_dir:
+        return LocalSink(sink_dir)
+    return BigQuerySink(project_name, store, staging_dir, credentials)
+
+
+def write_parts(chunks, tmp_dir, prefix='part'):
+    """chunkごとにヘッダなしのCSVファイルへ書き出し、ファイル名のリストを返す"""
+    local_files = []
+    for i, df in enumerate(chunks):
+        local_file = os.path.join(tmp_dir, '{}-{:05d}.csv'.format(prefix, i))
+        df.to_csv(local_file, header=False, index=False)
+        local_files.append(local_file)
+    return local_files
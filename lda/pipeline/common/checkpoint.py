@@ -0,0 +1,266 @@
+# coding: utf-8
+"""
+LDAモデルのチェックポイント
+- lda.saveで出力されるファイル群を、マニフェスト（形式のバージョン・各ファイルのサイズとsha256）付きの
+  1つのtarアーカイブ（無圧縮）にまとめる
+- 大きな配列（expElogbeta, state.sstatsなど）は.npyのままアーカイブに格納するので、
+  読み込み時は展開せずにアーカイブ内の位置を直接memory-mapできる
+- 推論だけ行う場合は mmap='r'、モデルを更新する場合は mmap='c'（copy-on-write）で読み込む
+- 途中経過（progress.json）と一緒に保存しておくと、失敗した処理を途中から再開できる
+- cast_modelで読み込んだモデルの配列を学習時と異なる精度（float32 / float64）に揃えられる
+"""
+
+import os
+import io
+import json
+import pickle
+import shutil
+import tarfile
+import hashlib
+import numpy as np
+from common import handoff
+
+
+CHECKPOINT_FILE = 'model.ckpt'
+MANIFEST_FILE = 'MANIFEST.json'
+PROGRESS_FILE = 'progress.json'
+CHECKPOINT_FORMAT = 'lda-checkpoint'
+CHECKPOINT_VERSION = 1
+MODEL_NAME = 'model'
+
+# 旧形式（lda.saveのファイルを個別にアップロード）のファイル
+LEGACY_SUFFIXES = ['', '.expElogbeta.npy', '.id2word', '.state']
+
+
+def _sha256(f, size, block_size=1 << 20):
+    digest = hashlib.sha256()
+    while size > 0:
+        block = f.read(min(block_size, size))
+        if not block:
+            break
+        digest.update(block)
+        size -= len(block)
+    return digest.hexdigest()
+
+
+def save_checkpoint(lda, archive_file, tmp_dir):
+    """
+    - モデルを1つのアーカイブに保存
+    - 一時ファイルに書き込んでから置き換えるので、同じファイルをmmapで読み込み中でも安全
+    (Input)
+    lda:          LdaModel
+    archive_file: Archive file name located in the instance
+    tmp_dir:      Directory for temporal files
+    """
+    save_dir = os.path.join(tmp_dir, 'checkpoint')
+    if os.path.isdir(save_dir):
+        shutil.rmtree(save_dir)
+    os.mkdir(save_dir)
+
+    # stateの配列もサイズによらず.npyとして個別に保存
+    lda.save(os.path.join(save_dir, MODEL_NAME), sep_limit=0)
+
+    members = sorted(os.listdir(save_dir))
+    manifest = {
+        'format': CHECKPOINT_FORMAT,
+        'version': CHECKPOINT_VERSION,
+        'num_topics': lda.num_topics,
+        'num_terms': lda.num_terms,
+        'members': {}
+    }
+    for name in members:
+        path = os.path.join(save_dir, name)
+        with open(path, 'rb') as f:
+            manifest['members'][name] = {
+                'size': os.path.getsize(path),
+                'sha256': _sha256(f, os.path.getsize(path))
+            }
+
+    partial_file = archive_file + '.partial'
+    with tarfile.open(partial_file, 'w') as tar:
+        data = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST_FILE)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        for name in members:
+            tar.add(os.path.join(save_dir, name), arcname=name)
+    os.replace(partial_file, archive_file)
+    shutil.rmtree(save_dir)
+
+
+def read_manifest(archive_file):
+    """アーカイブのマニフェストを返す"""
+    with tarfile.open(archive_file, 'r') as tar:
+        return _read_manifest(tar)
+
+
+def _read_manifest(tar):
+    manifest = json.loads(tar.extractfile(MANIFEST_FILE).read().decode('utf-8'))
+    if manifest.get('format') != CHECKPOINT_FORMAT:
+        raise ValueError('Not an LDA checkpoint')
+    if manifest.get('version', 0) > CHECKPOINT_VERSION:
+        raise ValueError('Unsupported checkpoint version: {}'.format(manifest['version']))
+    return manifest
+
+
+def verify_checkpoint(archive_file):
+    """各ファイルのサイズとsha256がマニフェストと一致するか確認（アーカイブ全体を読む）"""
+    with tarfile.open(archive_file, 'r') as tar:
+        manifest = _read_manifest(tar)
+        for name, expected in manifest['members'].items():
+            f = tar.extractfile(name)
+            if _sha256(f, expected['size']) != expected['sha256']:
+                raise ValueError('Checksum mismatch in checkpoint: {}'.format(name))
+
+
+def _load_array(archive_file, info, mmap):
+    """アーカイブ内の.npyを読み込む（mmapを指定した場合は展開せずにmemory-map）"""
+    with open(archive_file, 'rb') as f:
+        f.seek(info.offset_data)
+        if mmap is None:
+            return np.lib.format.read_array(f)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        raise ValueError('Cannot mmap an object array: {}'.format(info.name))
+    return np.memmap(archive_file, dtype=dtype, mode=mmap, offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def _restore(obj, tar, archive_file, infos, name, mmap):
+    # gensimのSaveLoad._load_specialsと同じ手順で、個別に保存された属性を戻す
+    for attrib in getattr(obj, '__recursive_saveloads', []):
+        _restore(getattr(obj, attrib), tar, archive_file, infos, name + '.' + attrib, mmap)
+    for attrib in getattr(obj, '__numpys', []):
+        setattr(obj, attrib, _load_array(archive_file, infos[name + '.' + attrib + '.npy'], mmap))
+    if getattr(obj, '__scipys', []):
+        raise ValueError('Sparse attributes are not supported in checkpoints')
+    for attrib in getattr(obj, '__ignoreds', []):
+        setattr(obj, attrib, None)
+
+
+def _unpickle(tar, name):
+    return pickle.loads(tar.extractfile(name).read(), encoding='latin1')
+
+
+def load_checkpoint(archive_file, mmap='r'):
+    """
+    - アーカイブからモデルを読み込む
+    - 大きな配列はアーカイブをmemory-mapするので、使う部分だけ読み込まれる
+    (Input)
+    archive_file: Archive file name located in the instance
+    mmap:         [ 'r' (inference only) | 'c' (copy-on-write, for updating) | None (read into memory) ]
+    """
+    from gensim import utils
+
+    with tarfile.open(archive_file, 'r') as tar:
+        manifest = _read_manifest(tar)
+        infos = {info.name: info for info in tar.getmembers()}
+        for name, expected in manifest['members'].items():
+            if name not in infos or infos[name].size != expected['size']:
+                raise ValueError('Truncated checkpoint: {}'.format(name))
+
+        lda = _unpickle(tar, MODEL_NAME)
+        _restore(lda, tar, archive_file, infos, MODEL_NAME, mmap)
+        state = _unpickle(tar, MODEL_NAME + '.state')
+        _restore(state, tar, archive_file, infos, MODEL_NAME + '.state', mmap)
+        lda.state = state
+        lda.id2word = _unpickle(tar, MODEL_NAME + '.id2word')
+
+    # LdaModel.loadと同じく、古いモデルにない属性を補う
+    if not hasattr(lda, 'random_state'):
+        lda.random_state = utils.get_random_state(None)
+    if not hasattr(lda, 'dtype'):
+        lda.dtype = np.float64
+    return lda
+
+
+def cast_model(lda, dtype):
+    """
+    - モデルの配列（expElogbeta, eta, alpha, state）をdtypeに変換
+    - 既にdtypeの場合は何もしない（memory-mapしたままにする）
+    - 変換する配列はメモリに読み込まれるので、旧形式のfloat64のモデルを更新する場合などに使う
+    """
+    dtype = np.dtype(dtype)
+    if np.dtype(lda.dtype) == dtype and lda.expElogbeta.dtype == dtype:
+        return lda
+    lda.dtype = dtype
+    lda.expElogbeta = lda.expElogbeta.astype(dtype)
+    lda.eta = np.asarray(lda.eta).astype(dtype)
+    lda.alpha = np.asarray(lda.alpha).astype(dtype)
+    lda.state.sstats = lda.state.sstats.astype(dtype)
+    lda.state.eta = np.asarray(lda.state.eta).astype(dtype)
+    lda.state.dtype = dtype
+    return lda
+
+
+def save_model(store, lda, model_dir, tmp_dir):
+    """
+    - モデルをアーカイブに保存してストレージにアップロード
+    - アーカイブは保存ごとに別の名前にし、アップロード後に削除する（アップロード待ちの間に次の保存で上書きしない）
+    """
+    local_file = handoff.local_file(tmp_dir, CHECKPOINT_FILE)
+    remote_file = os.path.join(model_dir, CHECKPOINT_FILE)
+    save_checkpoint(lda, local_file, tmp_dir)
+    handoff.put(remote_file, lda)
+    handoff.upload(store, local_file, remote_file, remove=True)
+
+
+def load_model(store, model_dir, tmp_dir, mmap='r', local_name='prev_' + CHECKPOINT_FILE):
+    """
+    - ストレージ上のモデルを読み込む（同一プロセスで学習済みの場合はそれを使う）
+    - アーカイブがない場合は旧形式のファイル群を読み込む
+    - local_nameは保存するアーカイブや、mmap中の他のアーカイブと重ならない名前にする
+    """
+    remote_file = os.path.join(model_dir, CHECKPOINT_FILE)
+    lda = handoff.get(remote_file)
+    if lda is not None:
+        return lda
+
+    if store.exists(remote_file):
+        local_file = os.path.join(tmp_dir, local_name)
+        store.download(local_file, remote_file)
+        return load_checkpoint(local_file, mmap)
+
+    from gensim import models
+    model_file = os.path.join(tmp_dir, 'prev_' + MODEL_NAME)
+    legacy_file = os.path.join(model_dir, MODEL_NAME)
+    store.download_many([(model_file + suffix, legacy_file + suffix) for suffix in LEGACY_SUFFIXES])
+    return models.LdaModel.load(model_file, mmap=mmap)
+
+
+def save_progress(store, lda, progress_dir, tmp_dir, progress):
+    """
+    - 途中のモデルと進捗を保存
+    - 再開時に進捗だけが新しくならないよう、モデル -> 進捗の順にアップロード（バックグラウンドでも順序は保つ）
+    """
+    local_file = handoff.local_file(tmp_dir, 'progress_' + CHECKPOINT_FILE)
+    save_checkpoint(lda, local_file, tmp_dir)
+
+    local_progress = handoff.local_file(tmp_dir, PROGRESS_FILE)
+    with open(local_progress, 'w') as f:
+        json.dump(progress, f)
+    handoff.upload_many(store, [(local_file, os.path.join(progress_dir, CHECKPOINT_FILE)),
+                                (local_progress, os.path.join(progress_dir, PROGRESS_FILE))],
+                        remove=True, ordered=True)
+
+
+def load_progress(store, progress_dir):
+    """保存された進捗を返す（ない場合はNone）"""
+    remote_file = os.path.join(progress_dir, PROGRESS_FILE)
+    if not store.exists(remote_file):
+        return None
+    return json.loads(store.read_bytes(remote_file).decode('utf-8'))
+
+
+def clear_progress(store, progress_dir):
+    """完了した処理の途中経過を削除（アップロード待ちの途中経過が削除の後に書き込まれないよう、先に完了を待つ）"""
+    handoff.flush()
+    for name in [PROGRESS_FILE, CHECKPOINT_FILE]:
+        remote_file = os.path.join(progress_dir, name)
+        if store.exists(remote_file):
+            store.delete(remote_file)
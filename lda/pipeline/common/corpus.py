@@ -0,0 +1,136 @@
+# coding: utf-8
+"""
+ディスク上にBoWコーパスを保存し、memory-mapで読み込む
+- <prefix>.indptr:  各文書の開始位置 (int64)
+- <prefix>.indices: 単語ID (int32)
+- <prefix>.data:    出現回数 (float32)
+CSR行列と同じ並びなので、文書単位のランダムアクセスもできる
+"""
+
+import os
+import numpy as np
+
+
+INDPTR_DTYPE = np.int64
+INDICES_DTYPE = np.int32
+DATA_DTYPE = np.float32
+SUFFIXES = ['.indptr', '.indices', '.data']
+
+
+def _memmap(path, dtype):
+    # サイズ0のファイルはmemory-mapできない
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class MmapCorpus(object):
+    """gensimのコーパスとして使える、memory-mapされたBoWコーパス"""
+
+    def __init__(self, prefix, chunk_docs=10000):
+        self.prefix = prefix
+        self.chunk_docs = chunk_docs
+        self.indptr = _memmap(prefix + '.indptr', INDPTR_DTYPE)
+        self.indices = _memmap(prefix + '.indices', INDICES_DTYPE)
+        self.data = _memmap(prefix + '.data', DATA_DTYPE)
+
+    def __len__(self):
+        return max(len(self.indptr) - 1, 0)
+
+    def __getitem__(self, i):
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return list(zip(self.indices[start:end].tolist(), self.data[start:end].tolist()))
+
+    def __iter__(self):
+        # chunk_docs文書ずつまとめて読み込む
+        for first in range(0, len(self), self.chunk_docs):
+            last = min(first + self.chunk_docs, len(self))
+            indptr = self.indptr[first:last + 1]
+            indices = self.indices[indptr[0]:indptr[-1]].tolist()
+            data = self.data[indptr[0]:indptr[-1]].tolist()
+            offsets = (indptr - indptr[0]).tolist()
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                yield list(zip(indices[start:end], data[start:end]))
+
+    @staticmethod
+    def files(prefix):
+        return [prefix + suffix for suffix in SUFFIXES]
+
+    @classmethod
+    def serialize(cls, prefix, docs, chunk_docs=10000):
+        """
+        - BoWの文書を順に書き出し、memory-mapしたコーパスを返す
+        (Input)
+        prefix:     File name prefix of the corpus
+        docs:       Iterable of documents in BoW format [(id, count), ...]
+        chunk_docs: Number of documents buffered before writing
+        """
+        with open(prefix + '.indptr', 'wb') as f_indptr, \
+                open(prefix + '.indices', 'wb') as f_indices, \
+                open(prefix + '.data', 'wb') as f_data:
+            offset = 0
+            np.array([offset], dtype=INDPTR_DTYPE).tofile(f_indptr)
+            buf_indptr, buf_indices, buf_data = [], [], []
+            for doc in docs:
+                for term_id, count in doc:
+                    buf_indices.append(term_id)
+                    buf_data.append(count)
+                offset += len(doc)
+                buf_indptr.append(offset)
+
+                if len(buf_indptr) >= chunk_docs:
+                    np.array(buf_indptr, dtype=INDPTR_DTYPE).tofile(f_indptr)
+                    np.array(buf_indices, dtype=INDICES_DTYPE).tofile(f_indices)
+                    np.array(buf_data, dtype=DATA_DTYPE).tofile(f_data)
+                    buf_indptr, buf_indices, buf_data = [], [], []
+
+            np.array(buf_indptr, dtype=INDPTR_DTYPE).tofile(f_indptr)
+            np.array(buf_indices, dtype=INDICES_DTYPE).tofile(f_indices)
+            np.array(buf_data, dtype=DATA_DTYPE).tofile(f_data)
+
+        return cls(prefix, chunk_docs=chunk_docs)
+
+    @classmethod
+    def serialize_csr(cls, prefix, matrices, chunk_docs=10000):
+        """
+        - 文書-単語行列 (CSR) を順に書き出し、memory-mapしたコーパスを返す
+        (Input)
+        prefix:   File name prefix of the corpus
+        matrices: Iterable of CSR matrices (rows = documents)
+        """
+        with CsrWriter(prefix) as writer:
+            for matrix in matrices:
+                writer.write(matrix)
+
+        return cls(prefix, chunk_docs=chunk_docs)
+
+
+class CsrWriter(object):
+    """
+    - 文書-単語行列 (CSR) を書き足してコーパスのファイルを作る
+    - 複数のコーパスに振り分けながら書く場合に使う（1つだけの場合はMmapCorpus.serialize_csr）
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.offset = 0
+        self._f_indptr = open(prefix + '.indptr', 'wb')
+        self._f_indices = open(prefix + '.indices', 'wb')
+        self._f_data = open(prefix + '.data', 'wb')
+        np.array([self.offset], dtype=INDPTR_DTYPE).tofile(self._f_indptr)
+
+    def write(self, matrix):
+        (matrix.indptr[1:] + self.offset).astype(INDPTR_DTYPE).tofile(self._f_indptr)
+        matrix.indices[:matrix.indptr[-1]].astype(INDICES_DTYPE).tofile(self._f_indices)
+        matrix.data[:matrix.indptr[-1]].astype(DATA_DTYPE).tofile(self._f_data)
+        self.offset += int(matrix.indptr[-1])
+
+    def close(self):
+        for f in (self._f_indptr, self._f_indices, self._f_data):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,108 @@
+# coding: utf-8
+"""
+dictionaryのキャッシュ
+- マスターデータ（NAMES）の内容のハッシュをキーに、生成済みのdictionaryをbucketに保存する
+- ハッシュが一致すればマスターデータのダウンロードとdictionaryの生成を省略できる
+- 最近使ったものから keep 世代だけ残し、それより古いものは削除する
+"""
+
+import os
+import json
+import hashlib
+from common import handoff
+
+
+CACHE_DIR = 'dict_cache'
+HASH_FILE = 'dict_hash.txt'
+DICT_FILE = 'dictionary'
+
+
+def content_hash(df):
+    """dataframeの内容のハッシュ（sha256）を返す"""
+    data = df.to_csv(header=False, index=False).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_file(output_dir, digest):
+    return os.path.join(output_dir, CACHE_DIR, digest, DICT_FILE)
+
+
+def index_file(output_dir):
+    return os.path.join(output_dir, CACHE_DIR, 'index.json')
+
+
+def has_cache(store, output_dir, digest):
+    return store.exists(cache_file(output_dir, digest))
+
+
+def read_hash(store, preprocess_output):
+    """preprocessが記録したハッシュを返す（ない場合はNone）"""
+    remote_file = os.path.join(preprocess_output, HASH_FILE)
+    if not store.exists(remote_file):
+        return None
+    return store.read_bytes(remote_file).decode('utf-8').strip()
+
+
+def write_hash(store, local_file, preprocess_output, digest):
+    with open(local_file, 'w') as f:
+        f.write(digest)
+    store.upload(local_file, os.path.join(preprocess_output, HASH_FILE))
+
+
+def load_dictionary(store, output_dir, digest, tmp_dir):
+    """
+    - キャッシュからdictionaryを読み込む（ない場合はNone）
+    (Input)
+    store:      Shared storage
+    output_dir: Output directory of the pipeline
+    digest:     Content hash of the master data
+    tmp_dir:    Temporal directory
+    """
+    from gensim import corpora
+
+    remote_file = cache_file(output_dir, digest)
+    if not store.exists(remote_file):
+        return None
+    local_file = os.path.join(tmp_dir, DICT_FILE)
+    store.download(local_file, remote_file)
+    _touch(store, output_dir, digest, tmp_dir)
+    return corpora.Dictionary.load(local_file)
+
+
+def save_dictionary(store, output_dir, digest, dict_deck, tmp_dir, keep=5):
+    """
+    - dictionaryをキャッシュに保存し、古いものを削除
+    (Input)
+    store:      Shared storage
+    output_dir: Output directory of the pipeline
+    digest:     Content hash of the master data
+    dict_deck:  Dictionary
+    tmp_dir:    Temporal directory
+    keep:       Number of versions kept in the cache
+    """
+    local_file = handoff.local_file(tmp_dir, DICT_FILE)
+    dict_deck.save(local_file)
+    handoff.upload(store, local_file, cache_file(output_dir, digest), remove=True)
+
+    return _touch(store, output_dir, digest, tmp_dir, keep=keep)
+
+
+def _touch(store, output_dir, digest, tmp_dir, keep=None):
+    """indexの末尾（最近使ったもの）にdigestを移し、keepを超えた分を削除する"""
+    remote_index = index_file(output_dir)
+    digests = []
+    if store.exists(remote_index):
+        digests = json.loads(store.read_bytes(remote_index).decode('utf-8'))
+    digests = [d for d in digests if d != digest] + [digest]
+
+    if keep is not None and len(digests) > keep:
+        for old in digests[:-keep]:
+            if store.exists(cache_file(output_dir, old)):
+                store.delete(cache_file(output_dir, old))
+        digests = digests[-keep:]
+
+    local_index = handoff.local_file(tmp_dir, 'dict_cache_index.json')
+    with open(local_index, 'w') as f:
+        json.dump(digests, f)
+    handoff.upload(store, local_index, remote_index, remove=True)
+    return digests
@@ -0,0 +1,137 @@
+# coding: utf-8
+"""
+複数Podでのデータ並列学習（E-stepとM-stepの分離）
+- split: データセットを1回だけ読み込んでchunk_size行ずつのblockに分け、shardごとに担当分（num_shardsおき）を
+  エンコード済みのコーパス（MmapCorpus）として保存する
+- shard: 自分のコーパスだけをダウンロードし、前のpassのモデルでE-stepを行い、十分統計量（sstats）と文書数を保存する
+- reducer: 全shardの統計量を合算し、M-stepでモデルを更新して次のpassのモデルとして保存する
+- gensimの分散LDAのバッチ学習（update_every=0）と同じく、passごとに1回M-stepを行う
+- pass 0のshardとreducerは同じ乱数シードで初期モデルを作るので、初期モデルの受け渡しは不要
+"""
+
+import os
+import numpy as np
+
+
+DIST_DIR = 'distributed'
+SHARD_DIR = 'shards'
+MODEL_DIR = 'model'
+
+# kfpに渡す値（splitはParallelForで展開するshardの一覧、reducerは次のpass番号か最後のpassの場合は'done'）
+SHARDS_FILE = '/shards.json'
+NEXT_PASS_FILE = '/next_pass.txt'
+LAST_PASS = 'done'
+
+
+def pass_dir(output, date, pass_no):
+    """pass_no番目のpassの統計量とモデルの保存先"""
+    return os.path.join(output, 'workflow_' + date, DIST_DIR, 'pass_{:03d}'.format(pass_no))
+
+
+def shard_dir(output, date):
+    """splitで分けたshardごとのコーパスの保存先（全passで共通）"""
+    return os.path.join(output, 'workflow_' + date, DIST_DIR, SHARD_DIR)
+
+
+def shard_prefix(shard):
+    return 'shard_{:03d}'.format(shard)
+
+
+def next_pass(pass_no, num_pass):
+    """reducerの後に続けるpass（最後のpassの場合はLAST_PASS）"""
+    return str(pass_no + 1) if pass_no + 1 < num_pass else LAST_PASS
+
+
+def state_file(shard):
+    return 'shard_{:03d}.npz'.format(shard)
+
+
+def is_assigned(block_no, shard, num_shards):
+    """blockをshardが担当するか"""
+    return block_no % num_shards == shard
+
+
+def assigned_rows(offset, rows, block_size, shard, num_shards):
+    """
+    - データセットのoffset行目からrows行のmicro-batchのうち、shardが担当する範囲（micro-batch内の行番号）を返す
+    - blockはデータセット全体の行番号で決めるので、micro-batchの大きさによらず同じ分け方になる
+    """
+    start = offset
+    end = offset + rows
+    while start < end:
+        block_no = start // block_size
+        stop = min((block_no + 1) * block_size, end)
+        if is_assigned(block_no, shard, num_shards):
+            yield start - offset, stop - offset
+        start = stop
+
+
+def init_model(id2word, num_topics, chunk_size, dtype=np.float32):
+    """学習前の初期モデル（同じ引数であれば、どのPodで作っても同じモデルになる）"""
+    from gensim import models
+    return models.LdaModel(
+        id2word=id2word,
+        num_topics=num_topics,
+        chunksize=chunk_size,
+        minimum_probability=0.,
+        random_state=1,
+        dtype=dtype
+    )
+
+
+def new_state(lda):
+    """モデルと同じ形の空の統計量"""
+    from gensim.models.ldamodel import LdaState
+    return LdaState(lda.eta, lda.state.sstats.shape, lda.dtype)
+
+
+def accumulate(lda, corpus, chunk_size, state):
+    """
+    - コーパスのE-stepを行い、統計量をstateに加算
+    (Input)
+    lda:        Model of the previous pass
+    corpus:     Corpus of the shard
+    chunk_size: Number of documents per E-step
+    state:      LdaState to accumulate into
+    """
+    from gensim import utils
+    for chunk in utils.grouper(corpus, chunk_size):
+        lda.do_estep(chunk, state)
+    return state
+
+
+def save_state(state, local_file):
+    """統計量を.npzで保存（pickleを使わない）"""
+    with open(local_file, 'wb') as f:
+        np.savez(f, sstats=state.sstats, numdocs=np.array(state.numdocs))
+
+
+def load_state(lda, local_file):
+    state = new_state(lda)
+    with np.load(local_file) as data:
+        state.sstats = data['sstats'].astype(lda.dtype, copy=False)
+        state.numdocs = int(data['numdocs'])
+    return state
+
+
+def merge_states(states):
+    """全shardの統計量を合算"""
+    merged = states[0]
+    for state in states[1:]:
+        merged.merge(state)
+    return merged
+
+
+def apply_mstep(lda, state, pass_no):
+    """
+    - 合算した統計量でM-stepを行う
+    - 学習率はLdaModel.updateのバッチ学習と同じく、pass数と更新済みの文書数から決める
+    """
+    if state.numdocs == 0:
+        raise ValueError('No documents in the shards of pass {}'.format(pass_no))
+    # LdaModel.updateと同じく、コーパス全体の文書数は最初のpassの前に1回だけ加える
+    if pass_no == 0:
+        lda.state.numdocs += state.numdocs
+    rho = pow(lda.offset + pass_no + (lda.num_updates / lda.chunksize), -lda.decay)
+    lda.do_mstep(rho, state, pass_no > 0)
+    return lda
@@ -0,0 +1,67 @@
+# coding: utf-8
+"""
+デッキのデータセットをまとめて単語IDに変換し、疎行列 (CSR) で返す
+- dictionaryの単語をpandasのIndexにしておき、全カラムを一度に引き当てる
+- dictionaryにない単語（欠損値を含む）はdoc2bowと同様に無視する
+"""
+
+import numpy as np
+
+
+def build_lookup(dict_deck):
+    """単語ID順に並べた単語のIndexを返す（位置 = 単語ID）"""
+    import pandas as pd
+    return pd.Index([dict_deck[i] for i in range(len(dict_deck))])
+
+
+def encode_decks(data_deck, lookup, unknown='ignore', dtype=np.float32):
+    """
+    - デッキのデータセットを (n_docs, num_terms) の文書-単語行列に変換
+    (Input)
+    data_deck: Dataframe of words (hero0..hero3)
+    lookup:    Index of words returned by build_lookup
+    unknown:   How to treat words missing from the dictionary [ 'ignore' | 'error' ]
+    dtype:     dtype of the counts
+    """
+    import pandas as pd
+    from scipy import sparse
+
+    words = data_deck.values
+    n_docs, n_cols = words.shape
+    term_ids = lookup.get_indexer(words.ravel())
+
+    # dictionaryにない単語
+    known = term_ids >= 0
+    if not known.all():
+        if unknown == 'error':
+            missing = pd.unique(words.ravel()[~known])
+            raise ValueError('Words missing from the dictionary: {}'.format(list(missing[:10])))
+        print('Ignoring {} words missing from the dictionary'.format((~known).sum()))
+
+    rows = np.repeat(np.arange(n_docs), n_cols)[known]
+    counts = np.ones(len(rows), dtype=dtype)
+    matrix = sparse.coo_matrix((counts, (rows, term_ids[known])), shape=(n_docs, len(lookup)))
+
+    # 重複した単語は出現回数として合算される
+    matrix = matrix.tocsr()
+    matrix.sum_duplicates()
+    return matrix
+
+
+def to_corpus(matrix):
+    """文書-単語行列をgensimのコーパスとして扱う"""
+    from gensim import matutils
+    return matutils.Sparse2Corpus(matrix, documents_columns=False)
+
+
+def as_matrix(corpus, num_terms):
+    """コーパスを文書-単語行列 (CSR) に変換（変換済みの場合はコピーせずに返す）"""
+    from scipy import sparse
+    from gensim import matutils
+    from common.corpus import MmapCorpus
+
+    if isinstance(corpus, MmapCorpus):
+        return sparse.csr_matrix((corpus.data, corpus.indices, corpus.indptr), shape=(len(corpus), num_terms))
+    if isinstance(corpus, matutils.Sparse2Corpus):
+        return corpus.sparse.T.tocsr()
+    return matutils.corpus2csc(corpus, num_terms=num_terms).T.tocsr()
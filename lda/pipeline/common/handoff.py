@@ -0,0 +1,153 @@
+# coding: utf-8
+"""
+同一プロセスで複数ステップを実行する場合の、メモリ上での受け渡し
+- 各ステップは保存したファイルと同じ名前（GCSのパス）でオブジェクトを登録する
+- 次のステップは登録済みであればストレージから読み込まずにそのまま使う
+- 有効な間、ファイルのアップロードはバックグラウンドで実行し、flushで完了を待つ
+- アップロード待ちのファイルが次の保存で上書きされないよう、ファイルはlocal_fileで毎回別の名前にし、
+  アップロード後に削除する（remove=True）
+- 無効（既定）の場合は何も登録せず、アップロードもその場で実行する
+- 単独で実行するステップも、async_uploadsでアップロードだけをバックグラウンドで実行できる
+"""
+
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+_objects = {}
+_futures = []
+_executor = None
+_share = False
+_lock = threading.Lock()
+
+
+def enable(max_workers=4, share=True):
+    """
+    - メモリ上での受け渡しを有効にする
+    - share=Falseの場合はアップロードのバックグラウンド実行だけを有効にし、オブジェクトは登録しない
+    """
+    global _executor, _share
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers)
+            _share = share
+
+
+def is_enabled():
+    return _executor is not None
+
+
+def is_sharing():
+    """オブジェクトを登録する（次のステップが使う）状態か"""
+    return is_enabled() and _share
+
+
+def put(remote_file, obj):
+    """remote_fileに保存したオブジェクトを登録"""
+    if is_enabled() and _share:
+        with _lock:
+            _objects[remote_file] = obj
+
+
+def get(remote_file):
+    """登録済みのオブジェクトを返す（ない場合はNone）"""
+    with _lock:
+        return _objects.get(remote_file)
+
+
+def discard(prefix):
+    """prefixで始まる名前で登録したオブジェクトを破棄（長いバックフィルでメモリを解放する）"""
+    with _lock:
+        for remote_file in [name for name in _objects if name.startswith(prefix)]:
+            del _objects[remote_file]
+
+
+def get_frame(remote_file, cols):
+    """登録済みのdataframeをカラム名を付け替えて返す（ない場合はNone）"""
+    df = get(remote_file)
+    if df is None:
+        return None
+    df = df.copy(deep=False)
+    df.columns = cols
+    return df
+
+
+def local_file(tmp_dir, name):
+    """アップロードするファイルのローカルの名前（呼び出しごとに別の名前にする）"""
+    fd, path = tempfile.mkstemp(prefix='upload_', suffix='_' + name, dir=tmp_dir)
+    os.close(fd)
+    return path
+
+
+def upload(store, local_file, remote_file, remove=False):
+    """有効な場合はバックグラウンドで、無効な場合はその場でアップロード"""
+    upload_many(store, [(local_file, remote_file)], remove=remove)
+
+
+def upload_many(store, files, remove=False, ordered=False):
+    """
+    - 複数のファイルをアップロード
+    (Input)
+    store:   Shared storage
+    files:   List of (local_file, remote_file)
+    remove:  Remove the local files after uploading them
+    ordered: Upload the files one by one in the given order (e.g. the data before the file pointing to it)
+    """
+    files = list(files)
+    if not is_enabled():
+        _upload(store, files, remove, ordered)
+        return
+    with _lock:
+        _futures.append(_executor.submit(_upload, store, files, remove, ordered))
+
+
+def _upload(store, files, remove, ordered):
+    if ordered:
+        for local_file, remote_file in files:
+            store.upload(local_file, remote_file)
+    else:
+        store.upload_many(files)
+    if remove:
+        for local_file, _ in files:
+            os.remove(local_file)
+
+
+def flush():
+    """バックグラウンドのアップロードの完了を待つ（失敗があれば例外を送出）"""
+    with _lock:
+        futures = list(_futures)
+        del _futures[:]
+    for future in futures:
+        future.result()
+
+
+def disable():
+    """アップロードの完了を待ってから無効にし、登録済みのオブジェクトを破棄"""
+    global _executor
+    try:
+        flush()
+    finally:
+        with _lock:
+            if _executor is not None:
+                _executor.shutdown()
+                _executor = None
+            _objects.clear()
+
+
+@contextmanager
+def async_uploads(max_workers=4):
+    """
+    - withブロック内のアップロードをバックグラウンドで実行し、抜けるときに完了を待つ
+    - 既に有効な場合（同一プロセスで複数ステップを実行中）はそのまま使う
+    """
+    if is_enabled():
+        yield
+        return
+    enable(max_workers, share=False)
+    try:
+        yield
+    finally:
+        disable()
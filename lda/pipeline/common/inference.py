@@ -0,0 +1,117 @@
+# coding: utf-8
+"""
+コーパスのトピック分布をまとめて推定する
+- chunk_docs文書ずつLdaModel.inferenceで推定し、(n_docs, num_topics)の配列に直接書き込む
+- processes > 1 の場合はchunkをプロセスプールに分配する
+- 同じ構成の文書（BoWが同一）は1回だけ推定し、結果を該当する全行に書き戻せる
+"""
+
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
+
+
+_worker_lda = None
+
+
+def iter_chunks(corpus, chunk_docs):
+    """コーパスをchunk_docs文書ずつのリストに分ける"""
+    it = iter(corpus)
+    while True:
+        chunk = list(islice(it, chunk_docs))
+        if not chunk:
+            return
+        yield chunk
+
+
+def infer_chunk(lda, chunk):
+    """chunk内の各文書のトピック分布（正規化済み）を返す"""
+    gamma, _ = lda.inference(chunk)
+    return gamma / gamma.sum(axis=1)[:, np.newaxis]
+
+
+def _init_worker(lda):
+    global _worker_lda
+    _worker_lda = lda
+
+
+def _infer_worker(chunk):
+    return infer_chunk(_worker_lda, chunk)
+
+
+def infer_topics(lda, corpus, chunk_docs=1000, processes=1, dtype=np.float64):
+    """
+    - コーパスのトピック分布を (n_docs, num_topics) の配列で返す
+    (Input)
+    lda:        Trained LDA model
+    corpus:     Corpus in BoW format (supports len())
+    chunk_docs: Number of documents inferred at once
+    processes:  Number of worker processes
+    dtype:      dtype of the returned array
+    """
+    topic_prob = np.empty((len(corpus), lda.num_topics), dtype=dtype)
+    chunks = iter_chunks(corpus, chunk_docs)
+
+    start = 0
+    if processes > 1:
+        pool = Pool(processes, initializer=_init_worker, initargs=(lda,))
+        try:
+            for prob in pool.imap(_infer_worker, chunks):
+                topic_prob[start:start + len(prob)] = prob
+                start += len(prob)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in chunks:
+            prob = infer_chunk(lda, chunk)
+            topic_prob[start:start + len(prob)] = prob
+            start += len(prob)
+
+    return topic_prob
+
+
+def dedup_matrix(matrix):
+    """
+    - 文書-単語行列 (CSR) の同一の行をまとめる
+    - 各行を (単語ID..., 出現回数...) の固定長の値に並べ、np.uniqueで一度に比較する
+    (Output)
+    unique_rows: 重複を除いた行の行列
+    inverse:     各文書に対応するunique_rowsの行番号
+    """
+    # 単語IDの順に揃え、同じ単語は合算しておく（memory-mapした行列は書き換えない）
+    if not matrix.has_canonical_format:
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+
+    n_docs = matrix.shape[0]
+    lengths = np.diff(matrix.indptr)
+    # 空の文書だけの場合も1列は確保する（長さ0の値は比較できない）
+    width = max(int(lengths.max()) if n_docs > 0 else 0, 1)
+
+    # 空きは-1で埋める（出現回数はfloat32のビット列をそのまま使う）
+    rows = np.repeat(np.arange(n_docs), lengths)
+    cols = np.arange(len(rows)) - np.repeat(matrix.indptr[:-1], lengths)
+    keys = np.full((n_docs, 2 * width), -1, dtype=np.int32)
+    keys[rows, cols] = matrix.indices
+    keys[rows, width + cols] = matrix.data.astype(np.float32).view(np.int32)
+
+    # 各行を1つの固定長の値として比較する（axis=0で比較するより速い）
+    keys = keys.view(np.dtype((np.void, keys.itemsize * keys.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return matrix[first], inverse.ravel()
+
+
+def infer_topics_dedup(lda, corpus, chunk_docs=1000, processes=1, dtype=np.float64):
+    """
+    - 重複を除いた文書だけを推定し、元の並びの (n_docs, num_topics) の配列で返す
+    (Output)
+    topic_prob:  Topic distribution of each document
+    dedup_ratio: 元の文書数 / 推定した文書数
+    """
+    from common.encoder import as_matrix, to_corpus
+
+    unique_rows, inverse = dedup_matrix(as_matrix(corpus, lda.num_terms))
+    unique_prob = infer_topics(lda, to_corpus(unique_rows), chunk_docs=chunk_docs, processes=processes, dtype=dtype)
+    dedup_ratio = len(inverse) / max(unique_rows.shape[0], 1)
+    return unique_prob[inverse], dedup_ratio
@@ -0,0 +1,180 @@
+# coding: utf-8
+"""
+ステップの計測値
+- span:  処理（query, download, encode, train, infer, visualize, upload, stage, load）ごとの経過時間
+- add:   処理した行数などのカウンタ
+- trace: 学習のpassごとのperplexityなどの系列
+- 最大メモリ使用量とストレージと送受信したバイト数はwriteの時点の値を記録
+処理の終了ごとに構造化ログ（1行のjson）を標準出力に出し、writeでKubeflow Pipelinesのメトリクス
+（/mlpipeline-metrics.json）として保存する
+系列は長さが決まらない（ストリーミング更新ではmicro-batch数 x pass数）ので、メトリクスには
+最初・最後・最小の値と件数だけを出し、全ての値は構造化ログに残す
+"""
+
+import re
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from common import storage
+
+
+METRICS_FILE = '/mlpipeline-metrics.json'
+
+_lock = threading.Lock()
+_state = {}
+
+
+def start(step):
+    """計測を開始する（同一プロセスで複数ステップを実行する場合はステップごとに呼ぶ）"""
+    with _lock:
+        _state.clear()
+        _state.update({
+            'step': step,
+            'start': time.time(),
+            'transferred': storage.transferred(),
+            'spans': OrderedDict(),
+            'counters': OrderedDict(),
+            'traces': OrderedDict()
+        })
+
+
+def _ensure_started():
+    if not _state:
+        start('unknown')
+
+
+def log(event, **fields):
+    """構造化ログを1行のjsonとして出力"""
+    record = OrderedDict([('severity', 'INFO'), ('step', _state.get('step')), ('event', event)])
+    record.update(fields)
+    print(json.dumps(record))
+    sys.stdout.flush()
+
+
+@contextmanager
+def span(phase):
+    """withブロックの経過時間をphaseに加算"""
+    _ensure_started()
+    begin = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - begin
+        with _lock:
+            _state['spans'][phase] = _state['spans'].get(phase, 0.0) + elapsed
+        log('span', phase=phase, seconds=round(elapsed, 3))
+
+
+def add(name, value):
+    """カウンタに加算"""
+    _ensure_started()
+    with _lock:
+        _state['counters'][name] = _state['counters'].get(name, 0) + value
+
+
+def trace(name, value):
+    """系列に値を追加"""
+    _ensure_started()
+    with _lock:
+        _state['traces'].setdefault(name, []).append(value)
+    log('trace', name=name, index=len(_state['traces'][name]), value=value)
+
+
+class _PerplexityHandler(logging.Handler):
+    # perplexityは丸めて出力されるので、per-word boundから計算する
+    PATTERN = re.compile(r'(-?[0-9.]+) per-word bound')
+
+    def emit(self, record):
+        match = self.PATTERN.search(record.getMessage())
+        if match:
+            trace('perplexity', 2 ** -float(match.group(1)))
+
+
+@contextmanager
+def perplexity_per_pass():
+    """
+    - withブロック内の学習でgensimが出力するperplexityの推定値を系列'perplexity'に記録
+    - モデルのeval_everyを十分大きくしておくと、各passの最後のchunkで1回ずつ評価される
+    """
+    logger = logging.getLogger('gensim.models.ldamodel')
+    handler = _PerplexityHandler(level=logging.INFO)
+    level = logger.level
+    logger.addHandler(handler)
+    if logger.getEffectiveLevel() > logging.INFO:
+        logger.setLevel(logging.INFO)
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+
+def peak_memory_mb():
+    """このプロセスと終了した子プロセスの最大メモリ使用量（Linuxのru_maxrssはKB単位）"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.0
+
+
+def summary():
+    """計測値をまとめて返す"""
+    _ensure_started()
+    with _lock:
+        transferred = storage.transferred()
+        result = OrderedDict([
+            ('step', _state['step']),
+            ('wall_seconds', time.time() - _state['start']),
+            ('peak_memory_mb', peak_memory_mb())
+        ])
+        for key, value in transferred.items():
+            result[key] = value - _state['transferred'].get(key, 0)
+        result['spans'] = OrderedDict((k, round(v, 3)) for k, v in _state['spans'].items())
+        result['counters'] = OrderedDict(_state['counters'])
+        result['traces'] = OrderedDict((k, list(v)) for k, v in _state['traces'].items())
+    return result
+
+
+def _metric_name(*parts):
+    # Kubeflow Pipelinesのメトリクス名は小文字・数字・ハイフンのみ
+    name = '-'.join(str(part) for part in parts).lower().replace('_', '-')
+    return re.sub(r'[^a-z0-9-]', '', name)[:63].strip('-')
+
+
+def _metric(name, value):
+    return {'name': name, 'numberValue': float(value), 'format': 'RAW'}
+
+
+def write(metrics_file=METRICS_FILE):
+    """計測値を構造化ログに出力し、Kubeflow Pipelinesのメトリクスとして保存"""
+    result = summary()
+    log('summary', **{k: v for k, v in result.items() if k not in ('step',)})
+
+    metrics = [
+        _metric(_metric_name('wall-seconds'), result['wall_seconds']),
+        _metric(_metric_name('peak-memory-mb'), result['peak_memory_mb']),
+        _metric(_metric_name('bytes-uploaded'), result['bytes_uploaded']),
+        _metric(_metric_name('bytes-downloaded'), result['bytes_downloaded'])
+    ]
+    for phase, seconds in result['spans'].items():
+        metrics.append(_metric(_metric_name(phase, 'seconds'), seconds))
+    for name, value in result['counters'].items():
+        metrics.append(_metric(_metric_name(name), value))
+    for name, values in result['traces'].items():
+        if not values:
+            continue
+        metrics.append(_metric(_metric_name(name, 'first'), values[0]))
+        metrics.append(_metric(_metric_name(name, 'last'), values[-1]))
+        metrics.append(_metric(_metric_name(name, 'min'), min(values)))
+        metrics.append(_metric(_metric_name(name, 'count'), len(values)))
+
+    try:
+        with open(metrics_file, 'w') as f:
+            json.dump({'metrics': metrics}, f)
+    except:
+        pass
+    return result
@@ -0,0 +1,179 @@
+# coding: utf-8
+"""
+クエリの実行先（BigQuery / SQLite）と、差分抽出用のwatermark
+- sqlite: BigQueryの代わりにローカルのSQLiteファイルを使う（テスト・ベンチマーク用）
+- watermark: テーブルごとに取得済みの最大値（日付やid）を保存し、次回はそれより後の行だけ取得する
+  - 抽出を始めたとき・終えたときのwatermarkはワークフローの出力にも残し、同じ日付の再実行では同じ範囲の行を取得する
+"""
+
+import os
+import json
+import sqlite3
+from common.auth import get_credentials
+
+
+# 抽出元のテーブルと、データセットとして保存するカラム（trainはこの順で読み込む）
+NAMES_TABLE = 'SAMPLE.NAMES'
+DATASET_TABLE = 'SAMPLE.DUMMY'
+DATASET_COLUMNS = ['id', 'hero0', 'hero1', 'hero2', 'hero3']
+
+
+class BigQueryBackend(object):
+    """BigQueryでクエリを実行する"""
+
+    def __init__(self, project_name, credentials=None):
+        self.project_name = project_name
+        self.credentials = credentials
+
+    def read(self, query):
+        import pandas_gbq
+        return pandas_gbq.read_gbq(query, project_id=self.project_name, dialect='standard',
+                                   credentials=self.credentials or get_credentials())
+
+
+class SQLiteBackend(object):
+    """SQLiteでクエリを実行する（'SAMPLE.DUMMY' のようなデータセット名はATTACHで解決）"""
+
+    def __init__(self, db_file, datasets=('SAMPLE',)):
+        self.db_file = db_file
+        self.datasets = datasets
+
+    def read(self, query):
+        import pandas as pd
+        conn = sqlite3.connect(self.db_file)
+        try:
+            for dataset in self.datasets:
+                conn.execute('ATTACH DATABASE ? AS {}'.format(dataset), (self.db_file,))
+            return pd.read_sql_query(query, conn)
+        finally:
+            conn.close()
+
+
+def get_backend(backend, project_name=None, credentials=None, db_file=None):
+    """
+    - クエリの実行先を返す
+    (Input)
+    backend:      [ 'bigquery' | 'sqlite' ]
+    project_name: GCP project ID (bigquery)
+    credentials:  GCP credentials (bigquery)
+    db_file:      SQLite database file (sqlite)
+    """
+    if backend == 'bigquery':
+        return BigQueryBackend(project_name, credentials)
+    elif backend == 'sqlite':
+        return SQLiteBackend(db_file)
+    else:
+        raise ValueError('Unknown query backend: {}'.format(backend))
+
+
+def sql_literal(value):
+    """watermarkの値をSQLのリテラルに変換"""
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def build_query(table, column=None, watermark=None, until=None):
+    """watermarkより後（untilを指定した場合はuntil以前）の行だけを取得するクエリを返す（watermarkがない場合は全件）"""
+    query = 'SELECT * FROM {}'.format(table)
+    conditions = []
+    if column is not None and watermark is not None:
+        conditions.append('{} > {}'.format(column, sql_literal(watermark)))
+    if column is not None and until is not None:
+        conditions.append('{} <= {}'.format(column, sql_literal(until)))
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query
+
+
+def build_range_query(table, column, start, end):
+    """columnの日付がstartからendまで（両端を含む）の行を取得するクエリを返す"""
+    return 'SELECT * FROM {} WHERE DATE({}) BETWEEN {} AND {}'.format(
+        table, column, sql_literal(start), sql_literal(end))
+
+
+def watermark_file(output_dir, table):
+    """テーブルごとのwatermarkファイル名"""
+    return os.path.join(output_dir, 'watermark', '{}.json'.format(table))
+
+
+def start_watermark_file(workflow_dir, table):
+    """ワークフローで抽出を始めたときのwatermarkファイル名"""
+    return os.path.join(workflow_dir, 'watermark_start', '{}.json'.format(table))
+
+
+def load_watermark(store, remote_file, column):
+    """watermarkファイルの内容を返す（ない場合・カラムが異なる場合はNone）"""
+    if not store.exists(remote_file):
+        return None
+    watermark = json.loads(store.read_bytes(remote_file).decode('utf-8'))
+    if watermark['column'] != column:
+        return None
+    return watermark
+
+
+def read_watermark(store, output_dir, table, column):
+    """
+    - 保存済みのwatermarkを読み込む（ない場合・カラムが異なる場合はNone）
+    (Input)
+    store:      Shared storage
+    output_dir: Output directory of the pipeline
+    table:      Table name
+    column:     Watermark column
+    """
+    watermark = load_watermark(store, watermark_file(output_dir, table), column)
+    if watermark is None:
+        return None
+    return watermark['value']
+
+
+def read_start_watermark(store, output_dir, workflow_dir, table, column, local_file):
+    """
+    - ワークフローで抽出を始めるwatermarkを返す
+    - 同じワークフローで記録済みであればその値を使い（再実行）、なければ現在のwatermarkを記録してから返す
+    - 後続のステップが失敗してwatermarkだけが進んでいても、再実行で同じ行を取得できる
+    (Input)
+    store:        Shared storage
+    output_dir:   Output directory of the pipeline
+    workflow_dir: Output directory of the workflow step
+    table:        Table name
+    column:       Watermark column
+    local_file:   File name located in the instance
+    """
+    remote_file = start_watermark_file(workflow_dir, table)
+    watermark = load_watermark(store, remote_file, column)
+    if watermark is not None:
+        return watermark['value']
+    value = read_watermark(store, output_dir, table, column)
+    write_watermark(store, local_file, [remote_file], table, column, value)
+    return value
+
+
+def is_delta(store, workflow_dir, table):
+    """ワークフローのデータセットが、前回のwatermarkより後の行だけを抽出したものか"""
+    remote_file = start_watermark_file(workflow_dir, table)
+    if not store.exists(remote_file):
+        return False
+    return json.loads(store.read_bytes(remote_file).decode('utf-8'))['value'] is not None
+
+
+def write_watermark(store, local_file, remote_files, table, column, value):
+    """
+    - watermarkを保存
+    (Input)
+    store:        Shared storage
+    local_file:   File name located in the instance
+    remote_files: GCS file names
+    table:        Table name
+    column:       Watermark column
+    value:        Max value of the column already extracted
+    """
+    # numpyの型はjsonにできないのでPythonの型に変換
+    if hasattr(value, 'item'):
+        value = value.item()
+    elif value is not None and not isinstance(value, (int, float)):
+        value = str(value)
+
+    with open(local_file, 'w') as f:
+        json.dump({'table': table, 'column': column, 'value': value}, f)
+    store.upload_many([(local_file, remote_file) for remote_file in remote_files])
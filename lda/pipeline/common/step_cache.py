@@ -0,0 +1,129 @@
+# coding: utf-8
+"""
+ステップ単位のキャッシュ
+- 入力ファイルのハッシュ・引数・pipeline_version・コードのハッシュからキーを計算する
+- 同じキーで成功した実行があり、その出力が残っていれば、ステップを実行せずに終了できる
+- indexはステップごとにbucketに保存し、最後に使ってから ttl_days 日を過ぎたものと、
+  size 件を超えた古いものを削除する（出力ファイル自体は各日付の成果物なので削除しない）
+"""
+
+import os
+import json
+import glob
+import time
+import hashlib
+from common import handoff
+
+
+CACHE_DIR = 'step_cache'
+
+# 結果に影響しない引数
+IGNORED_ARGS = ['tmp_dir', 'storage_dir', 'step_cache', 'cache_ttl_days', 'cache_size', 'upload_workers']
+
+
+def code_hash(step_file):
+    """ステップのスクリプトと共通モジュール（common）のハッシュを返す"""
+    common_dir = os.path.dirname(os.path.abspath(__file__))
+    files = [os.path.abspath(step_file)] + sorted(glob.glob(os.path.join(common_dir, '*.py')))
+    digest = hashlib.sha256()
+    for path in files:
+        with open(path, 'rb') as f:
+            digest.update(os.path.basename(path).encode('utf-8'))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def index_file(output_dir, step):
+    return os.path.join(output_dir, CACHE_DIR, step, 'index.json')
+
+
+class StepCache(object):
+    """
+    - ステップのキャッシュ
+    (Input)
+    store:      Shared storage
+    output_dir: Output directory of the pipeline
+    step:       Step name
+    tmp_dir:    Temporal directory
+    ttl_days:   Days an entry is kept after its last use
+    size:       Number of entries kept per step
+    """
+
+    def __init__(self, store, output_dir, step, tmp_dir, ttl_days=30, size=20):
+        self.store = store
+        self.output_dir = output_dir
+        self.step = step
+        self.tmp_dir = tmp_dir
+        self.ttl_days = ttl_days
+        self.size = size
+
+    def key(self, args, inputs, step_file):
+        """
+        - キャッシュのキーを返す
+        (Input)
+        args:      Step arguments (including pipeline_version)
+        inputs:    Remote files read by the step
+        step_file: Script file of the step
+        """
+        # 同一プロセスの前のステップのアップロードが終わってからハッシュを取る
+        handoff.flush()
+        params = {k: v for k, v in args.items() if k not in IGNORED_ARGS}
+        payload = {
+            'step': self.step,
+            'args': params,
+            'inputs': {remote_file: self.store.checksum(remote_file) for remote_file in inputs},
+            'code': code_hash(step_file)
+        }
+        data = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def lookup(self, key):
+        """キーに対応する成功済みの実行があり、その出力が全て残っていればTrue"""
+        entries = self._read_index()
+        entry = entries.get(key)
+        if entry is None:
+            return False
+        if not all(self.store.exists(remote_file) for remote_file in entry['outputs']):
+            return False
+        entry['last_used'] = time.time()
+        self._write_index(entries)
+        return True
+
+    def record(self, key, outputs):
+        """
+        - 成功した実行の出力を登録
+        - 同一プロセスでの実行中はアップロードが終わってから登録する
+        """
+        handoff.flush()
+        entries = self._read_index()
+        now = time.time()
+        entries[key] = {'outputs': list(outputs), 'created': now, 'last_used': now}
+        self._write_index(entries)
+
+    def _read_index(self):
+        remote_index = index_file(self.output_dir, self.step)
+        if not self.store.exists(remote_index):
+            return {}
+        return json.loads(self.store.read_bytes(remote_index).decode('utf-8'))
+
+    def _write_index(self, entries):
+        # 期限切れのものと、size件を超えた古いものを削除
+        expire = time.time() - self.ttl_days * 24 * 60 * 60
+        keys = [k for k, entry in entries.items() if entry['last_used'] >= expire]
+        keys = sorted(keys, key=lambda k: entries[k]['last_used'], reverse=True)[:self.size]
+        entries = {k: entries[k] for k in keys}
+
+        local_index = handoff.local_file(self.tmp_dir, 'step_cache_{}.json'.format(self.step))
+        with open(local_index, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        handoff.upload(self.store, local_index, index_file(self.output_dir, self.step), remove=True)
+
+
+def get_cache(store, args, step):
+    """引数に応じたキャッシュを返す（無効の場合はNone）"""
+    if args.get('step_cache', 'on') != 'on':
+        return None
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+    return StepCache(store, args['output'], step, args['tmp_dir'],
+                     ttl_days=args.get('cache_ttl_days', 30), size=args.get('cache_size', 20))
@@ -0,0 +1,281 @@
+# coding: utf-8
+"""
+GCS / ローカルファイルシステム共通のストレージ層
+- clientとbucketはプロセス内で1つだけ生成し、使い回す
+- 複数ファイルのアップロード/ダウンロードはスレッドプールで並列に実行
+- storage_dirを指定するとGCSの代わりにローカルディレクトリを使う（オフラインのベンチマーク用）
+- CSVはblobのバイトストリームから直接パースする（全体をメモリに載せない）
+- 送受信したバイト数をプロセス単位で集計する（transferred）
+"""
+
+import io
+import os
+import shutil
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from common.auth import get_credentials
+
+
+MAX_WORKERS = 8
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+_storages = {}
+_lock = threading.Lock()
+_transferred = {'bytes_uploaded': 0, 'bytes_downloaded': 0}
+
+
+def _count(key, n):
+    with _lock:
+        _transferred[key] += n
+
+
+def transferred():
+    """このプロセスでストレージと送受信したバイト数を返す"""
+    with _lock:
+        return dict(_transferred)
+
+
+class BlobReader(io.RawIOBase):
+    """blobをRange指定で少しずつ読み込むストリーム"""
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.blob.reload()
+        self.size = blob.size or 0
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        end = min(self.pos + len(b), self.size) - 1
+        data = self.blob.download_as_string(start=self.pos, end=end)
+        n = len(data)
+        b[:n] = data
+        self.pos += n
+        _count('bytes_downloaded', n)
+        return n
+
+
+class FileReader(io.FileIO):
+    """読み込んだバイト数を集計するローカルファイル"""
+
+    def readinto(self, b):
+        n = super(FileReader, self).readinto(b)
+        _count('bytes_downloaded', n or 0)
+        return n
+
+    def readall(self):
+        data = super(FileReader, self).readall()
+        _count('bytes_downloaded', len(data))
+        return data
+
+
+class GCSStorage(object):
+    """GCSのbucketを操作する"""
+
+    def __init__(self, project_name, bucket_name, credentials=None, max_workers=MAX_WORKERS):
+        from google.cloud import storage
+        self.project_name = project_name
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.client = storage.Client(project_name, credentials=credentials or get_credentials())
+        self.bucket = self.client.get_bucket(bucket_name)
+
+    def blob_name(self, remote_file):
+        """'gs://<bucket>/'を除いたblob名を返す"""
+        return remote_file.replace('gs://{}/'.format(self.bucket_name), '')
+
+    def upload(self, local_file, remote_file):
+        blob = self.bucket.blob(self.blob_name(remote_file))
+        blob.upload_from_filename(local_file)
+        _count('bytes_uploaded', os.path.getsize(local_file))
+
+    def download(self, local_file, remote_file):
+        blob = self.bucket.blob(self.blob_name(remote_file))
+        blob.download_to_filename(local_file)
+        _count('bytes_downloaded', os.path.getsize(local_file))
+
+    def exists(self, remote_file):
+        return self.bucket.blob(self.blob_name(remote_file)).exists()
+
+    def read_bytes(self, remote_file):
+        data = self.bucket.blob(self.blob_name(remote_file)).download_as_string()
+        _count('bytes_downloaded', len(data))
+        return data
+
+    def delete(self, remote_file):
+        self.bucket.blob(self.blob_name(remote_file)).delete()
+
+    def checksum(self, remote_file):
+        """ファイルの内容のハッシュ（GCSが保持しているmd5）を返す（ない場合はNone）"""
+        blob = self.bucket.get_blob(self.blob_name(remote_file))
+        if blob is None:
+            return None
+        return blob.md5_hash or blob.crc32c
+
+    def open_read(self, remote_file):
+        """バイナリのストリームとして開く"""
+        blob = self.bucket.blob(self.blob_name(remote_file))
+        return io.BufferedReader(BlobReader(blob), buffer_size=READ_BUFFER_SIZE)
+
+    def list_dirs(self, remote_dir):
+        """remote_dir直下のディレクトリ名を返す"""
+        prefix = self.blob_name(remote_dir).rstrip('/') + '/'
+        iterator = self.bucket.list_blobs(prefix=prefix, delimiter='/')
+        # prefixesは全ページを読み込んだ後に揃う
+        for _ in iterator:
+            pass
+        return sorted(name[len(prefix):].rstrip('/') for name in iterator.prefixes)
+
+    def upload_many(self, files):
+        """
+        - 複数ファイルを並列にアップロード
+        (Input)
+        files: (local_file, remote_file) のリスト
+        """
+        self._run_many(self.upload, files)
+
+    def download_many(self, files):
+        """
+        - 複数ファイルを並列にダウンロード
+        (Input)
+        files: (local_file, remote_file) のリスト
+        """
+        self._run_many(self.download, files)
+
+    def _run_many(self, func, files):
+        files = list(files)
+        if len(files) <= 1:
+            for local_file, remote_file in files:
+                func(local_file, remote_file)
+            return
+
+        # 例外は呼び出し元に伝播させる
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(files))) as executor:
+            futures = [executor.submit(func, local_file, remote_file) for local_file, remote_file in files]
+            for future in futures:
+                future.result()
+
+
+class LocalStorage(GCSStorage):
+    """GCSの代わりにローカルディレクトリを使う（gs://<bucket>/<path> -> <root>/<path>）"""
+
+    def __init__(self, root, bucket_name, max_workers=MAX_WORKERS):
+        self.project_name = None
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.root = root
+
+    def path(self, remote_file):
+        """リモートのファイル名に対応するローカルのパスを返す"""
+        return os.path.join(self.root, self.blob_name(remote_file).lstrip('/'))
+
+    def upload(self, local_file, remote_file):
+        path = self.path(remote_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # GCSと同じく、書き込み途中のファイルが他のプロセスから読まれないよう置き換える
+        partial = '{}.{}.partial'.format(path, os.getpid())
+        shutil.copyfile(local_file, partial)
+        os.replace(partial, path)
+        _count('bytes_uploaded', os.path.getsize(path))
+
+    def download(self, local_file, remote_file):
+        shutil.copyfile(self.path(remote_file), local_file)
+        _count('bytes_downloaded', os.path.getsize(local_file))
+
+    def exists(self, remote_file):
+        return os.path.isfile(self.path(remote_file))
+
+    def read_bytes(self, remote_file):
+        with open(self.path(remote_file), 'rb') as f:
+            data = f.read()
+        _count('bytes_downloaded', len(data))
+        return data
+
+    def delete(self, remote_file):
+        os.remove(self.path(remote_file))
+
+    def checksum(self, remote_file):
+        path = self.path(remote_file)
+        if not os.path.isfile(path):
+            return None
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_BUFFER_SIZE), b''):
+                digest.update(block)
+        return base64.b64encode(digest.digest()).decode('ascii')
+
+    def open_read(self, remote_file):
+        return io.BufferedReader(FileReader(self.path(remote_file), 'r'), buffer_size=READ_BUFFER_SIZE)
+
+    def list_dirs(self, remote_dir):
+        path = self.path(remote_dir)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+
+
+def get_storage(project_name, bucket_name, credentials=None, storage_dir=None):
+    """
+    - プロセス内で共有するストレージを返す
+    (Input)
+    project_name: GCS project ID
+    bucket_name:  GCS bucket name
+    credentials:  GCP credentials
+    storage_dir:  GCSの代わりに使うローカルディレクトリ（Noneの場合はGCS）
+    """
+    key = (project_name, bucket_name, storage_dir)
+    with _lock:
+        if key not in _storages:
+            if storage_dir:
+                _storages[key] = LocalStorage(storage_dir, bucket_name)
+            else:
+                _storages[key] = GCSStorage(project_name, bucket_name, credentials)
+        return _storages[key]
+
+
+def read_csv(store, remote_file, cols, chunksize=None, dtype=None):
+    """
+    - ストレージ上のヘッダなしCSVをストリームから直接読み込む
+    - chunksizeを指定した場合はその行数ごとのdataframeを返すイテレータになる
+    (Input)
+    store:       Shared storage
+    remote_file: GCS file name
+    cols:        Column names of dataframe
+    chunksize:   Number of rows per chunk (None: read all rows)
+    dtype:       dtype of each column
+    """
+    import pandas as pd
+    f = store.open_read(remote_file)
+    if chunksize is None:
+        with f:
+            return pd.read_csv(f, names=cols, dtype=dtype)
+
+    return _iter_csv(f, cols, chunksize, dtype)
+
+
+def _iter_csv(f, cols, chunksize, dtype):
+    import pandas as pd
+    with f:
+        for chunk in pd.read_csv(f, names=cols, dtype=dtype, chunksize=chunksize):
+            yield chunk
@@ -0,0 +1,121 @@
+# coding: utf-8
+"""
+ハイパーパラメータ（num_topics / num_pass / chunk_size）のグリッドサーチ
+- 変換済みの文書-単語行列を学習用と評価用に分け、各設定をプロセスプールで並行して学習
+- 評価用データのperplexityと、学習用データのtopic coherence (u_mass) で評価
+"""
+
+import os
+import itertools
+from multiprocessing import Pool
+import numpy as np
+
+
+SWEEP_PARAMS = ['num_topics', 'num_pass', 'chunk_size']
+METRICS = {
+    # 指標名: 大きいほど良いか
+    'perplexity': False,
+    'coherence': True
+}
+
+_shared = {}
+
+
+def parse_grid(spec, defaults):
+    """
+    - 'num_topics=4,6,8;num_pass=10,30' 形式の指定からパラメータの組み合わせを返す
+    - 指定のないパラメータはdefaultsの値を使う
+    """
+    values = {name: [defaults[name]] for name in SWEEP_PARAMS}
+    for item in spec.split(';'):
+        if not item.strip():
+            continue
+        name, candidates = item.split('=')
+        name = name.strip()
+        if name not in SWEEP_PARAMS:
+            raise ValueError('Unknown sweep parameter: {}'.format(name))
+        values[name] = [int(v) for v in candidates.split(',')]
+    return [dict(zip(SWEEP_PARAMS, combination))
+            for combination in itertools.product(*[values[name] for name in SWEEP_PARAMS])]
+
+
+def split_holdout(matrix, holdout_ratio, seed=1):
+    """文書-単語行列の行をランダムに学習用と評価用に分ける"""
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(matrix.shape[0])
+    n_test = int(matrix.shape[0] * holdout_ratio)
+    return matrix[np.sort(order[n_test:])], matrix[np.sort(order[:n_test])]
+
+
+def _init_worker(train_matrix, test_matrix, id2word, dtype):
+    _shared['train'] = train_matrix
+    _shared['test'] = test_matrix
+    _shared['id2word'] = id2word
+    _shared['dtype'] = dtype
+
+
+def _train_one(task):
+    from gensim import models
+    from gensim.models.coherencemodel import CoherenceModel
+    from common.encoder import to_corpus
+
+    params, model_file = task
+    train_corpus = to_corpus(_shared['train'])
+    test_corpus = to_corpus(_shared['test']) if _shared['test'].shape[0] > 0 else train_corpus
+
+    # プールのワーカーは子プロセスを作れないので、LdaMulticoreではなくLdaModelで学習
+    lda = models.LdaModel(
+        corpus=train_corpus,
+        id2word=_shared['id2word'],
+        num_topics=params['num_topics'],
+        chunksize=params['chunk_size'],
+        passes=params['num_pass'],
+        minimum_probability=0.,
+        random_state=1,
+        dtype=_shared['dtype']
+    )
+    lda.save(model_file)
+
+    perplexity = np.exp2(-lda.log_perplexity(list(test_corpus)))
+    coherence = CoherenceModel(model=lda, corpus=train_corpus, dictionary=_shared['id2word'],
+                               coherence='u_mass').get_coherence()
+
+    result = dict(params)
+    result.update({'perplexity': float(perplexity), 'coherence': float(coherence), 'model_file': model_file})
+    return result
+
+
+def run_sweep(matrix, id2word, grid, tmp_dir, processes=1, holdout_ratio=0.1, metric='perplexity', seed=1,
+              dtype=np.float32):
+    """
+    - グリッドの各設定で学習・評価し、良い順に並べた結果を返す
+    (Input)
+    matrix:        Document-term matrix (CSR)
+    id2word:       Dictionary
+    grid:          List of parameter dicts returned by parse_grid
+    tmp_dir:       Directory where the models are saved
+    processes:     Number of worker processes
+    holdout_ratio: Ratio of documents held out for the perplexity
+    metric:        Metric used for ranking [ 'perplexity' | 'coherence' ]
+    seed:          Random seed of the holdout split
+    dtype:         dtype of the model arrays
+    """
+    train_matrix, test_matrix = split_holdout(matrix, holdout_ratio, seed)
+
+    sweep_dir = os.path.join(tmp_dir, 'sweep')
+    if not os.path.isdir(sweep_dir):
+        os.mkdir(sweep_dir)
+    tasks = [(params, os.path.join(sweep_dir, 'model{}'.format(i))) for i, params in enumerate(grid)]
+
+    pool = Pool(min(processes, len(tasks)), initializer=_init_worker,
+                initargs=(train_matrix, test_matrix, id2word, dtype))
+    try:
+        results = pool.map(_train_one, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    results.sort(key=lambda r: r[metric], reverse=METRICS[metric])
+    for rank, result in enumerate(results):
+        result['rank'] = rank + 1
+    return results
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+preprocess -> train -> postprocess (-> visualize) を1つのプロセスで実行する（ローカル実行・バックフィル用）
+- 各ステップのmainを順に呼び出し、dataframe・モデルはメモリ上で受け渡す
+- 各ステップの成果物は従来どおり保存する（アップロードはバックグラウンドで実行）
+- num_shardsを指定すると、モデルのリセットをshardごとのプロセスでデータ並列に学習する
+"""
+
+import os
+import sys
+import shlex
+import argparse
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), step)
+                for step in ['preprocess', 'train', 'postprocess', 'visualize']]
+
+from common import handoff
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--project',
+        help='GCP project ID',
+        required=True
+    )
+    parser.add_argument(
+        '--bucket',
+        help='GCS bucket name',
+        required=True
+    )
+    parser.add_argument(
+        '--table',
+        help='Table name',
+        required=True
+    )
+    parser.add_argument(
+        '--prev_date',
+        help='Previous date (used for loading the model)',
+        default=''
+    )
+    parser.add_argument(
+        '--date',
+        help='Date',
+        default=''
+    )
+    parser.add_argument(
+        '--learning_type',
+        help='Reset or update the model [ "reset" | "update" ]',
+        default='update'
+    )
+    parser.add_argument(
+        '--pipeline_version',
+        help='Pipeline version',
+        default='fused'
+    )
+    parser.add_argument(
+        '--tmp_dir',
+        help='Directory for temporal files',
+        required=True
+    )
+    parser.add_argument(
+        '--output',
+        help='Output directory',
+        required=True
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS (for offline benchmarks)'
+    )
+    parser.add_argument(
+        '--step_cache',
+        help='Skip train / postprocess / visualize when they already succeeded with the same inputs [ "on" | "off" ]',
+        default='on'
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--preprocess_args',
+        help='Extra arguments passed to preprocess.py (e.g. "--extract_mode incremental")',
+        default=''
+    )
+    parser.add_argument(
+        '--train_args',
+        help='Extra arguments passed to train.py (e.g. "--corpus_mode stream")',
+        default=''
+    )
+    parser.add_argument(
+        '--postprocess_args',
+        help='Extra arguments passed to postprocess.py (e.g. "--load_mode append")',
+        default=''
+    )
+    parser.add_argument(
+        '--visualize_args',
+        help='Extra arguments passed to visualize.py (e.g. "--sample_size 5000")',
+        default=''
+    )
+    parser.add_argument(
+        '--num_shards',
+        help='Number of processes of the data-parallel reset (1: train in this process)',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--skip_visualize',
+        help='Do not build the pyLDAvis report',
+        action='store_true'
+    )
+
+    args = parser.parse_args()
+    return args.__dict__
+
+
+def step_arguments(module, argv):
+    """各ステップのparse_argumentsでargvを解釈し、ステップの引数を返す"""
+    sys_argv = sys.argv
+    try:
+        sys.argv = [module.__file__] + argv
+        return module.parse_arguments()
+    finally:
+        sys.argv = sys_argv
+
+
+def build_argv(options, extra):
+    argv = []
+    for key, value in options:
+        if value is not None:
+            argv.extend(['--' + key, value])
+    return argv + shlex.split(extra)
+
+
+def run_shard(argv):
+    """shardのE-stepを実行（spawnで起動するので、メモリ上での受け渡しは無効の状態で始まる）"""
+    import train
+    train.main(step_arguments(train, argv))
+
+
+def train_distributed(train, argv, num_shards):
+    """
+    - train.pyの分散学習（kfpではParallelFor）をnum_shards個のプロセスで実行
+    - 最初にこのプロセスでデータセットをshardごとのコーパスに分けておく
+    - passごとに全shardのE-stepを並行して実行し、このプロセスのreducerでM-stepを行う
+    """
+    import multiprocessing
+
+    train_args = step_arguments(train, argv)
+    options = ['--num_shards', str(num_shards)]
+    train.main(step_arguments(train, argv + options + ['--dist_role', 'split']))
+    with multiprocessing.get_context('spawn').Pool(num_shards) as pool:
+        for pass_no in range(train_args['num_pass']):
+            # shardは別プロセスなので、前のpassのモデルのアップロードを待ってから始める
+            handoff.flush()
+            pass_options = options + ['--pass_no', str(pass_no)]
+            pool.map(run_shard, [
+                argv + pass_options + ['--dist_role', 'shard', '--shard', str(shard),
+                                       '--tmp_dir', os.path.join(train_args['tmp_dir'], 'shard_{}'.format(shard))]
+                for shard in range(num_shards)
+            ])
+            train.main(step_arguments(train, argv + pass_options + ['--dist_role', 'reduce']))
+
+
+def main(args):
+    """3つのステップを順に実行"""
+    import preprocess
+    import train
+    import postprocess
+    import visualize
+
+    common_options = [
+        ('project', args['project']),
+        ('bucket', args['bucket']),
+        ('date', args['date']),
+        ('tmp_dir', args['tmp_dir']),
+        ('output', args['output']),
+        ('storage_dir', args.get('storage_dir')),
+        ('artifact_format', args['artifact_format'])
+    ]
+
+    handoff.enable()
+    try:
+        preprocess_args = step_arguments(preprocess, build_argv(common_options, args['preprocess_args']))
+        preprocess.main(preprocess_args)
+
+        date = preprocess_args['date']
+        common_options[2] = ('date', date)
+        train_argv = build_argv(common_options + [
+            ('preprocess_output', os.path.join(args['output'], 'workflow_' + date, 'preprocess')),
+            ('table', args['table']),
+            ('prev_date', args['prev_date']),
+            ('learning_type', args['learning_type']),
+            ('pipeline_version', args['pipeline_version']),
+            ('step_cache', args['step_cache'])
+        ], args['train_args'])
+        if args['num_shards'] > 1:
+            train_distributed(train, train_argv, args['num_shards'])
+        else:
+            train.main(step_arguments(train, train_argv))
+
+        postprocess_args = step_arguments(postprocess, build_argv(common_options + [
+            ('training_output', os.path.join(args['output'], 'workflow_' + date, 'train')),
+            ('table', args['table']),
+            ('step_cache', args['step_cache'])
+        ], args['postprocess_args']))
+        postprocess.main(postprocess_args)
+
+        if not args['skip_visualize']:
+            visualize_args = step_arguments(visualize, build_argv(common_options + [
+                ('training_output', os.path.join(args['output'], 'workflow_' + date, 'train')),
+                ('table', args['table']),
+                ('step_cache', args['step_cache'])
+            ], args['visualize_args']))
+            visualize.main(visualize_args)
+    finally:
+        # 成果物のアップロードの完了を待つ
+        handoff.disable()
+
+    print('Pipeline done.')
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
@@ -4,19 +4,11 @@
 import os
 import argparse
 from datetime import datetime, date, timedelta
-from io import StringIO
-import pandas as pd
-import pandas_gbq
-from google.cloud import storage
-from google.oauth2 import service_account
-
-
-"""認証キーを読み込み"""
-credentials = service_account.Credentials.from_service_account_info(
-    {
-        """使用するGCPプロジェクトの認証キー情報を入れる"""
-    },
-)
+from common import handoff, metrics
+from common.storage import get_storage
+from common.step_cache import get_cache
+from common.artifacts import artifact_file, read_frame, result_columns, read_num_topics, SCHEMA_FILE
+from common.bqload import get_sink, write_parts
 
 
 def get_prev_date(days):
@@ -54,6 +46,52 @@ def parse_arguments():
         help='Date',
         required=True
     )
+    parser.add_argument(
+        '--load_mode',
+        help='Append rows to the table or replace the date partition, by a single load job [ "append" | "partition" ]',
+        default='partition'
+    )
+    parser.add_argument(
+        '--sink_dir',
+        help='Local directory used instead of BigQuery'
+    )
+    parser.add_argument(
+        '--tmp_dir',
+        help='Directory for temporal files',
+        default='/tmp'
+    )
+    parser.add_argument(
+        '--chunk_rows',
+        help='Number of rows read from the result file at once',
+        type=int,
+        default=100000
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--step_cache',
+        help='Skip the step when the same inputs, arguments and code already succeeded [ "on" | "off" ]',
+        default='on'
+    )
+    parser.add_argument(
+        '--cache_ttl_days',
+        help='Days a step cache entry is kept after its last use',
+        type=int,
+        default=30
+    )
+    parser.add_argument(
+        '--cache_size',
+        help='Number of step cache entries kept per step',
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS (for offline benchmarks)'
+    )
     parser.add_argument(
         '--output',
         help='Output directory',
@@ -72,64 +110,72 @@ def parse_arguments():
     return params
 
 
-def read_gcs(project_name, bucket_name, gcs_csv, cols):
-    """
-    - GCS上のテキストファイルを読み込み, pandas dataframeで返す
-    (Input)
-    project_name: GCS project ID
-    bucket_name:  GCS bucket name
-    gcs_csv:      GCS file name
-    cols:         Column names of dataframe
-    """
-    client = storage.Client(project_name, credentials=credentials)
-    bucket = client.get_bucket(bucket_name)
-
-    # CSVを取得
-    blob = storage.Blob(gcs_csv.replace('gs://{}/'.format(bucket_name), ''), bucket)
-    content = blob.download_as_string()
-    s = str(content, 'utf-8')
-    data = StringIO(s)
-
-    df = pd.read_csv(data, names=cols)
-
-    return df
+def write_output(output_dir):
+    """出力先と計測値をkfpに渡す"""
+    try:
+        with open('/output.txt', 'w') as f:
+            f.write(output_dir)
+    except:
+        pass
+    metrics.write()
 
 
 def main(args):
     """LDAの結果をBigQueryのテーブルにアップロード"""
+    metrics.start('postprocess')
+    store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
+    gcs_file = os.path.join(args['training_output'], artifact_file(args['table'], args['artifact_format']))
+
+    # 保存先
+    OUTPUT_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'postprocess')
+
+    # 同じ結果をロード済みであれば省略
+    cache = get_cache(store, args, 'postprocess')
+    if cache is not None:
+        cache_key = cache.key(args, [gcs_file, os.path.join(args['training_output'], SCHEMA_FILE)], __file__)
+        if cache.lookup(cache_key):
+            print('Step cache hit ({}), skipping the upload.'.format(cache_key[:12]))
+            metrics.add('step_cache_hit', 1)
+            write_output(OUTPUT_DIR)
+            return
 
     # GCSからダウンロードして読み込み
     print('Downloading results from GCS....')
-    gcs_csv = os.path.join(args['training_output'], '{}.csv'.format(args['table']))
-    cols = [
-        'date', 'id', 
-        'name0', 'name1', 'name2', 'name3', 
-        'topic0', 'topic1', 'topic2', 'topic3', 'topic4', 'topic5',
-        'execution_time', 'pipeline_version'
-    ]
-    df = read_gcs(args['project'], args['bucket'], gcs_csv, cols).astype({
-        'date': 'object', 'id': 'object',
-        'name0': 'object', 'name1': 'object', 'name2': 'object', 'name3': 'object', 
-        'topic0': 'float32', 'topic1': 'float32', 'topic2': 'float32', 
-        'topic3': 'float32', 'topic4': 'float32', 'topic5': 'float32',
-        'execution_time': 'object', 'pipeline_version': 'object'
-    })
-
-    # テーブルに追加
+    num_topics = read_num_topics(store, args['training_output'])
+    cols = result_columns(num_topics)
+    dtype = {col: 'float32' if col.startswith('topic') else 'object' for col in cols}
+    df = handoff.get_frame(gcs_file, cols)
+    if df is not None:
+        # 同一プロセスのtrainから受け取った結果を使う
+        df = df.astype(dtype)
+        chunks = (df.iloc[i:i + args['chunk_rows']] for i in range(0, len(df), args['chunk_rows']))
+    else:
+        chunks = read_frame(store, gcs_file, cols, args['artifact_format'], chunksize=args['chunk_rows'], dtype=dtype)
+
     print('Uploading results to BigQuery....')
     destination_table = 'WORK.{}'.format(args['table'])
-    pandas_gbq.to_gbq(df, destination_table, args['project'], if_exists='append', credentials=credentials)
 
-    # 保存先
-    OUTPUT_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'postprocess')
-    
-    # output
-    try:
-        with open('/output.txt', 'w') as f:
-            f.write(OUTPUT_DIR)
-    except:
-        pass
+    # chunkごとにファイルへ書き出し、1つのロードジョブでロード
+    # （partition: 日付パーティションを置き換え、append: テーブルに追加）
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+    with metrics.span('stage'):
+        local_files = write_parts(chunks, args['tmp_dir'], prefix=args['table'])
+    sink = get_sink(args['project'], store, os.path.join(OUTPUT_DIR, 'load'), sink_dir=args.get('sink_dir'))
+    with metrics.span('load'):
+        if args['load_mode'] == 'partition':
+            rows = sink.load_partition(destination_table, args['date'], local_files, cols)
+        else:
+            rows = sink.load_append(destination_table, local_files, cols)
+    print('{} rows loaded into {} ({})'.format(rows, destination_table, args['date']))
+    metrics.add('rows_processed', rows)
+
+    # 成功した実行を登録
+    if cache is not None:
+        cache.record(cache_key, [])
 
+    # output
+    write_output(OUTPUT_DIR)
 
     print('Postprocessing done.')
 
@@ -4,18 +4,12 @@
 import os
 import argparse
 from datetime import datetime, date, timedelta
-import pandas as pd
-import pandas_gbq
-from google.cloud import storage
-from google.oauth2 import service_account
-
-
-"""認証キーを読み込み"""
-credentials = service_account.Credentials.from_service_account_info(
-    {
-        """使用するGCPプロジェクトの認証キー情報を入れる"""
-    },
-)
+from common import handoff, metrics
+from common.storage import get_storage
+from common.artifacts import artifact_file, write_frame
+from common.dict_cache import content_hash, has_cache, write_hash
+from common.query import NAMES_TABLE, DATASET_TABLE, DATASET_COLUMNS, get_backend, build_query, watermark_file, \
+    load_watermark, read_start_watermark, write_watermark
 
 
 def get_prev_date(days):
@@ -58,6 +52,40 @@ def parse_arguments():
         help='Temporal directory',
         required=True
     )
+    parser.add_argument(
+        '--extract_mode',
+        help='Extract the whole dataset or only rows past the watermark [ "full" | "incremental" ]',
+        default='full'
+    )
+    parser.add_argument(
+        '--watermark_column',
+        help='Column of the dataset table used as the watermark (date/partition column or id, not saved in the dataset)',
+        default='id'
+    )
+    parser.add_argument(
+        '--query_backend',
+        help='Where the queries are run [ "bigquery" | "sqlite" ]',
+        default='bigquery'
+    )
+    parser.add_argument(
+        '--sqlite_db',
+        help='SQLite database file used instead of BigQuery (query_backend=sqlite)'
+    )
+    parser.add_argument(
+        '--dict_cache_size',
+        help='Number of dictionary versions kept in the cache (0: disable the cache)',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS (for offline benchmarks)'
+    )
     parser.add_argument(
         '--output',
         help='Output directory',
@@ -76,68 +104,114 @@ def parse_arguments():
     return params
 
 
-def load_gcs(project_name, bucket_name, local_file, gcs_file, mode):
-    """
-    - インスタンス上のファイルをGCSにアップロード/ダウンロード
-    (Input)
-    project_name: GCS project ID
-    bucket_name:  GCS bucket name
-    local_file:   File name located in the instance
-    gcs_file:     GCS file name
-    mode:         [ 'upload' | 'download' ]
-    """
-    client = storage.Client(project_name, credentials=credentials)
-    bucket = client.get_bucket(bucket_name)
-    
-    # ファイルをアップロード/ダウンロード
-    blob = bucket.blob(gcs_file.replace('gs://{}/'.format(bucket_name), ''))
-    if mode == 'upload':
-        blob.upload_from_filename(local_file)
-    elif mode == 'download':
-        blob.download_to_filename(local_file)
+def save_names(store, df, args, output_dir):
+    """ワードのマスターデータとそのハッシュを保存"""
+    # ファイル名の指定
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+    dict_file = artifact_file(args['dict_file'], args['artifact_format'])
+    local_file = os.path.join(args['tmp_dir'], dict_file)
+    gcs_file = os.path.join(output_dir, dict_file)
+
+    # マスターデータのハッシュを記録（trainはキャッシュ済みのdictionaryがあれば、ファイルを読み込まずにそれを使う）
+    digest = content_hash(df)
+    write_hash(store, os.path.join(args['tmp_dir'], 'dict_hash.txt'), output_dir, digest)
+    if args['dict_cache_size'] > 0 and has_cache(store, args['output'], digest):
+        print('Dictionary is cached ({})'.format(digest[:12]))
+
+    # キャッシュは古いものから削除されるので、ファイルは常に保存してGCSにアップロード
+    with metrics.span('upload'):
+        write_frame(df, local_file, args['artifact_format'])
+        handoff.put(gcs_file, df)
+        handoff.upload(store, local_file, gcs_file)
+
+
+def save_dataset(store, df, args, output_dir):
+    """データセットを保存（parquetの場合、デッキ内容のカラムは辞書エンコードする）"""
+    # ディレクトリの指定
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+    dataset_file = artifact_file(args['dataset_file'], args['artifact_format'])
+    local_file = os.path.join(args['tmp_dir'], dataset_file)
+    gcs_file = os.path.join(output_dir, dataset_file)
+
+    # ファイルを保存
+    if args['artifact_format'] == 'parquet':
+        df = df.astype({col: 'category' for col in df.columns[1:]})
+    with metrics.span('upload'):
+        write_frame(df, local_file, args['artifact_format'])
+
+        # GCSにアップロード
+        handoff.put(gcs_file, df)
+        handoff.upload(store, local_file, gcs_file)
+    return df
 
 
 def main(args):
     """dictionaryを読込"""
     print('Loading dictionary data from BigQuery....')
+    metrics.start('preprocess')
+    store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
+    backend = get_backend(args['query_backend'], args['project'], db_file=args.get('sqlite_db'))
 
     # BigQueryから引っ張ってくる
-    query = """SELECT * FROM SAMPLE.NAMES"""
-    df = pandas_gbq.read_gbq(query, project_id=args['project'], dialect='standard', credentials=credentials)
+    query = build_query(NAMES_TABLE)
+    with metrics.span('query'):
+        df = backend.read(query)
+    metrics.add('dictionary_rows', len(df))
 
     # 保存先の指定
     OUTPUT_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'preprocess')
-
-    # ファイル名の指定
-    if not os.path.isdir(args['tmp_dir']):
-        os.mkdir(args['tmp_dir'])
-    local_file = os.path.join(args['tmp_dir'], args['dict_file'] + '.csv')
-    gcs_file = os.path.join(OUTPUT_DIR, args['dict_file'] + '.csv')
-
-    # csvを保存
-    df.to_csv(local_file, header=False, index=False)
-
-    # GCSにアップロード
-    load_gcs(args['project'], args['bucket'], local_file, gcs_file, 'upload')
+    save_names(store, df, args, OUTPUT_DIR)
 
     """データセットを読込"""
     print('Loading dataset from BigQuery....')
 
-    # BigQueryから引っ張ってくる
-    query = """SELECT * FROM SAMPLE.DUMMY"""
-    df = pandas_gbq.read_gbq(query, args['project'], dialect='standard', credentials=credentials)
-
-    # ディレクトリの指定
-    if not os.path.isdir(args['tmp_dir']):
-        os.mkdir(args['tmp_dir'])
-    local_file = os.path.join(args['tmp_dir'], args['dataset_file'] + '.csv')
-    gcs_file = os.path.join(OUTPUT_DIR, args['dataset_file'] + '.csv')
-
-    # csvを保存
-    df.to_csv(local_file, header=False, index=False)
-    
-    # GCSにアップロード
-    load_gcs(args['project'], args['bucket'], local_file, gcs_file, 'upload')
+    # BigQueryから引っ張ってくる（incrementalの場合は前回のwatermarkより後の行だけ）
+    # 同じ日付の再実行では、最初の実行で抽出した範囲の行を取得し直す
+    # （後続のステップが失敗してwatermarkだけが進んでいても、その日の行は失われない）
+    watermark = None
+    extracted = None
+    if args['extract_mode'] == 'incremental':
+        if not os.path.isdir(args['tmp_dir']):
+            os.mkdir(args['tmp_dir'])
+        watermark = read_start_watermark(store, args['output'], OUTPUT_DIR, DATASET_TABLE, args['watermark_column'],
+                                         os.path.join(args['tmp_dir'], 'watermark_start.json'))
+        extracted = load_watermark(store, os.path.join(OUTPUT_DIR, 'watermark.json'), args['watermark_column'])
+        print('Watermark of {}: {}'.format(DATASET_TABLE, watermark))
+    until = extracted['value'] if extracted is not None else None
+    query = build_query(DATASET_TABLE, args['watermark_column'], watermark, until)
+    with metrics.span('query'):
+        df = backend.read(query)
+    metrics.add('rows_processed', len(df))
+
+    # 取得した最大値はparquet用にcategoryへ変換する前に求める（順序のないcategoryではmaxを取れない）
+    # 日付などのwatermarkのカラムはtrainが読み込むカラムではないので、データセットには保存しない
+    latest = None
+    if args['extract_mode'] == 'incremental':
+        if len(df) > 0:
+            latest = df[args['watermark_column']].max()
+        if args['watermark_column'] not in DATASET_COLUMNS:
+            df = df.drop(args['watermark_column'], axis=1)
+
+    # ファイルを保存してGCSにアップロード
+    df = save_dataset(store, df, args, OUTPUT_DIR)
+
+    # watermarkを更新（ワークフローの出力にも残す）
+    # 再実行の場合は、既に先の日付で進んでいる可能性があるので更新しない
+    if args['extract_mode'] == 'incremental':
+        print('{} rows extracted from {}'.format(len(df), DATASET_TABLE))
+        if extracted is not None:
+            print('Re-extracted the rows up to {} of the first run'.format(until))
+        elif latest is not None:
+            watermark = latest
+        if (extracted is None) and (watermark is not None):
+            local_file = os.path.join(args['tmp_dir'], 'watermark.json')
+            remote_files = [
+                watermark_file(args['output'], DATASET_TABLE),
+                os.path.join(OUTPUT_DIR, 'watermark.json')
+            ]
+            write_watermark(store, local_file, remote_files, DATASET_TABLE, args['watermark_column'], watermark)
 
     # output
     try:
@@ -145,6 +219,7 @@ def main(args):
             f.write(OUTPUT_DIR)
     except:
         pass
+    metrics.write()
 
     print('Preprocessing done.')
 
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+デッキのトピック分布をHTTPで返すスコアリングサーバ
+- 最新の workflow_<date>/model のチェックポイントを1回だけ読み込み（読み込み専用でmemory-map）、
+  モデルが持つdictionary（学習時のDictionary）で単語IDに変換して推論する
+- 結果は正規化したデッキ（ワードを並べ替えたもの）ごとに、上限つきのLRUに保持する
+- reload_interval秒ごとに新しい workflow_<date>/model を探し、見つかればモデルを入れ替える
+- /stats でレイテンシのp50/p99とキャッシュのヒット率を返す
+
+(API)
+POST /score   {"deck": {"hero0": ..., "hero3": ...}} -> {"workflow": ..., "topics": [...]}
+              {"decks": [{...}, ...]}                 -> {"workflow": ..., "topics": [[...], ...]}
+              （デッキはワードのリストでもよい）
+GET  /stats   レイテンシ・キャッシュ・モデルの情報
+GET  /healthz モデルを読み込み済みであれば200
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict, deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import warnings
+warnings.filterwarnings('ignore')
+from common import metrics
+from common.storage import get_storage
+from common.checkpoint import CHECKPOINT_FILE, load_model
+from common.encoder import build_lookup, encode_decks, to_corpus
+from common.inference import infer_topics
+
+
+DECK_COLS = ['hero0', 'hero1', 'hero2', 'hero3']
+WORKFLOW_PATTERN = re.compile(r'^workflow_(\d{4}-\d{2}-\d{2})$')
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--project',
+        help='GCP project ID',
+        required=True
+    )
+    parser.add_argument(
+        '--bucket',
+        help='GCS bucket name',
+        required=True
+    )
+    parser.add_argument(
+        '--output',
+        help='Output directory of the pipeline (containing workflow_<date>/model)',
+        required=True
+    )
+    parser.add_argument(
+        '--tmp_dir',
+        help='Directory for the downloaded checkpoints',
+        default='/tmp'
+    )
+    parser.add_argument(
+        '--host',
+        help='Address to listen on',
+        default='0.0.0.0'
+    )
+    parser.add_argument(
+        '--port',
+        help='Port to listen on',
+        type=int,
+        default=8080
+    )
+    parser.add_argument(
+        '--cache_size',
+        help='Number of decks whose topic distribution is kept in the LRU cache (0: disable the cache)',
+        type=int,
+        default=100000
+    )
+    parser.add_argument(
+        '--reload_interval',
+        help='Seconds between checks for a newer model (0: never reload)',
+        type=int,
+        default=60
+    )
+    parser.add_argument(
+        '--latency_window',
+        help='Number of recent requests used for the latency percentiles',
+        type=int,
+        default=10000
+    )
+    parser.add_argument(
+        '--chunk_size',
+        help='Number of decks inferred at once in a batched request',
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS (for local runs)'
+    )
+
+    args = parser.parse_args()
+    return args.__dict__
+
+
+def find_latest_model(store, output):
+    """チェックポイントが揃っている最新の workflow_<date> を返す（ない場合はNone）"""
+    workflows = [name for name in store.list_dirs(output) if WORKFLOW_PATTERN.match(name)]
+    for workflow in sorted(workflows, reverse=True):
+        if store.exists(os.path.join(output, workflow, 'model', CHECKPOINT_FILE)):
+            return workflow
+    return None
+
+
+class LRUCache(object):
+    """上限つきのLRU（スレッドセーフ）"""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class LatencyStats(object):
+    """直近window件のリクエストのレイテンシ"""
+
+    def __init__(self, window):
+        self.count = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.count += 1
+
+    def percentiles(self):
+        """p50/p99（ミリ秒）を返す"""
+        import numpy as np
+        with self._lock:
+            latencies = np.array(self._latencies)
+        if len(latencies) == 0:
+            return {'p50_ms': None, 'p99_ms': None}
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        return {'p50_ms': round(float(p50), 3), 'p99_ms': round(float(p99), 3)}
+
+
+class TopicScorer(object):
+    """
+    - 最新のモデルでデッキのトピック分布を返す
+    (Input)
+    store:      Shared storage
+    output:     Output directory of the pipeline
+    tmp_dir:    Directory for the downloaded checkpoints
+    cache_size: Number of decks kept in the LRU cache
+    chunk_size: Number of decks inferred at once
+    """
+
+    def __init__(self, store, output, tmp_dir, cache_size=100000, chunk_size=1000):
+        self.store = store
+        self.output = output
+        self.tmp_dir = tmp_dir
+        self.chunk_size = chunk_size
+        self.cache = LRUCache(cache_size)
+        self.workflow = None
+        self._model = None
+        self._local_file = None
+        self._lock = threading.Lock()
+
+    def reload(self):
+        """新しいモデルがあれば読み込んで入れ替え、入れ替えた場合はTrueを返す"""
+        workflow = find_latest_model(self.store, self.output)
+        if workflow is None or workflow == self.workflow:
+            return False
+
+        # 処理中のリクエストが前のモデルを使い終わるまで、前のアーカイブは別名で残す
+        local_name = '{}_{}'.format(workflow, CHECKPOINT_FILE)
+        lda = load_model(self.store, os.path.join(self.output, workflow, 'model'), self.tmp_dir,
+                         mmap='r', local_name=local_name)
+        model = (workflow, lda, build_lookup(lda.id2word))
+        with self._lock:
+            prev_file = self._local_file
+            self._model = model
+            self.workflow = workflow
+            self._local_file = os.path.join(self.tmp_dir, local_name)
+            self.cache.clear()
+
+        # memory-map済みの配列はファイルを削除しても読める
+        if prev_file is not None and os.path.isfile(prev_file):
+            os.remove(prev_file)
+        metrics.log('reload', workflow=workflow, num_topics=lda.num_topics)
+        return True
+
+    def is_ready(self):
+        return self._model is not None
+
+    def score(self, decks):
+        """
+        - デッキのリストのトピック分布を返す
+        - キャッシュにないデッキだけをまとめて推論する
+        (Input)
+        decks: List of decks (lists of words)
+        """
+        import pandas as pd
+
+        workflow, lda, lookup = self._model
+        keys = [tuple(sorted(deck)) for deck in decks]
+        results = [self.cache.get((workflow, key)) for key in keys]
+
+        # 同じリクエスト内の重複も1回だけ推論
+        missing = list(OrderedDict.fromkeys(key for key, result in zip(keys, results) if result is None))
+        if missing:
+            data_deck = pd.DataFrame(list(missing), columns=DECK_COLS)
+            topic_prob = infer_topics(lda, to_corpus(encode_decks(data_deck, lookup, unknown='error')),
+                                      chunk_docs=self.chunk_size)
+            inferred = {key: [round(float(p), 6) for p in prob] for key, prob in zip(missing, topic_prob)}
+            for key, result in inferred.items():
+                self.cache.put((workflow, key), result)
+            results = [inferred[key] if result is None else result for key, result in zip(keys, results)]
+        return workflow, results
+
+
+def parse_deck(deck):
+    """{"hero0": ..} またはワードのリストをワードのリストにする"""
+    if isinstance(deck, dict):
+        deck = [deck.get(col) for col in DECK_COLS]
+    if not isinstance(deck, list) or len(deck) != len(DECK_COLS) or \
+            not all(isinstance(word, str) for word in deck):
+        raise ValueError('A deck needs {} words'.format(len(DECK_COLS)))
+    return deck
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """スコアリングのHTTPハンドラ（scorer・latencyはサーバの属性を使う）"""
+
+    def log_message(self, format, *args):
+        # アクセスログは出さない（レイテンシは/statsで確認する）
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        scorer = self.server.scorer
+        if self.path == '/healthz':
+            if scorer.is_ready():
+                self._send(200, {'status': 'ok', 'workflow': scorer.workflow})
+            else:
+                self._send(503, {'status': 'loading'})
+        elif self.path == '/stats':
+            stats = OrderedDict([('workflow', scorer.workflow), ('requests', self.server.latency.count)])
+            stats.update(self.server.latency.percentiles())
+            stats.update([('cache_entries', len(scorer.cache)), ('cache_hits', scorer.cache.hits),
+                          ('cache_misses', scorer.cache.misses)])
+            self._send(200, stats)
+        else:
+            self._send(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._send(404, {'error': 'Not found'})
+            return
+        if not self.server.scorer.is_ready():
+            self._send(503, {'error': 'No model has been loaded yet'})
+            return
+
+        begin = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('The request body must be a JSON object')
+            if 'decks' in request:
+                if not isinstance(request['decks'], list):
+                    raise ValueError('"decks" must be a list')
+                decks = [parse_deck(deck) for deck in request['decks']]
+            else:
+                decks = [parse_deck(request.get('deck'))]
+            workflow, results = self.server.scorer.score(decks)
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+        topics = results if 'decks' in request else results[0]
+        self._send(200, {'workflow': workflow, 'topics': topics})
+        self.server.latency.record(time.time() - begin)
+
+
+class ScoringServer(socketserver.ThreadingMixIn, HTTPServer):
+    """リクエストごとにスレッドで処理するHTTPサーバ"""
+    daemon_threads = True
+
+    def __init__(self, address, scorer, latency):
+        HTTPServer.__init__(self, address, ScoringHandler)
+        self.scorer = scorer
+        self.latency = latency
+
+
+def watch(scorer, latency, interval, stop):
+    """interval秒ごとに新しいモデルを確認し、レイテンシを構造化ログに出す"""
+    while not stop.wait(interval):
+        try:
+            scorer.reload()
+        except Exception as e:
+            # 読み込みに失敗しても前のモデルで処理を続ける
+            metrics.log('reload_failed', error=str(e))
+        metrics.log('latency', requests=latency.count, cache_entries=len(scorer.cache), **latency.percentiles())
+
+
+def main(args):
+    """スコアリングサーバを起動"""
+    metrics.start('serve')
+    store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+
+    scorer = TopicScorer(store, args['output'], args['tmp_dir'],
+                         cache_size=args['cache_size'], chunk_size=args['chunk_size'])
+    latency = LatencyStats(args['latency_window'])
+    print('Loading the model....')
+    if not scorer.reload():
+        print('No model found in {}, waiting for a training run.'.format(args['output']))
+
+    stop = threading.Event()
+    if args['reload_interval'] > 0:
+        threading.Thread(target=watch, args=(scorer, latency, args['reload_interval'], stop), daemon=True).start()
+
+    server = ScoringServer((args['host'], args['port']), scorer, latency)
+    print('Serving on {}:{}....'.format(args['host'], args['port']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+    print('Serving done.')
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
@@ -0,0 +1,105 @@
+# coding: utf-8
+"""
+テスト共通のfixture
+- GCS・BigQueryの代わりにLocalStorage・LocalSink・SQLiteを使う
+- 各ステップのスクリプトは、Dockerイメージと同じくディレクトリをsys.pathに追加してimportする
+"""
+
+import os
+import sys
+import sqlite3
+import itertools
+import pytest
+
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [PIPELINE_DIR] + [os.path.join(PIPELINE_DIR, step) for step in ['preprocess', 'train', 'postprocess', 'serve']]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+NAMES = ['hero{:02d}'.format(i) for i in range(12)]
+OUTPUT = 'gs://bucket/out'
+PREPROCESS_OUTPUT = OUTPUT + '/workflow_2020-01-01/preprocess'
+
+
+@pytest.fixture
+def store(tmp_path):
+    from common.storage import LocalStorage
+    return LocalStorage(str(tmp_path / 'gcs'), 'bucket')
+
+
+@pytest.fixture
+def tmp_dir(tmp_path):
+    path = tmp_path / 'tmp'
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def dictionary():
+    from gensim import corpora
+    return corpora.Dictionary([[name] for name in NAMES])
+
+
+@pytest.fixture
+def decks():
+    """重複したデッキを含むデータセット"""
+    import pandas as pd
+    rows = [list(names) for names in itertools.islice(itertools.combinations(NAMES, 4), 0, 400, 10)]
+    rows += rows[:20]
+    df = pd.DataFrame(rows, columns=['hero0', 'hero1', 'hero2', 'hero3'])
+    df.insert(0, 'id', range(len(df)))
+    return df
+
+
+@pytest.fixture
+def lda(dictionary, decks):
+    from gensim import models
+    from common.encoder import build_lookup, encode_decks, to_corpus
+    corpus = to_corpus(encode_decks(decks.drop('id', axis=1), build_lookup(dictionary)))
+    return models.LdaModel(corpus=corpus, id2word=dictionary, num_topics=3, passes=2,
+                           minimum_probability=0., random_state=1)
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, decks):
+    """SAMPLE.NAMES / SAMPLE.DUMMY を持つSQLiteファイル"""
+    import pandas as pd
+    db_file = str(tmp_path / 'bq.db')
+    conn = sqlite3.connect(db_file)
+    pd.DataFrame({'name': NAMES}).to_sql('NAMES', conn, index=False)
+    decks.to_sql('DUMMY', conn, index=False)
+    conn.close()
+    return db_file
+
+
+@pytest.fixture
+def write_inputs(store, tmp_dir):
+    """preprocessの出力（dictionaryとデータセット）をストレージに保存する"""
+    def write(decks, fmt='csv', preprocess_output=PREPROCESS_OUTPUT, row_group_size=None):
+        import pandas as pd
+        from common.artifacts import artifact_file, write_frame
+        for name, df in [('dict', pd.DataFrame({'name': NAMES})), ('dataset', decks)]:
+            local_file = os.path.join(tmp_dir, artifact_file(name, fmt))
+            write_frame(df, local_file, fmt, row_group_size=row_group_size)
+            store.upload(local_file, os.path.join(preprocess_output, artifact_file(name, fmt)))
+        return preprocess_output
+    return write
+
+
+@pytest.fixture
+def train_args(store, tmp_path, monkeypatch):
+    """train.parse_argumentsで解釈した引数（overridesはコマンドラインの引数として渡す）"""
+    def parse(**overrides):
+        import train
+        argv = {
+            'preprocess_output': PREPROCESS_OUTPUT, 'project': 'project', 'bucket': 'bucket',
+            'table': 'TOPIC_RESULT', 'date': '2020-01-01', 'tmp_dir': str(tmp_path / 'train'),
+            'learning_type': 'reset', 'num_topics': 3, 'num_pass': 2, 'chunk_size': 16, 'workers': 1,
+            'storage_dir': store.root, 'output': OUTPUT, 'step_cache': 'off', 'pipeline_version': 'v1'
+        }
+        argv.update(overrides)
+        flags = [arg for k, v in argv.items() if v is not None
+                 for arg in (['--' + k] if v is True else ['--' + k, str(v)])]
+        monkeypatch.setattr(sys, 'argv', ['train.py'] + flags)
+        return train.parse_arguments()
+    return parse
@@ -0,0 +1,69 @@
+# coding: utf-8
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from common.artifacts import artifact_file, write_frame, read_frame, read_num_topics, write_schema
+
+import train
+
+COLS = ['id', 'hero0', 'hero1', 'hero2', 'hero3']
+
+
+def upload_frame(store, tmp_dir, df, fmt, **kwargs):
+    name = artifact_file('dataset', fmt)
+    local_file = os.path.join(tmp_dir, name)
+    write_frame(df, local_file, fmt, **kwargs)
+    store.upload(local_file, 'gs://bucket/out/' + name)
+    return 'gs://bucket/out/' + name
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet'])
+def test_round_trip(store, tmp_dir, decks, fmt):
+    remote_file = upload_frame(store, tmp_dir, decks, fmt)
+    df = read_frame(store, remote_file, COLS, fmt)
+    assert df.columns.tolist() == COLS
+    assert df.astype({col: str for col in COLS[1:]}).values.tolist() == decks.values.tolist()
+
+
+def test_parquet_keeps_types(store, tmp_dir, decks):
+    df = decks.astype({col: 'category' for col in COLS[1:]})
+    df['topic0'] = np.linspace(0, 1, len(df), dtype=np.float32)
+    remote_file = upload_frame(store, tmp_dir, df, 'parquet')
+    loaded = read_frame(store, remote_file, COLS + ['topic0'], 'parquet')
+    assert loaded['topic0'].dtype == np.float32
+    assert str(loaded['hero0'].dtype) == 'category'
+    np.testing.assert_array_equal(loaded['topic0'].values, df['topic0'].values)
+
+
+def test_parquet_chunks_split_row_groups(store, tmp_dir, decks):
+    remote_file = upload_frame(store, tmp_dir, decks, 'parquet', row_group_size=25)
+    chunks = list(read_frame(store, remote_file, COLS, 'parquet', chunksize=10))
+    # row groupは25, 25, 10行で、chunksizeより大きいものは分割する
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5, 10, 10, 5, 10]
+    assert pd.concat(chunks)['id'].tolist() == decks['id'].tolist()
+
+
+def test_unknown_format(store, tmp_dir, decks):
+    with pytest.raises(ValueError):
+        write_frame(decks, os.path.join(tmp_dir, 'dataset.txt'), 'txt')
+    with pytest.raises(ValueError):
+        read_frame(store, 'gs://bucket/out/dataset.txt', COLS, 'txt')
+
+
+def test_schema(store, tmp_dir):
+    assert read_num_topics(store, 'gs://bucket/out/train') == 6
+    write_schema(store, tmp_dir, 'gs://bucket/out/train', 8)
+    assert read_num_topics(store, 'gs://bucket/out/train') == 8
+
+
+def test_train_reads_parquet_dataset(dictionary, decks, write_inputs, train_args):
+    write_inputs(decks, fmt='csv')
+    _, data_uid, corpus = train.get_deck(dictionary, train_args(artifact_format='csv'))
+    write_inputs(decks.astype({col: 'category' for col in COLS[1:]}), fmt='parquet')
+    _, parquet_uid, parquet_corpus = train.get_deck(dictionary, train_args(artifact_format='parquet'))
+
+    assert parquet_uid.tolist() == data_uid.tolist()
+    assert [sorted(doc) for doc in parquet_corpus] == [sorted(doc) for doc in corpus]
@@ -0,0 +1,71 @@
+# coding: utf-8
+
+import os
+import glob
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import NAMES, OUTPUT
+from common import handoff
+from common.checkpoint import load_model
+
+import backfill
+
+
+@pytest.fixture
+def gap_db(tmp_path, decks):
+    """1/1と1/3にだけ行があるSAMPLE.DUMMY（1/2は行がない）"""
+    db_file = str(tmp_path / 'gap.db')
+    conn = sqlite3.connect(db_file)
+    pd.DataFrame({'name': NAMES}).to_sql('NAMES', conn, index=False)
+    df = decks.copy()
+    df['date'] = ['2020-01-01' if i % 2 == 0 else '2020-01-03' for i in range(len(df))]
+    df.to_sql('DUMMY', conn, index=False)
+    conn.close()
+    return db_file
+
+
+def run_backfill(store, tmp_path, db_file, **kwargs):
+    args = {
+        'project': 'project', 'bucket': 'bucket', 'table': 'TOPIC_RESULT', 'prev_date': '',
+        'start_date': '2020-01-01', 'end_date': '2020-01-03', 'date_column': 'date', 'pipeline_version': 'backfill',
+        'tmp_dir': str(tmp_path / 'backfill'), 'output': OUTPUT, 'storage_dir': store.root, 'step_cache': 'off',
+        'artifact_format': 'csv', 'load_mode': 'partition', 'sink_dir': str(tmp_path / 'bq'),
+        'preprocess_args': '--query_backend sqlite --sqlite_db {}'.format(db_file),
+        'train_args': '--num_topics 3 --num_pass 2 --chunk_size 16 --workers 1',
+        'postprocess_args': '', 'visualize_args': '', 'skip_visualize': True
+    }
+    args.update(kwargs)
+    os.makedirs(args['tmp_dir'])
+    backfill.main(args)
+
+
+def test_split_days(decks):
+    df = decks.copy()
+    df['date'] = ['2020-01-01 10:00:00', '2020-01-02 23:59:59'] * (len(df) // 2)
+    days = backfill.split_days(df, 'date')
+    assert sorted(days) == ['2020-01-01', '2020-01-02']
+    assert days['2020-01-01'].columns.tolist() == decks.columns.tolist()
+    assert len(days['2020-01-01']) + len(days['2020-01-02']) == len(decks)
+
+
+def test_backfill_carries_forward_empty_days(store, tmp_path, gap_db, decks):
+    run_backfill(store, tmp_path, gap_db)
+    assert not handoff.is_enabled()
+
+    # 行のない日は前日のモデルをそのまま保存する
+    first = load_model(store, OUTPUT + '/workflow_2020-01-01/model', str(tmp_path))
+    carried = load_model(store, OUTPUT + '/workflow_2020-01-02/model', str(tmp_path), local_name='carried.ckpt')
+    np.testing.assert_array_equal(carried.expElogbeta, first.expElogbeta)
+    assert not store.exists(OUTPUT + '/workflow_2020-01-02/train/TOPIC_RESULT.csv')
+
+    # 翌日は引き継いだモデルを更新する
+    last = load_model(store, OUTPUT + '/workflow_2020-01-03/model', str(tmp_path), local_name='last.ckpt')
+    assert last.state.numdocs == first.state.numdocs + len(decks) // 2
+    assert not np.array_equal(last.expElogbeta, first.expElogbeta)
+
+    # 結果は行のある日だけロードする
+    partitions = sorted(os.path.basename(path) for path in glob.glob(str(tmp_path / 'bq' / 'WORK.TOPIC_RESULT' / '*')))
+    assert partitions == ['20200101', '20200103']
@@ -0,0 +1,99 @@
+# coding: utf-8
+
+import os
+import glob
+import pandas as pd
+import pytest
+
+from common.bqload import LocalSink, write_parts, get_sink
+from common.artifacts import write_frame, write_schema, result_columns
+
+import postprocess
+from common import metrics
+
+
+@pytest.fixture
+def result(decks):
+    """TOPIC_RESULTと同じカラムの結果"""
+    df = pd.DataFrame({'date': '2020-01-01', 'id': decks['id']})
+    for i in range(4):
+        df['name{}'.format(i)] = decks['hero{}'.format(i)]
+    for i in range(3):
+        df['topic{}'.format(i)] = 1. / 3
+    df['execution_time'] = '2020-01-01 00:00:00'
+    df['pipeline_version'] = 'v1'
+    return df[result_columns(3)]
+
+
+def read_rows(files):
+    return sum(len(pd.read_csv(f, header=None)) for f in files)
+
+
+def test_write_parts(result, tmp_dir):
+    chunks = (result.iloc[i:i + 25] for i in range(0, len(result), 25))
+    local_files = write_parts(chunks, tmp_dir, prefix='TOPIC_RESULT')
+    assert [os.path.basename(f) for f in local_files] == \
+        ['TOPIC_RESULT-00000.csv', 'TOPIC_RESULT-00001.csv', 'TOPIC_RESULT-00002.csv']
+    assert read_rows(local_files) == len(result)
+
+
+def test_get_sink(store, tmp_path):
+    assert isinstance(get_sink('project', store, 'gs://bucket/load', sink_dir=str(tmp_path)), LocalSink)
+
+
+def test_load_partition_replaces(result, tmp_path, tmp_dir):
+    sink = LocalSink(str(tmp_path / 'bq'))
+    cols = result_columns(3)
+    local_files = write_parts([result.iloc[:30], result.iloc[30:]], tmp_dir)
+    assert sink.load_partition('WORK.TOPIC_RESULT', '2020-01-01', local_files, cols) == len(result)
+
+    # 再実行しても行は重複しない
+    local_files = write_parts([result.iloc[:10]], tmp_dir, prefix='rerun')
+    assert sink.load_partition('WORK.TOPIC_RESULT', '2020-01-01', local_files, cols) == 10
+    files = glob.glob(os.path.join(sink.partition_dir('WORK.TOPIC_RESULT', '2020-01-01'), '*'))
+    assert read_rows(files) == 10
+    assert os.listdir(str(tmp_path / 'bq' / 'WORK.TOPIC_RESULT')) == ['20200101']
+
+
+def test_load_append(result, tmp_path, tmp_dir):
+    sink = LocalSink(str(tmp_path / 'bq'))
+    local_files = write_parts([result.iloc[:30], result.iloc[30:]], tmp_dir)
+    assert sink.load_append('WORK.TOPIC_RESULT', local_files, result_columns(3)) == len(result)
+
+    # 1回のロードは1つのファイルになる
+    files = glob.glob(str(tmp_path / 'bq' / 'WORK.TOPIC_RESULT' / 'append' / '*'))
+    assert len(files) == 1 and files[0].endswith('.csv')
+    assert read_rows(files) == len(result)
+
+
+def test_postprocess_rerun_loads_partition_once(result, store, tmp_path, tmp_dir):
+    training_output = 'gs://bucket/out/workflow_2020-01-01/train'
+    local_file = os.path.join(tmp_dir, 'TOPIC_RESULT.csv')
+    write_frame(result, local_file, 'csv')
+    store.upload(local_file, os.path.join(training_output, 'TOPIC_RESULT.csv'))
+    write_schema(store, tmp_dir, training_output, 3)
+
+    args = {
+        'project': 'project', 'bucket': 'bucket', 'storage_dir': store.root, 'output': 'gs://bucket/out',
+        'training_output': training_output, 'table': 'TOPIC_RESULT', 'date': '2020-01-01', 'chunk_rows': 25,
+        'tmp_dir': tmp_dir, 'load_mode': 'partition', 'sink_dir': str(tmp_path / 'bq'), 'artifact_format': 'csv',
+        'step_cache': 'off'
+    }
+    postprocess.main(args)
+    postprocess.main(args)
+
+    # ファイルへの書き出しはダウンロードとは別に計測する
+    assert set(metrics.summary()['spans']) >= {'stage', 'load'}
+
+    sink = LocalSink(str(tmp_path / 'bq'))
+    files = glob.glob(os.path.join(sink.partition_dir('WORK.TOPIC_RESULT', '2020-01-01'), '*'))
+    df = pd.concat([pd.read_csv(f, header=None) for f in files])
+    assert len(df) == len(result)
+    assert sorted(df[1].tolist()) == sorted(result['id'].tolist())
+
+
+def test_postprocess_replaces_partition_by_default(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['postprocess.py', '--training_output', 'gs://bucket/out/train',
+                                     '--project', 'project', '--bucket', 'bucket', '--table', 'TOPIC_RESULT',
+                                     '--date', '2020-01-01', '--output', 'gs://bucket/out'])
+    assert postprocess.parse_arguments()['load_mode'] == 'partition'
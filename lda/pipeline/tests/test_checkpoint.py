@@ -0,0 +1,69 @@
+# coding: utf-8
+
+import os
+import tarfile
+import numpy as np
+import pytest
+
+from common.checkpoint import (CHECKPOINT_FILE, save_checkpoint, load_checkpoint, verify_checkpoint, read_manifest,
+                               save_model, load_model, cast_model)
+
+
+@pytest.mark.parametrize('mmap', ['r', 'c', None])
+def test_round_trip(lda, tmp_dir, mmap):
+    archive_file = os.path.join(tmp_dir, CHECKPOINT_FILE)
+    save_checkpoint(lda, archive_file, tmp_dir)
+    loaded = load_checkpoint(archive_file, mmap=mmap)
+
+    assert loaded.num_topics == lda.num_topics
+    assert dict(loaded.id2word.token2id) == dict(lda.id2word.token2id)
+    np.testing.assert_array_equal(loaded.expElogbeta, lda.expElogbeta)
+    np.testing.assert_array_equal(loaded.state.sstats, lda.state.sstats)
+    if mmap is not None:
+        assert isinstance(loaded.expElogbeta, np.memmap)
+
+
+def test_manifest_and_checksums(lda, tmp_dir):
+    archive_file = os.path.join(tmp_dir, CHECKPOINT_FILE)
+    save_checkpoint(lda, archive_file, tmp_dir)
+    manifest = read_manifest(archive_file)
+    assert manifest['num_topics'] == lda.num_topics
+    verify_checkpoint(archive_file)
+
+
+def test_corrupted_member_is_detected(lda, tmp_dir):
+    archive_file = os.path.join(tmp_dir, CHECKPOINT_FILE)
+    save_checkpoint(lda, archive_file, tmp_dir)
+
+    # 配列の先頭のバイトを書き換える
+    with tarfile.open(archive_file, 'r') as tar:
+        info = [info for info in tar.getmembers() if info.name.endswith('expElogbeta.npy')][0]
+    with open(archive_file, 'r+b') as f:
+        f.seek(info.offset_data + info.size - 1)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([last[0] ^ 0xff]))
+
+    with pytest.raises(ValueError):
+        verify_checkpoint(archive_file)
+
+
+def test_save_and_load_through_storage(lda, store, tmp_dir):
+    save_model(store, lda, 'gs://bucket/out/workflow_2020-01-01/model', tmp_dir)
+    loaded = load_model(store, 'gs://bucket/out/workflow_2020-01-01/model', tmp_dir)
+    np.testing.assert_array_equal(loaded.expElogbeta, lda.expElogbeta)
+
+def test_cast_model(lda, tmp_dir):
+    archive_file = os.path.join(tmp_dir, CHECKPOINT_FILE)
+    lda = cast_model(lda, 'float64')
+    save_checkpoint(lda, archive_file, tmp_dir)
+    loaded = load_checkpoint(archive_file, mmap='c')
+
+    # 同じ型であればmemory-mapしたまま
+    assert cast_model(loaded, 'float64') is loaded
+    assert isinstance(loaded.expElogbeta, np.memmap)
+
+    cast_model(loaded, 'float32')
+    for array in [loaded.expElogbeta, loaded.eta, loaded.alpha, loaded.state.sstats, loaded.state.eta]:
+        assert array.dtype == np.float32
+    np.testing.assert_allclose(loaded.expElogbeta, lda.expElogbeta, rtol=1e-6)
@@ -0,0 +1,46 @@
+# coding: utf-8
+
+import os
+import numpy as np
+
+from common.corpus import MmapCorpus
+from common.encoder import build_lookup, encode_decks, to_corpus
+
+import train
+
+
+def test_serialize_round_trip(dictionary, decks, tmp_dir):
+    docs = list(to_corpus(encode_decks(decks.drop('id', axis=1), build_lookup(dictionary))))
+    corpus = MmapCorpus.serialize(os.path.join(tmp_dir, 'corpus'), docs, chunk_docs=7)
+
+    assert len(corpus) == len(docs)
+    assert [sorted(doc) for doc in corpus] == [sorted(doc) for doc in docs]
+    assert sorted(corpus[5]) == sorted(docs[5])
+    assert isinstance(corpus.data, np.memmap)
+
+
+def test_serialize_csr_matches_serialize(dictionary, decks, tmp_dir):
+    lookup = build_lookup(dictionary)
+    data_deck = decks.drop('id', axis=1)
+    matrices = [encode_decks(data_deck.iloc[i:i + 16], lookup) for i in range(0, len(data_deck), 16)]
+    corpus = MmapCorpus.serialize_csr(os.path.join(tmp_dir, 'csr'), matrices, chunk_docs=5)
+    expected = MmapCorpus.serialize(os.path.join(tmp_dir, 'docs'), to_corpus(encode_decks(data_deck, lookup)))
+    assert list(corpus) == list(expected)
+
+
+def test_empty_corpus(tmp_dir):
+    corpus = MmapCorpus.serialize(os.path.join(tmp_dir, 'corpus'), [])
+    assert len(corpus) == 0
+    assert list(corpus) == []
+
+
+def test_stream_mode_keeps_only_ids(store, dictionary, decks, write_inputs, train_args):
+    write_inputs(decks)
+    data_deck, data_uid, corpus = train.get_deck(dictionary, train_args(corpus_mode='memory'))
+    stream_deck, stream_uid, stream_corpus = train.get_deck(dictionary, train_args(corpus_mode='stream', chunk_rows=7))
+
+    assert stream_deck is None
+    assert isinstance(stream_corpus, MmapCorpus)
+    assert stream_uid.tolist() == data_uid.tolist() == decks['id'].tolist()
+    assert [sorted((int(i), float(n)) for i, n in doc) for doc in stream_corpus] == \
+        [sorted((int(i), float(n)) for i, n in doc) for doc in corpus]
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import os
+import json
+import pandas as pd
+import pytest
+
+from common.dict_cache import (HASH_FILE, content_hash, cache_file, index_file, has_cache, read_hash, write_hash,
+                               load_dictionary, save_dictionary)
+
+import train
+
+OUTPUT = 'gs://bucket/out'
+
+
+def test_content_hash():
+    df = pd.DataFrame({'name': ['a', 'b']})
+    assert content_hash(df) == content_hash(df.copy())
+    assert content_hash(df) != content_hash(pd.DataFrame({'name': ['b', 'a']}))
+
+
+def test_hash_file(store, tmp_dir):
+    assert read_hash(store, OUTPUT + '/preprocess') is None
+    write_hash(store, os.path.join(tmp_dir, HASH_FILE), OUTPUT + '/preprocess', 'abc')
+    assert read_hash(store, OUTPUT + '/preprocess') == 'abc'
+
+
+def test_hit(store, tmp_dir, dictionary):
+    assert load_dictionary(store, OUTPUT, 'd1', tmp_dir) is None
+    save_dictionary(store, OUTPUT, 'd1', dictionary, tmp_dir)
+    assert has_cache(store, OUTPUT, 'd1')
+    assert load_dictionary(store, OUTPUT, 'd1', tmp_dir).token2id == dictionary.token2id
+
+
+def test_eviction_keeps_recently_used(store, tmp_dir, dictionary):
+    for digest in ['d1', 'd2', 'd3']:
+        save_dictionary(store, OUTPUT, digest, dictionary, tmp_dir, keep=3)
+
+    # d1を使うと最近使ったものになり、次の保存ではd2が削除される
+    load_dictionary(store, OUTPUT, 'd1', tmp_dir)
+    assert save_dictionary(store, OUTPUT, 'd4', dictionary, tmp_dir, keep=3) == ['d3', 'd1', 'd4']
+    assert not has_cache(store, OUTPUT, 'd2')
+    assert all(has_cache(store, OUTPUT, digest) for digest in ['d1', 'd3', 'd4'])
+    assert json.loads(store.read_bytes(index_file(OUTPUT)).decode('utf-8')) == ['d3', 'd1', 'd4']
+
+
+def test_train_uses_cached_dictionary(store, tmp_dir, decks, dictionary, write_inputs, train_args):
+    preprocess_output = write_inputs(decks)
+    write_hash(store, os.path.join(tmp_dir, HASH_FILE), preprocess_output, 'd1')
+
+    # キャッシュがなければマスターデータから生成して保存する
+    dict_word = train.get_dict(train_args())
+    assert dict_word.token2id == dictionary.token2id
+    assert has_cache(store, OUTPUT, 'd1')
+
+    # キャッシュがあればマスターデータを読み込まない
+    store.delete(os.path.join(preprocess_output, 'dict.csv'))
+    assert train.get_dict(train_args()).token2id == dictionary.token2id
+
+    # キャッシュを無効にした場合はマスターデータを読み込む
+    with pytest.raises((IOError, OSError)):
+        train.get_dict(train_args(dict_cache_size=0))
+
+
+def test_preprocess_writes_dict_on_hit(store, tmp_dir, dictionary):
+    import preprocess
+    from conftest import NAMES
+    df = pd.DataFrame({'name': NAMES})
+    save_dictionary(store, OUTPUT, content_hash(df), dictionary, tmp_dir)
+
+    # キャッシュは古いものから削除されるので、ヒットしてもマスターデータは保存する
+    args = {'tmp_dir': tmp_dir, 'dict_file': 'dict', 'artifact_format': 'csv', 'dict_cache_size': 2, 'output': OUTPUT}
+    preprocess.save_names(store, df, args, OUTPUT + '/preprocess')
+    assert read_hash(store, OUTPUT + '/preprocess') == content_hash(df)
+    assert store.exists(OUTPUT + '/preprocess/dict.csv')
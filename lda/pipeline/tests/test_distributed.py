@@ -0,0 +1,94 @@
+# coding: utf-8
+
+import os
+import numpy as np
+import pytest
+
+from conftest import OUTPUT
+from common import distributed
+from common.corpus import MmapCorpus
+from common.checkpoint import load_model
+from common.encoder import build_lookup, encode_decks, to_corpus
+
+MODEL_DIR = OUTPUT + '/workflow_2020-01-01/model'
+
+
+@pytest.mark.parametrize('batch_rows', [1, 7, 16, 100])
+def test_assigned_rows_cover_every_row_once(batch_rows):
+    rows, block_size, num_shards = 60, 16, 3
+    owners = np.full(rows, -1)
+    for shard in range(num_shards):
+        for offset in range(0, rows, batch_rows):
+            size = min(batch_rows, rows - offset)
+            for start, stop in distributed.assigned_rows(offset, size, block_size, shard, num_shards):
+                assert (owners[offset + start:offset + stop] == -1).all()
+                owners[offset + start:offset + stop] = shard
+    # micro-batchの大きさによらず、block単位でshardに振り分けられる
+    np.testing.assert_array_equal(owners, (np.arange(rows) // block_size) % num_shards)
+
+
+def test_next_pass():
+    assert distributed.next_pass(0, 3) == '1'
+    assert distributed.next_pass(2, 3) == distributed.LAST_PASS
+
+
+def run_distributed(train_args, num_shards, num_pass):
+    """split・各passのshardとreducerを、kfpと同じ順に1つずつ実行"""
+    import train
+    options = {'num_shards': num_shards, 'num_pass': num_pass}
+    train.main(train_args(dist_role='split', **options))
+    for pass_no in range(num_pass):
+        for shard in range(num_shards):
+            args = train_args(dist_role='shard', shard=shard, pass_no=pass_no, **options)
+            args['tmp_dir'] = os.path.join(args['tmp_dir'], 'shard_{}'.format(shard))
+            train.main(args)
+        train.main(train_args(dist_role='reduce', pass_no=pass_no, **options))
+
+
+def batch_model(dictionary, decks, num_pass):
+    """同じ初期値・chunk・pass数でgensimのバッチ学習（passごとに1回M-step）を行ったモデル"""
+    from gensim import models
+    corpus = to_corpus(encode_decks(decks.drop('id', axis=1), build_lookup(dictionary)))
+    return models.LdaModel(corpus=corpus, id2word=dictionary, num_topics=3, chunksize=16, passes=num_pass,
+                           update_every=0, eval_every=None, minimum_probability=0., random_state=1)
+
+
+def test_split_writes_each_shard_once(store, decks, write_inputs, train_args):
+    import train
+    write_inputs(decks)
+    args = train_args(dist_role='split', num_shards=3, chunk_rows=7)
+    train.main(args)
+
+    remote_dir = distributed.shard_dir(OUTPUT, '2020-01-01')
+    sizes = []
+    for shard in range(3):
+        prefix = os.path.join(store.path(remote_dir), distributed.shard_prefix(shard))
+        corpus = MmapCorpus(prefix)
+        sizes.append(len(corpus))
+        # 担当するblockの行だけを持つ
+        rows = [row for row in range(len(decks)) if (row // 16) % 3 == shard]
+        expected = encode_decks(decks.iloc[rows].drop('id', axis=1), build_lookup(train.get_dict(args)))
+        np.testing.assert_array_equal(np.asarray(corpus.indptr), expected.indptr)
+    assert sum(sizes) == len(decks)
+
+
+def test_single_shard_pass_matches_batch_training(store, dictionary, decks, write_inputs, train_args):
+    write_inputs(decks)
+    run_distributed(train_args, num_shards=1, num_pass=1)
+    lda = load_model(store, MODEL_DIR, store.root)
+
+    expected = batch_model(dictionary, decks, num_pass=1)
+    assert lda.state.numdocs == expected.state.numdocs == len(decks)
+    np.testing.assert_allclose(lda.get_topics(), expected.get_topics(), rtol=1e-5)
+
+
+def test_shards_agree_with_batch_training(store, dictionary, decks, write_inputs, train_args):
+    write_inputs(decks)
+    run_distributed(train_args, num_shards=3, num_pass=3)
+    lda = load_model(store, MODEL_DIR, store.root)
+
+    # E-stepのgammaの初期値は乱数なので、shardに分けると乱数の順序の分だけずれる
+    expected = batch_model(dictionary, decks, num_pass=3)
+    assert lda.state.numdocs == expected.state.numdocs
+    np.testing.assert_allclose(lda.get_topics(), expected.get_topics(), atol=0.05)
+    assert os.path.exists(store.path(OUTPUT + '/workflow_2020-01-01/train/TOPIC_RESULT.csv'))
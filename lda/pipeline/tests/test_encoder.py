@@ -0,0 +1,36 @@
+# coding: utf-8
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from common.encoder import build_lookup, encode_decks, to_corpus, as_matrix
+
+
+def test_encode_matches_doc2bow(dictionary, decks):
+    data_deck = decks.drop('id', axis=1)
+    corpus = list(to_corpus(encode_decks(data_deck, build_lookup(dictionary))))
+    expected = [sorted(dictionary.doc2bow(row)) for row in data_deck.values.tolist()]
+    assert [sorted((int(i), float(n)) for i, n in doc) for doc in corpus] == expected
+
+
+def test_repeated_words_are_counted(dictionary):
+    data_deck = pd.DataFrame([['hero01', 'hero01', 'hero02', 'hero01']], columns=['hero0', 'hero1', 'hero2', 'hero3'])
+    matrix = encode_decks(data_deck, build_lookup(dictionary))
+    assert matrix[0, dictionary.token2id['hero01']] == 3
+    assert matrix[0, dictionary.token2id['hero02']] == 1
+    assert matrix.nnz == 2
+
+
+def test_unknown_words(dictionary):
+    data_deck = pd.DataFrame([['hero01', 'unknown', None, 'hero02']], columns=['hero0', 'hero1', 'hero2', 'hero3'])
+    lookup = build_lookup(dictionary)
+    assert encode_decks(data_deck, lookup).sum() == 2
+    with pytest.raises(ValueError):
+        encode_decks(data_deck, lookup, unknown='error')
+
+
+def test_as_matrix_round_trip(dictionary, decks):
+    matrix = encode_decks(decks.drop('id', axis=1), build_lookup(dictionary))
+    again = as_matrix(list(to_corpus(matrix)), len(dictionary))
+    np.testing.assert_array_equal(again.toarray(), matrix.toarray())
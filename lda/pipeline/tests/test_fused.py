@@ -0,0 +1,95 @@
+# coding: utf-8
+
+import os
+import glob
+import pandas as pd
+import pytest
+
+from common import handoff
+
+import fused
+import train
+
+
+@pytest.fixture
+def sharing():
+    handoff.enable()
+    yield
+    handoff.disable()
+
+
+def test_disabled_handoff_keeps_nothing(store, tmp_dir, decks):
+    handoff.put('gs://bucket/out/dataset.csv', decks)
+    assert handoff.get('gs://bucket/out/dataset.csv') is None
+
+    # アップロードはその場で実行する
+    local_file = os.path.join(tmp_dir, 'a.txt')
+    with open(local_file, 'w') as f:
+        f.write('a')
+    handoff.upload(store, local_file, 'gs://bucket/out/a.txt')
+    assert store.exists('gs://bucket/out/a.txt')
+
+
+def test_handoff_frames(sharing, decks):
+    handoff.put('gs://bucket/out/workflow_2020-01-01/preprocess/dataset.csv', decks)
+    df = handoff.get_frame('gs://bucket/out/workflow_2020-01-01/preprocess/dataset.csv', ['a', 'b', 'c', 'd', 'e'])
+    assert df.columns.tolist() == ['a', 'b', 'c', 'd', 'e']
+    # 登録したdataframeのカラム名は変わらない
+    assert decks.columns.tolist() == ['id', 'hero0', 'hero1', 'hero2', 'hero3']
+
+    handoff.discard('gs://bucket/out/workflow_2020-01-01/')
+    assert handoff.get('gs://bucket/out/workflow_2020-01-01/preprocess/dataset.csv') is None
+
+
+def test_uploads_finish_at_flush(sharing, store, tmp_dir):
+    local_file = os.path.join(tmp_dir, 'a.txt')
+    with open(local_file, 'w') as f:
+        f.write('a')
+    handoff.upload(store, local_file, 'gs://bucket/out/a.txt')
+    handoff.flush()
+    assert store.exists('gs://bucket/out/a.txt')
+
+    # 失敗したアップロードはflushで例外になる
+    handoff.upload(store, os.path.join(tmp_dir, 'missing.txt'), 'gs://bucket/out/b.txt')
+    with pytest.raises((IOError, OSError)):
+        handoff.flush()
+
+
+def test_train_reads_handed_off_dataset(sharing, store, dictionary, decks, train_args):
+    # ストレージにファイルがなくても、登録済みのdataframeを使う
+    handoff.put('gs://bucket/out/workflow_2020-01-01/preprocess/dataset.csv', decks)
+    _, data_uid, corpus = train.get_deck(dictionary, train_args())
+    assert data_uid.tolist() == decks['id'].tolist()
+    assert len(corpus) == len(decks)
+
+
+def run_fused(store, tmp_path, sqlite_db, **kwargs):
+    args = {
+        'project': 'project', 'bucket': 'bucket', 'table': 'TOPIC_RESULT', 'prev_date': '', 'date': '2020-01-01',
+        'learning_type': 'reset', 'pipeline_version': 'fused', 'tmp_dir': str(tmp_path / 'fused'),
+        'output': 'gs://bucket/out', 'storage_dir': store.root, 'step_cache': 'off', 'artifact_format': 'csv',
+        'preprocess_args': '--query_backend sqlite --sqlite_db {}'.format(sqlite_db),
+        'train_args': '--num_topics 3 --num_pass 2 --chunk_size 16 --workers 1',
+        'postprocess_args': '--sink_dir {}'.format(tmp_path / 'bq'),
+        'visualize_args': '', 'num_shards': 1, 'skip_visualize': True
+    }
+    args.update(kwargs)
+    fused.main(args)
+
+
+def test_fused_pipeline(store, tmp_path, sqlite_db, decks):
+    default_params = dict(train.DEFAULT_PARAMS)
+    run_fused(store, tmp_path, sqlite_db)
+
+    # 各ステップの成果物は従来どおり保存する
+    for name in ['preprocess/dataset.csv', 'preprocess/dict.csv', 'model/model.ckpt', 'train/TOPIC_RESULT.csv',
+                 'train/schema.json']:
+        assert store.exists('gs://bucket/out/workflow_2020-01-01/' + name), name
+    assert not handoff.is_enabled()
+    assert train.DEFAULT_PARAMS == default_params
+
+    files = glob.glob(str(tmp_path / 'bq' / 'WORK.TOPIC_RESULT' / '20200101' / '*'))
+    df = pd.concat([pd.read_csv(f, header=None) for f in files])
+    assert sorted(df[1].tolist()) == decks['id'].tolist()
+    # トピック分布の合計は1
+    assert ((df.iloc[:, 6:9].sum(axis=1) - 1).abs() < 1e-4).all()
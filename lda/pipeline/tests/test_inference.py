@@ -0,0 +1,77 @@
+# coding: utf-8
+
+import numpy as np
+
+from common.corpus import MmapCorpus
+from common.encoder import build_lookup, encode_decks, to_corpus
+from common.inference import infer_topics, infer_topics_dedup, dedup_matrix
+
+
+def test_dedup_matrix(dictionary, decks):
+    matrix = encode_decks(decks.drop('id', axis=1), build_lookup(dictionary))
+    unique_rows, inverse = dedup_matrix(matrix)
+    assert unique_rows.shape == (40, len(dictionary))
+    assert len(inverse) == len(decks)
+    np.testing.assert_array_equal(unique_rows[inverse].toarray(), matrix.toarray())
+
+
+def test_dedup_matrix_compares_counts():
+    from scipy import sparse
+    # 単語の並び・重複した単語・空の文書
+    matrix = sparse.csr_matrix((np.array([1., 1., 2., 1., 1., 1.], dtype=np.float32),
+                                np.array([0, 1, 0, 1, 0, 0]), np.array([0, 2, 3, 5, 5, 6])), shape=(5, 3))
+    unique_rows, inverse = dedup_matrix(matrix)
+    assert unique_rows.shape[0] == 4
+    assert inverse[0] == inverse[2]
+    assert len(set(inverse.tolist())) == 4
+    np.testing.assert_array_equal(unique_rows[inverse].toarray(), matrix.toarray())
+
+
+def test_dedup_matrix_empty():
+    from scipy import sparse
+    unique_rows, inverse = dedup_matrix(sparse.csr_matrix((0, 3), dtype=np.float32))
+    assert unique_rows.shape == (0, 3)
+    assert len(inverse) == 0
+
+    # 空の文書だけの場合は1つにまとめる
+    unique_rows, inverse = dedup_matrix(sparse.csr_matrix((4, 3), dtype=np.float32))
+    assert unique_rows.shape == (1, 3)
+    assert inverse.tolist() == [0, 0, 0, 0]
+
+
+def test_dedup_matches_plain_inference(lda, dictionary, decks):
+    corpus = to_corpus(encode_decks(decks.drop('id', axis=1), build_lookup(dictionary)))
+    plain = infer_topics(lda, corpus, chunk_docs=7)
+    dedup, ratio = infer_topics_dedup(lda, corpus, chunk_docs=7)
+
+    assert dedup.shape == plain.shape == (len(decks), lda.num_topics)
+    assert ratio == len(decks) / 40.
+    np.testing.assert_allclose(dedup.sum(axis=1), 1., rtol=1e-6)
+    # 推論の初期値は乱数なので、収束の誤差の範囲で一致する
+    np.testing.assert_allclose(dedup, plain, atol=1e-2)
+    # 重複した行は同じ結果になる
+    np.testing.assert_array_equal(dedup[40:], dedup[:20])
+
+
+def test_dedup_accepts_mmap_corpus(lda, dictionary, decks, tmp_dir):
+    import os
+    matrix = encode_decks(decks.drop('id', axis=1), build_lookup(dictionary))
+    corpus = MmapCorpus.serialize_csr(os.path.join(tmp_dir, 'corpus'), [matrix])
+    topic_prob, ratio = infer_topics_dedup(lda, corpus)
+    assert topic_prob.shape == (len(decks), lda.num_topics)
+    assert ratio == len(decks) / 40.
+
+
+def test_inference_dtype(lda, dictionary, decks):
+    corpus = to_corpus(encode_decks(decks.drop('id', axis=1), build_lookup(dictionary)))
+    assert infer_topics(lda, corpus, dtype=np.float32).dtype == np.float32
+
+
+def test_float32_inference_agrees_with_float64(lda, dictionary, decks):
+    from common.checkpoint import cast_model
+    corpus = to_corpus(encode_decks(decks.drop('id', axis=1), build_lookup(dictionary)))
+    reference, _ = infer_topics_dedup(cast_model(lda, 'float64'), corpus, dtype=np.float64)
+    topic_prob, _ = infer_topics_dedup(cast_model(lda, 'float32'), corpus, dtype=np.float32)
+    assert topic_prob.dtype == np.float32
+    np.testing.assert_allclose(topic_prob, reference, atol=1e-2)
+    assert (topic_prob.argmax(axis=1) == reference.argmax(axis=1)).mean() >= 0.95
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import os
+import json
+import logging
+
+from common import metrics
+
+
+def test_summary(store, tmp_dir):
+    metrics.start('train')
+    with metrics.span('train'):
+        pass
+    with metrics.span('train'):
+        pass
+    metrics.add('rows_processed', 10)
+    metrics.add('rows_processed', 5)
+
+    local_file = os.path.join(tmp_dir, 'a.txt')
+    with open(local_file, 'w') as f:
+        f.write('abc')
+    store.upload(local_file, 'gs://bucket/out/a.txt')
+
+    result = metrics.summary()
+    assert result['step'] == 'train'
+    assert list(result['spans']) == ['train']
+    assert result['counters'] == {'rows_processed': 15}
+    assert result['bytes_uploaded'] == 3
+    assert result['bytes_downloaded'] == 0
+
+
+def test_write_kfp_metrics(tmp_dir):
+    metrics.start('train')
+    with metrics.span('upload_wait'):
+        pass
+    metrics.add('inference_dedup_ratio', 1.5)
+    for value in [30., 20., 25.]:
+        metrics.trace('perplexity', value)
+
+    metrics_file = os.path.join(tmp_dir, 'mlpipeline-metrics.json')
+    metrics.write(metrics_file)
+    with open(metrics_file) as f:
+        values = {m['name']: m['numberValue'] for m in json.load(f)['metrics']}
+
+    # メトリクス名は小文字・数字・ハイフンのみで、系列は件数によらず固定の要約だけを出す
+    assert values['inference-dedup-ratio'] == 1.5
+    assert 'upload-wait-seconds' in values
+    assert (values['perplexity-first'], values['perplexity-last'], values['perplexity-min'],
+            values['perplexity-count']) == (30., 25., 20., 3.)
+    assert not [name for name in values if name.startswith('perplexity-') and name[-1].isdigit()]
+    assert {'wall-seconds', 'peak-memory-mb', 'bytes-uploaded', 'bytes-downloaded'} <= set(values)
+
+
+def test_perplexity_per_pass():
+    metrics.start('train')
+    logger = logging.getLogger('gensim.models.ldamodel')
+    with metrics.perplexity_per_pass():
+        logger.info('-3.000 per-word bound, 8.0 perplexity estimate based on a held-out corpus of 10 documents')
+    logger.info('-1.000 per-word bound, 2.0 perplexity estimate based on a held-out corpus of 10 documents')
+    assert metrics.summary()['traces'] == {'perplexity': [8.0]}
+
+
+def test_train_records_perplexity(decks, write_inputs, train_args):
+    import train
+    write_inputs(decks)
+    train.main(train_args(num_pass=3))
+    result = metrics.summary()
+    assert result['step'] == 'train'
+    # passの最後には必ず評価される（途中のchunkで評価されるかはgensimのバージョンによる）
+    assert len(result['traces']['perplexity']) >= 3
+    assert all(value > 1 for value in result['traces']['perplexity'])
+    assert {'download', 'encode', 'train', 'infer', 'upload', 'upload_wait'} <= set(result['spans'])
@@ -0,0 +1,47 @@
+# coding: utf-8
+
+import numpy as np
+import pytest
+
+from conftest import OUTPUT
+from common.artifacts import read_frame, result_columns
+from common.checkpoint import load_model, save_model
+
+import train
+
+MODEL_DIR = OUTPUT + '/workflow_2020-01-01/model'
+RESULT_FILE = OUTPUT + '/workflow_2020-01-01/train/TOPIC_RESULT.parquet'
+
+
+def train_precision(store, train_args, precision, tmp_path, **options):
+    train.main(train_args(precision=precision, artifact_format='parquet', **options))
+    lda = load_model(store, MODEL_DIR, str(tmp_path), local_name=precision + '.ckpt')
+    result = read_frame(store, RESULT_FILE, result_columns(3), 'parquet')
+    return lda, result
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_precision_throughout(store, decks, write_inputs, train_args, tmp_path, precision):
+    write_inputs(decks, fmt='parquet')
+    lda, result = train_precision(store, train_args, precision, tmp_path)
+    # チェックポイントから読み込んだモデルと結果のトピック分布が同じ型になる
+    for array in [lda.expElogbeta, lda.state.sstats]:
+        assert array.dtype == np.dtype(precision)
+    assert result['topic0'].dtype == np.dtype(precision)
+
+
+def test_float32_update_agrees_with_float64(store, lda, decks, write_inputs, train_args, tmp_path, tmp_dir):
+    # LdaMulticoreは実行ごとに結果が変わるので、決定的なLdaModel.updateで同じ前日のモデルを更新して比べる
+    write_inputs(decks, fmt='parquet')
+    save_model(store, lda, OUTPUT + '/workflow_2019-12-31/model', tmp_dir)
+    options = {'learning_type': 'update', 'prev_date': '2019-12-31', 'num_pass': 5}
+    lda64, result64 = train_precision(store, train_args, 'float64', tmp_path, **options)
+    lda32, result32 = train_precision(store, train_args, 'float32', tmp_path, **options)
+
+    np.testing.assert_allclose(lda32.get_topics(), lda64.get_topics(), atol=1e-5)
+    topic_cols = ['topic{}'.format(i) for i in range(3)]
+    prob32 = result32[topic_cols].values
+    prob64 = result64[topic_cols].values
+    # 推論の初期値は乱数なので、収束の誤差の範囲で一致する
+    np.testing.assert_allclose(prob32, prob64, atol=1e-2)
+    assert (prob32.argmax(axis=1) == prob64.argmax(axis=1)).mean() >= 0.95
@@ -0,0 +1,64 @@
+# coding: utf-8
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import OUTPUT
+from common.artifacts import FrameWriter, read_frame, result_columns
+
+import train
+
+HERO_COLS = ['hero0', 'hero1', 'hero2', 'hero3']
+RESULT_FILE = OUTPUT + '/workflow_2020-01-01/train/TOPIC_RESULT.parquet'
+
+
+def test_build_result_columns(decks):
+    args = {'date': '2020-01-01', 'pipeline_version': 'v1'}
+    topic_prob = np.full((len(decks), 3), 1 / 3., dtype=np.float32)
+    df = train.build_result(decks['id'], decks[HERO_COLS], topic_prob, args, '2020-01-02 00:00:00')
+    assert len(df.columns) == len(result_columns(3))
+    assert df['topic0'].dtype == np.float32
+    assert df['date'].cat.categories.tolist() == ['2020-01-01']
+    assert df[HERO_COLS].values.tolist() == decks[HERO_COLS].values.tolist()
+
+
+def test_frame_writer_chunks_with_different_categories(tmp_dir, decks):
+    # row groupごとに読み込んだcategoryのカラムは、chunkごとにカテゴリ（とコードの型）が異なる
+    args = {'date': '2020-01-01', 'pipeline_version': 'v1'}
+    many = pd.DataFrame({col: ['{}_{:03d}'.format(col, i) for i in range(200)] for col in HERO_COLS})
+    many.insert(0, 'id', range(len(decks), len(decks) + len(many)))
+    chunks = [decks.iloc[:7], decks.iloc[7:], many]
+
+    local_file = os.path.join(tmp_dir, 'result.parquet')
+    with FrameWriter(local_file, 'parquet') as writer:
+        for chunk in chunks:
+            chunk = chunk.astype({col: 'category' for col in HERO_COLS})
+            topic_prob = np.full((len(chunk), 3), 1 / 3., dtype=np.float32)
+            writer.write(train.build_result(chunk['id'], chunk[HERO_COLS], topic_prob, args, '2020-01-02 00:00:00'))
+
+    import pyarrow.parquet as pq
+    assert pq.ParquetFile(local_file).num_row_groups == 3
+    df = pq.read_table(local_file).to_pandas()
+    expected = pd.concat(chunks)
+    assert df['id'].tolist() == expected['id'].tolist()
+    assert df[HERO_COLS].values.tolist() == expected[HERO_COLS].values.tolist()
+
+
+@pytest.mark.parametrize('options', [{'corpus_mode': 'stream'}, {'learning_type': 'update', 'update_mode': 'stream'}])
+def test_train_writes_multi_row_group_dataset(store, decks, write_inputs, train_args, options):
+    import train
+    categorical = decks.astype({col: 'category' for col in HERO_COLS})
+    if options.get('learning_type') == 'update':
+        # 更新する前日のモデル
+        write_inputs(categorical, fmt='parquet', preprocess_output=OUTPUT + '/workflow_2019-12-31/preprocess')
+        train.main(train_args(artifact_format='parquet', date='2019-12-31',
+                              preprocess_output=OUTPUT + '/workflow_2019-12-31/preprocess'))
+        options = dict(options, prev_date='2019-12-31')
+    write_inputs(categorical, fmt='parquet', row_group_size=7)
+    train.main(train_args(artifact_format='parquet', chunk_rows=7, **options))
+
+    df = read_frame(store, RESULT_FILE, result_columns(3), 'parquet')
+    assert df['id'].tolist() == decks['id'].tolist()
+    assert df[['name0', 'name1', 'name2', 'name3']].astype(str).values.tolist() == decks[HERO_COLS].values.tolist()
@@ -0,0 +1,116 @@
+# coding: utf-8
+
+import json
+import threading
+import urllib.request
+import urllib.error
+import pytest
+
+from conftest import OUTPUT, NAMES
+from common.checkpoint import save_model
+from serve import LRUCache, LatencyStats, TopicScorer, ScoringServer
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # 'b'が最も古いので追い出される
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+@pytest.fixture
+def scorer(store, lda, tmp_dir):
+    save_model(store, lda, OUTPUT + '/workflow_2020-01-01/model', tmp_dir)
+    scorer = TopicScorer(store, OUTPUT, tmp_dir, cache_size=10)
+    assert scorer.reload()
+    return scorer
+
+
+def test_score_uses_cache(scorer):
+    deck = NAMES[:4]
+    workflow, first = scorer.score([deck, list(reversed(deck))])
+    assert workflow == 'workflow_2020-01-01'
+    # 並びが違うだけのデッキは同じデッキとして1回だけ推論する
+    assert first[0] == first[1]
+    assert (scorer.cache.hits, scorer.cache.misses) == (0, 2)
+    assert len(scorer.cache) == 1
+
+    _, second = scorer.score([deck])
+    assert second[0] == first[0]
+    assert scorer.cache.hits == 1
+
+
+def test_reload_swaps_to_newer_model(scorer, store, lda, tmp_dir):
+    scorer.score([NAMES[:4]])
+    assert not scorer.reload()
+
+    save_model(store, lda, OUTPUT + '/workflow_2020-01-02/model', tmp_dir)
+    assert scorer.reload()
+    assert scorer.workflow == 'workflow_2020-01-02'
+    # 前のモデルの結果は使わない
+    assert len(scorer.cache) == 0
+    workflow, _ = scorer.score([NAMES[:4]])
+    assert workflow == 'workflow_2020-01-02'
+
+
+@pytest.fixture
+def server(scorer):
+    server = ScoringServer(('127.0.0.1', 0), scorer, LatencyStats(100))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url + '/score', data=body.encode('utf-8'), method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read().decode('utf-8'))
+
+
+def test_score_request(server):
+    deck = dict(zip(['hero0', 'hero1', 'hero2', 'hero3'], NAMES[:4]))
+    status, body = post(server, json.dumps({'deck': deck}))
+    assert status == 200
+    assert body['workflow'] == 'workflow_2020-01-01'
+    assert len(body['topics']) == 3
+
+    status, body = post(server, json.dumps({'decks': [NAMES[:4], NAMES[4:8]]}))
+    assert status == 200
+    assert len(body['topics']) == 2
+
+    with urllib.request.urlopen(server + '/stats') as response:
+        stats = json.loads(response.read().decode('utf-8'))
+    # レイテンシは応答の後に記録するので、件数は確認しない
+    assert stats['workflow'] == 'workflow_2020-01-01'
+    assert stats['cache_hits'] == 1
+
+
+@pytest.mark.parametrize('body', [
+    '[1, 2]',
+    '{"decks": "hero00"}',
+    '{"deck": ["hero00", "hero01"]}',
+    '{"deck": ["hero00", "hero01", "hero02", "unknown"]}',
+    'not json'
+])
+def test_bad_request_returns_400(server, body):
+    status, response = post(server, body)
+    assert status == 400
+    assert 'error' in response
@@ -0,0 +1,73 @@
+# coding: utf-8
+
+import os
+import pytest
+
+from common.step_cache import StepCache
+
+
+INPUT = 'gs://bucket/out/workflow_2020-01-01/preprocess/dataset.csv'
+OUTPUT = 'gs://bucket/out/workflow_2020-01-01/train/TOPIC_RESULT.csv'
+
+
+def put(store, tmp_dir, remote_file, text):
+    local_file = os.path.join(tmp_dir, 'upload.txt')
+    with open(local_file, 'w') as f:
+        f.write(text)
+    store.upload(local_file, remote_file)
+
+
+@pytest.fixture
+def cache(store, tmp_dir):
+    return StepCache(store, 'gs://bucket/out', 'train', tmp_dir)
+
+
+@pytest.fixture
+def step_file(tmp_path):
+    path = tmp_path / 'step.py'
+    path.write_text('print(1)\n')
+    return str(path)
+
+
+ARGS = {'date': '2020-01-01', 'num_topics': 6, 'pipeline_version': 'v1', 'tmp_dir': '/tmp', 'upload_workers': 4}
+
+
+def test_key_invalidation(cache, store, tmp_dir, step_file):
+    put(store, tmp_dir, INPUT, 'a')
+    key = cache.key(ARGS, [INPUT], step_file)
+    assert cache.key(dict(ARGS), [INPUT], step_file) == key
+
+    # 結果に影響しない引数は無視する
+    assert cache.key(dict(ARGS, tmp_dir='/other', upload_workers=1), [INPUT], step_file) == key
+
+    # 引数・入力ファイル・コードが変わるとキーも変わる
+    assert cache.key(dict(ARGS, num_topics=8), [INPUT], step_file) != key
+    assert cache.key(dict(ARGS, pipeline_version='v2'), [INPUT], step_file) != key
+    put(store, tmp_dir, INPUT, 'b')
+    assert cache.key(ARGS, [INPUT], step_file) != key
+    put(store, tmp_dir, INPUT, 'a')
+    with open(step_file, 'a') as f:
+        f.write('print(2)\n')
+    assert cache.key(ARGS, [INPUT], step_file) != key
+
+
+def test_lookup_requires_outputs(cache, store, tmp_dir, step_file):
+    put(store, tmp_dir, INPUT, 'a')
+    key = cache.key(ARGS, [INPUT], step_file)
+    assert not cache.lookup(key)
+
+    put(store, tmp_dir, OUTPUT, 'result')
+    cache.record(key, [OUTPUT])
+    assert cache.lookup(key)
+
+    # 出力が削除されていれば実行し直す
+    store.delete(OUTPUT)
+    assert not cache.lookup(key)
+
+
+def test_index_keeps_size_entries(store, tmp_dir):
+    cache = StepCache(store, 'gs://bucket/out', 'train', tmp_dir, size=2)
+    for key in ['k1', 'k2', 'k3']:
+        cache.record(key, [])
+    assert not cache.lookup('k1')
+    assert cache.lookup('k2') and cache.lookup('k3')
@@ -0,0 +1,85 @@
+# coding: utf-8
+
+import pytest
+
+from common.checkpoint import load_model, load_progress
+
+import train
+
+MODEL_DIR = 'gs://bucket/out/workflow_2020-01-02/model'
+PREPROCESS_OUTPUT = 'gs://bucket/out/workflow_2020-01-02/preprocess'
+
+
+@pytest.fixture
+def prev_model(decks, write_inputs, train_args):
+    """前日（2020-01-01）のモデルと当日のデータセット"""
+    write_inputs(decks)
+    train.main(train_args())
+    write_inputs(decks, preprocess_output=PREPROCESS_OUTPUT)
+
+
+def stream_args(train_args, **kwargs):
+    options = dict(learning_type='update', update_mode='stream', prev_date='2020-01-01', date='2020-01-02',
+                   preprocess_output=PREPROCESS_OUTPUT, chunk_rows=10, checkpoint_every=2)
+    options.update(kwargs)
+    return train_args(**options)
+
+
+def fail_after(monkeypatch, batches):
+    """batches個のmicro-batchを返した後に失敗させる"""
+    iter_deck_batches = train.iter_deck_batches
+
+    def failing(args, store, skip=0):
+        for i, batch in iter_deck_batches(args, store, skip=skip):
+            if i >= batches:
+                raise RuntimeError('interrupted')
+            yield i, batch
+
+    monkeypatch.setattr(train, 'iter_deck_batches', failing)
+
+
+def test_stream_update(prev_model, store, decks, train_args):
+    args = stream_args(train_args)
+    train.main(args)
+    lda = load_model(store, MODEL_DIR, args['tmp_dir'])
+    prev = load_model(store, 'gs://bucket/out/workflow_2020-01-01/model', args['tmp_dir'])
+    assert lda.num_updates == prev.num_updates + len(decks)
+    assert load_progress(store, MODEL_DIR + '/stream') is None
+    assert store.exists('gs://bucket/out/workflow_2020-01-02/train/TOPIC_RESULT.csv')
+
+
+def test_resume_after_failure(prev_model, store, decks, train_args, monkeypatch, capsys):
+    args = stream_args(train_args)
+    fail_after(monkeypatch, 5)
+    with pytest.raises(RuntimeError):
+        train.main(args)
+
+    # checkpoint_everyごとに保存した進捗が残る
+    progress = load_progress(store, MODEL_DIR + '/stream')
+    assert progress['batches'] == 4
+    assert progress['prev_date'] == '2020-01-01'
+
+    # 再実行は保存したmicro-batchの続きから
+    monkeypatch.undo()
+    args = stream_args(train_args)
+    train.main(args)
+    assert 'Resuming the streaming update from micro-batch 4' in capsys.readouterr().out
+    lda = load_model(store, MODEL_DIR, args['tmp_dir'])
+    prev = load_model(store, 'gs://bucket/out/workflow_2020-01-01/model', args['tmp_dir'])
+    assert lda.num_updates == prev.num_updates + len(decks)
+    assert load_progress(store, MODEL_DIR + '/stream') is None
+
+
+def test_progress_of_other_settings_is_ignored(prev_model, store, decks, train_args, monkeypatch, capsys):
+    fail_after(monkeypatch, 3)
+    with pytest.raises(RuntimeError):
+        train.main(stream_args(train_args))
+    monkeypatch.undo()
+
+    # micro-batchの大きさが変わると途中経過は使えない
+    args = stream_args(train_args, chunk_rows=20)
+    train.main(args)
+    assert 'Resuming' not in capsys.readouterr().out
+    lda = load_model(store, MODEL_DIR, args['tmp_dir'])
+    prev = load_model(store, 'gs://bucket/out/workflow_2020-01-01/model', args['tmp_dir'])
+    assert lda.num_updates == prev.num_updates + len(decks)
@@ -0,0 +1,61 @@
+# coding: utf-8
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from common.artifacts import read_num_topics
+from common.checkpoint import load_model
+from common.encoder import build_lookup, encode_decks
+from common.sweep import parse_grid, split_holdout, run_sweep
+
+import train
+
+
+def test_parse_grid():
+    defaults = {'num_topics': 6, 'num_pass': 30, 'chunk_size': 1000}
+    grid = parse_grid('num_topics=4,8; num_pass=10', defaults)
+    assert grid == [{'num_topics': 4, 'num_pass': 10, 'chunk_size': 1000},
+                    {'num_topics': 8, 'num_pass': 10, 'chunk_size': 1000}]
+    assert parse_grid('', defaults) == [defaults]
+    with pytest.raises(ValueError):
+        parse_grid('alpha=1', defaults)
+
+
+def test_split_holdout(dictionary, decks):
+    matrix = encode_decks(decks.drop('id', axis=1), build_lookup(dictionary))
+    train_matrix, test_matrix = split_holdout(matrix, 0.25)
+    assert (train_matrix.shape[0], test_matrix.shape[0]) == (45, 15)
+    assert train_matrix.sum() + test_matrix.sum() == matrix.sum()
+
+
+@pytest.mark.parametrize('metric', ['perplexity', 'coherence'])
+def test_run_sweep_ranks_results(dictionary, decks, tmp_dir, metric):
+    matrix = encode_decks(decks.drop('id', axis=1), build_lookup(dictionary))
+    grid = parse_grid('num_topics=2,3,4', {'num_topics': 3, 'num_pass': 2, 'chunk_size': 16})
+    results = run_sweep(matrix, dictionary, grid, tmp_dir, processes=2, metric=metric)
+
+    assert [r['rank'] for r in results] == [1, 2, 3]
+    assert sorted(r['num_topics'] for r in results) == [2, 3, 4]
+    values = [r[metric] for r in results]
+    assert values == sorted(values, reverse=(metric == 'coherence'))
+    assert all(os.path.isfile(r['model_file']) for r in results)
+
+
+def test_train_promotes_the_best_model(store, decks, write_inputs, train_args):
+    write_inputs(decks)
+    args = train_args(sweep_grid='num_topics=2,4', workers=2)
+    train.main(args)
+
+    output_dir = 'gs://bucket/out/workflow_2020-01-01'
+    leaderboard = pd.read_csv(store.path(output_dir + '/train/leaderboard.csv'))
+    best = leaderboard[leaderboard['rank'] == 1].iloc[0]
+    assert best['perplexity'] == leaderboard['perplexity'].min()
+
+    # 最も良い設定のモデル・結果のスキーマを保存する
+    lda = load_model(store, output_dir + '/model', args['tmp_dir'])
+    assert lda.num_topics == best['num_topics']
+    assert read_num_topics(store, output_dir + '/train') == best['num_topics']
+    result = pd.read_csv(store.path(output_dir + '/train/TOPIC_RESULT.csv'), header=None)
+    np.testing.assert_allclose(result.iloc[:, 6:6 + lda.num_topics].sum(axis=1), 1., rtol=1e-5)
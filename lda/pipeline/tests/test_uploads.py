@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import os
+import glob
+import threading
+import numpy as np
+import pytest
+
+from conftest import OUTPUT
+from common import handoff
+from common.storage import LocalStorage
+from common.checkpoint import save_model, load_model
+
+
+class GatedStorage(LocalStorage):
+    """gateが開くまでアップロードを待たせ、アップロードしたスレッドと順序を記録する"""
+
+    def __init__(self, root, bucket_name):
+        LocalStorage.__init__(self, root, bucket_name)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.uploads = []
+
+    def upload(self, local_file, remote_file):
+        self.gate.wait(10)
+        self.uploads.append((remote_file, threading.current_thread() is threading.main_thread()))
+        LocalStorage.upload(self, local_file, remote_file)
+
+
+@pytest.fixture
+def gated(tmp_path):
+    return GatedStorage(str(tmp_path / 'gcs'), 'bucket')
+
+
+@pytest.fixture
+def async_uploads():
+    handoff.enable(share=False)
+    yield
+    handoff.disable()
+
+
+def test_pending_model_is_not_overwritten(async_uploads, gated, lda, tmp_dir):
+    from gensim import models
+    other = models.LdaModel(id2word=lda.id2word, num_topics=3, random_state=2)
+
+    # 1つ目のアップロードが終わる前に、同じtmp_dirに次のモデルを保存する
+    gated.gate.clear()
+    save_model(gated, lda, OUTPUT + '/workflow_2020-01-01/model', tmp_dir)
+    save_model(gated, other, OUTPUT + '/workflow_2020-01-02/model', tmp_dir)
+    gated.gate.set()
+    handoff.flush()
+    handoff.disable()
+
+    first = load_model(gated, OUTPUT + '/workflow_2020-01-01/model', tmp_dir)
+    second = load_model(gated, OUTPUT + '/workflow_2020-01-02/model', tmp_dir, local_name='next.ckpt')
+    np.testing.assert_array_equal(first.expElogbeta, lda.expElogbeta)
+    np.testing.assert_array_equal(second.expElogbeta, other.expElogbeta)
+    # アップロードしたファイルは削除される
+    assert glob.glob(os.path.join(tmp_dir, 'upload_*')) == []
+
+
+def test_ordered_uploads(async_uploads, gated, tmp_dir):
+    files = []
+    for name in ['model.ckpt', 'progress.json']:
+        local_file = handoff.local_file(tmp_dir, name)
+        with open(local_file, 'w') as f:
+            f.write(name)
+        files.append((local_file, OUTPUT + '/stream/' + name))
+    handoff.upload_many(gated, files, remove=True, ordered=True)
+    handoff.flush()
+    assert [remote_file for remote_file, _ in gated.uploads] == [remote_file for _, remote_file in files]
+    assert not any(os.path.exists(local_file) for local_file, _ in files)
+
+
+def test_train_uploads_in_background(gated, decks, write_inputs, train_args, monkeypatch):
+    import train
+    monkeypatch.setattr(train, 'get_storage', lambda *args, **kwargs: gated)
+    write_inputs(decks)
+    gated.uploads = []
+
+    args = train_args(step_cache='on')
+    train.main(args)
+
+    uploaded = [remote_file for remote_file, _ in gated.uploads]
+    assert OUTPUT + '/workflow_2020-01-01/model/model.ckpt' in uploaded
+    assert OUTPUT + '/workflow_2020-01-01/train/schema.json' in uploaded
+    assert OUTPUT + '/workflow_2020-01-01/train/TOPIC_RESULT.csv' in uploaded
+    # モデル・スキーマ・キャッシュを含め、学習の間のアップロードは全てバックグラウンドで実行される
+    assert not any(on_main for _, on_main in gated.uploads)
+    assert glob.glob(os.path.join(args['tmp_dir'], 'upload_*')) == []
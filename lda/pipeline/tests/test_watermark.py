@@ -0,0 +1,120 @@
+# coding: utf-8
+
+import os
+import sqlite3
+import pandas as pd
+import pytest
+
+from common.query import build_query, read_watermark, read_start_watermark, write_watermark, watermark_file, is_delta
+
+import preprocess
+
+
+def test_build_query():
+    assert build_query('SAMPLE.DUMMY') == 'SELECT * FROM SAMPLE.DUMMY'
+    assert build_query('SAMPLE.DUMMY', 'id') == 'SELECT * FROM SAMPLE.DUMMY'
+    assert build_query('SAMPLE.DUMMY', 'id', 10) == 'SELECT * FROM SAMPLE.DUMMY WHERE id > 10'
+    assert build_query('SAMPLE.DUMMY', 'id', 10, 20) == 'SELECT * FROM SAMPLE.DUMMY WHERE id > 10 AND id <= 20'
+    assert build_query('SAMPLE.DUMMY', 'ts', "2020-01-01 00:00:00") == \
+        "SELECT * FROM SAMPLE.DUMMY WHERE ts > '2020-01-01 00:00:00'"
+
+
+def test_start_watermark_is_kept(store, tmp_dir):
+    local_file = os.path.join(tmp_dir, 'watermark.json')
+    workflow_dir = 'gs://bucket/out/workflow_2020-01-01/preprocess'
+    write_watermark(store, local_file, [watermark_file('gs://bucket/out', 'T')], 'T', 'id', 10)
+
+    assert read_start_watermark(store, 'gs://bucket/out', workflow_dir, 'T', 'id', local_file) == 10
+    # 現在のwatermarkが進んでも、同じワークフローでは記録した値を使う
+    write_watermark(store, local_file, [watermark_file('gs://bucket/out', 'T')], 'T', 'id', 20)
+    assert read_start_watermark(store, 'gs://bucket/out', workflow_dir, 'T', 'id', local_file) == 10
+    assert read_watermark(store, 'gs://bucket/out', 'T', 'id') == 20
+    # カラムが異なるwatermarkは使わない
+    assert read_watermark(store, 'gs://bucket/out', 'T', 'ts') is None
+
+
+@pytest.fixture
+def run_preprocess(store, tmp_path, tmp_dir, sqlite_db):
+    def run(date):
+        preprocess.main({
+            'project': 'project', 'bucket': 'bucket', 'storage_dir': store.root, 'output': 'gs://bucket/out',
+            'tmp_dir': tmp_dir, 'artifact_format': 'csv', 'date': date, 'dict_file': 'dict',
+            'dataset_file': 'dataset', 'extract_mode': 'incremental', 'watermark_column': 'id',
+            'query_backend': 'sqlite', 'sqlite_db': sqlite_db, 'dict_cache_size': 2
+        })
+        output_dir = os.path.join(store.root, 'out', 'workflow_' + date, 'preprocess')
+        assert os.path.isfile(os.path.join(output_dir, 'dict.csv'))
+        # データセットはヘッダなしのCSV
+        return pd.read_csv(os.path.join(output_dir, 'dataset.csv'), header=None)[0]
+    return run
+
+
+def test_incremental_extract(run_preprocess, store, sqlite_db, decks):
+    assert len(run_preprocess('2020-01-01')) == len(decks)
+    assert read_watermark(store, 'gs://bucket/out', preprocess.DATASET_TABLE, 'id') == len(decks) - 1
+
+    conn = sqlite3.connect(sqlite_db)
+    conn.execute("INSERT INTO DUMMY VALUES (?, 'hero00', 'hero01', 'hero02', 'hero03')", (len(decks),))
+    conn.commit()
+    conn.close()
+
+    # 同じ日付の再実行では、最初の実行と同じ行を取得し直す
+    assert len(run_preprocess('2020-01-01')) == len(decks)
+    assert read_watermark(store, 'gs://bucket/out', preprocess.DATASET_TABLE, 'id') == len(decks) - 1
+
+    # 次の日付では新しい行だけ
+    assert run_preprocess('2020-01-02').tolist() == [len(decks)]
+    assert read_watermark(store, 'gs://bucket/out', preprocess.DATASET_TABLE, 'id') == len(decks)
+
+    # 先の日付の実行後でも、前の日付の再実行で取得する行は変わらない
+    assert len(run_preprocess('2020-01-01')) == len(decks)
+    assert read_watermark(store, 'gs://bucket/out', preprocess.DATASET_TABLE, 'id') == len(decks)
+
+
+@pytest.fixture
+def dated_db(tmp_path, decks):
+    """更新日のカラムを持つSAMPLE.DUMMY"""
+    from conftest import NAMES
+    db_file = str(tmp_path / 'dated.db')
+    conn = sqlite3.connect(db_file)
+    pd.DataFrame({'name': NAMES}).to_sql('NAMES', conn, index=False)
+    df = decks.copy()
+    df['updated'] = ['2020-01-{:02d}'.format(1 + i % 3) for i in range(len(df))]
+    df.to_sql('DUMMY', conn, index=False)
+    conn.close()
+    return db_file
+
+
+def test_date_watermark_with_parquet(store, tmp_dir, dated_db, decks):
+    args = {
+        'project': 'project', 'bucket': 'bucket', 'storage_dir': store.root, 'output': 'gs://bucket/out',
+        'tmp_dir': tmp_dir, 'artifact_format': 'parquet', 'date': '2020-01-03', 'dict_file': 'dict',
+        'dataset_file': 'dataset', 'extract_mode': 'incremental', 'watermark_column': 'updated',
+        'query_backend': 'sqlite', 'sqlite_db': dated_db, 'dict_cache_size': 2
+    }
+    preprocess.main(args)
+
+    # watermarkはcategoryに変換する前の値で、データセットにはtrainが読み込むカラムだけを保存する
+    assert read_watermark(store, 'gs://bucket/out', preprocess.DATASET_TABLE, 'updated') == '2020-01-03'
+    df = pd.read_parquet(os.path.join(store.root, 'out', 'workflow_2020-01-03', 'preprocess', 'dataset.parquet'))
+    assert df.columns.tolist() == ['id', 'hero0', 'hero1', 'hero2', 'hero3']
+    assert len(df) == len(decks)
+
+
+def test_reset_rejects_delta(run_preprocess, store, sqlite_db, decks, train_args):
+    import train
+    output_dir = 'gs://bucket/out/workflow_{}/preprocess'
+
+    # 最初の抽出はテーブル全体なのでリセットに使える
+    run_preprocess('2020-01-01')
+    assert not is_delta(store, output_dir.format('2020-01-01'), preprocess.DATASET_TABLE)
+
+    conn = sqlite3.connect(sqlite_db)
+    conn.execute("INSERT INTO DUMMY VALUES (?, 'hero00', 'hero01', 'hero02', 'hero03')", (len(decks),))
+    conn.commit()
+    conn.close()
+    run_preprocess('2020-01-02')
+    assert is_delta(store, output_dir.format('2020-01-02'), preprocess.DATASET_TABLE)
+
+    with pytest.raises(ValueError):
+        train.main(train_args(preprocess_output=output_dir.format('2020-01-02'), date='2020-01-02'))
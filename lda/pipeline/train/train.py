@@ -8,24 +8,22 @@ import argparse
 from datetime import datetime, date, timedelta, timezone
 import json
 import warnings
-from io import StringIO
 warnings.filterwarnings('ignore')
-import numpy as np
-import pandas as pd
-from google.cloud import storage
-from google.oauth2 import service_account
-from gensim import corpora, models
-import pyLDAvis
-import pyLDAvis.gensim
-
-
-"""認証キーを読み込み"""
-print('loading credentials')
-credentials = service_account.Credentials.from_service_account_info(
-    {
-        """使用するGCPプロジェクトの認証キー情報を入れる"""
-    },
-)
+from common import handoff, metrics
+from common.storage import get_storage
+from common.step_cache import get_cache
+from collections import OrderedDict
+from common.artifacts import artifact_file, read_frame, write_schema, constant_column, FrameWriter, SCHEMA_FILE
+from common.corpus import MmapCorpus, CsrWriter
+from common.dict_cache import HASH_FILE, read_hash, load_dictionary, save_dictionary
+from common.encoder import build_lookup, encode_decks, to_corpus, as_matrix
+from common.inference import infer_topics, infer_topics_dedup
+from common.checkpoint import CHECKPOINT_FILE, load_model, save_model, save_progress, load_progress, clear_progress, \
+    cast_model
+from common.sweep import SWEEP_PARAMS, parse_grid, run_sweep
+from common.query import DATASET_TABLE, is_delta
+from common import distributed
+
 
 DEFAULT_PARAMS = {
     'num_topics': 6,
@@ -34,6 +32,12 @@ DEFAULT_PARAMS = {
     'workers': 3
 }
 
+# 途中のchunkでは評価せず、各passの最後のchunkでだけperplexityを評価する
+EVAL_EVERY_PASS = 10 ** 9
+
+# ストリーミング更新の途中経過の保存先（モデルの保存先からの相対パス）
+STREAM_DIR = 'stream'
+
 
 def get_current_time(area='JST'):
     return datetime.now(
@@ -99,10 +103,160 @@ def parse_arguments():
         help='Reset or update the model [ "reset" | "update" ]',
         default='update'
     )
+    parser.add_argument(
+        '--num_topics',
+        help='Number of topics (default: {})'.format(DEFAULT_PARAMS['num_topics']),
+        type=int
+    )
+    parser.add_argument(
+        '--num_pass',
+        help='Number of passes over the corpus (default: {})'.format(DEFAULT_PARAMS['num_pass']),
+        type=int
+    )
+    parser.add_argument(
+        '--chunk_size',
+        help='Number of documents per training chunk (default: {})'.format(DEFAULT_PARAMS['chunk_size']),
+        type=int
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of training worker processes (default: {})'.format(DEFAULT_PARAMS['workers']),
+        type=int
+    )
+    parser.add_argument(
+        '--corpus_mode',
+        help='Keep the corpus in memory or stream it from disk [ "memory" | "stream" ]',
+        default='memory'
+    )
+    parser.add_argument(
+        '--chunk_rows',
+        help='Number of rows read from the dataset at once (corpus_mode=stream)',
+        type=int,
+        default=100000
+    )
+    parser.add_argument(
+        '--infer_workers',
+        help='Number of processes used for topic inference',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--no_dedup_inference',
+        help='Infer every row separately instead of each distinct deck once',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--update_mode',
+        help='How the model is updated [ "batch" (whole dataset at once) | "stream" (micro-batches of chunk_rows) ]',
+        default='batch'
+    )
+    parser.add_argument(
+        '--decay',
+        help='Weight decay of the online update for each micro-batch (default: the model\'s value)',
+        type=float
+    )
+    parser.add_argument(
+        '--offset',
+        help='Offset that slows down the first online updates (default: the model\'s value)',
+        type=float
+    )
+    parser.add_argument(
+        '--checkpoint_every',
+        help='Number of micro-batches between checkpoints of the streaming update',
+        type=int,
+        default=10
+    )
+    parser.add_argument(
+        '--precision',
+        help='Precision of the model, checkpoints, inference and results [ "float32" | "float64" ] '
+             '(default: float32 model, results in float32 for parquet and float64 for csv)',
+        choices=['float32', 'float64']
+    )
+    parser.add_argument(
+        '--sweep_grid',
+        help='Parameter grid trained in parallel when resetting (e.g. "num_topics=4,6,8;num_pass=10,30")'
+    )
+    parser.add_argument(
+        '--sweep_metric',
+        help='Metric used to promote the best model [ "perplexity" | "coherence" ]',
+        default='perplexity'
+    )
+    parser.add_argument(
+        '--holdout_ratio',
+        help='Ratio of documents held out for the perplexity in the sweep',
+        type=float,
+        default=0.1
+    )
+    parser.add_argument(
+        '--dist_role',
+        help='Role in the data-parallel reset over several pods '
+             '[ "split" (once before the passes) | "shard" (E-step) | "reduce" (M-step) ]'
+    )
+    parser.add_argument(
+        '--num_shards',
+        help='Number of shards of the data-parallel reset',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--shard',
+        help='Shard number of this pod (dist_role=shard)',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--pass_no',
+        help='Pass number of the data-parallel reset (0-origin)',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--visualize',
+        help='Build the pyLDAvis report here or in the separate visualize step [ "inline" | "step" ]',
+        default='step'
+    )
     parser.add_argument(
         '--pipeline_version',
         help='Pipeline version'
     )
+    parser.add_argument(
+        '--dict_cache_size',
+        help='Number of dictionary versions kept in the cache (0: disable the cache)',
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--step_cache',
+        help='Skip the step when the same inputs, arguments and code already succeeded [ "on" | "off" ]',
+        default='on'
+    )
+    parser.add_argument(
+        '--cache_ttl_days',
+        help='Days a step cache entry is kept after its last use',
+        type=int,
+        default=30
+    )
+    parser.add_argument(
+        '--cache_size',
+        help='Number of step cache entries kept per step',
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        '--upload_workers',
+        help='Number of background threads uploading the artifacts while training continues',
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS (for offline benchmarks)'
+    )
     parser.add_argument(
         '--output',
         help='Output directory',
@@ -112,7 +266,7 @@ def parse_arguments():
     args = parser.parse_args()
     arguments = args.__dict__
 
-    params = DEFAULT_PARAMS
+    params = dict(DEFAULT_PARAMS)
     params.update({k: arg for k, arg in arguments.items() if arg is not None})
 
     # データセット日時のチェック
@@ -122,214 +276,591 @@ def parse_arguments():
         pass
 
     # モデル更新時のチェック
-    if (params['learning_type'] == 'update') & (params['prev_date'] == ''):
+    if (params['learning_type'] == 'update') and (params.get('prev_date', '') == ''):
         print('When updating the model, you need "--prev_date" argument.')
         sys.exit()
 
-    return params
-
-
-def read_gcs(project_name, bucket_name, gcs_csv, cols):
-    """
-    - GCS上のテキストファイルを読み込み, pandas dataframeで返す
-    (Input)
-    project_name: GCS project ID
-    bucket_name:  GCS bucket name
-    gcs_csv:      GCS file name
-    cols:         Column names of dataframe
-    """
-    client = storage.Client(project_name, credentials=credentials)
-    bucket = client.get_bucket(bucket_name)
-
-    # CSVを取得
-    blob = storage.Blob(gcs_csv.replace('gs://{}/'.format(bucket_name), ''), bucket)
-    content = blob.download_as_string()
-    s = str(content, 'utf-8')
-    data = StringIO(s)
-
-    df = pd.read_csv(data, names=cols)
-
-    return df
+    # ストリーミング更新時のチェック（データセット全体をメモリに載せないので、pyLDAvisは別ステップで作成）
+    if (params['update_mode'] == 'stream') & (params['visualize'] == 'inline'):
+        print('When updating the model by streaming, "--visualize" must be "step".')
+        sys.exit()
 
+    # 分散学習時のチェック（モデルのリセットのみ対応）
+    if params.get('dist_role') is not None:
+        if params['dist_role'] not in ['split', 'shard', 'reduce']:
+            print('"--dist_role" must be "split", "shard" or "reduce".')
+            sys.exit()
+        if (params['learning_type'] != 'reset') | (params.get('sweep_grid') is not None):
+            print('The data-parallel training only supports "--learning_type reset" without "--sweep_grid".')
+            sys.exit()
 
-def load_gcs(project_name, bucket_name, local_file, gcs_file, mode):
-    """
-    - インスタンス上のファイルをGCSにアップロード
-    (Input)
-    project_name: GCS project ID
-    bucket_name:  GCS bucket name
-    local_file:   File name located in the instance
-    gcs_file:     GCS file name
-    mode:         [ 'upload' | 'download' ]
-    """
-    client = storage.Client(project_name, credentials=credentials)
-    bucket = client.get_bucket(bucket_name)
-    
-    # ファイルをアップロード/ダウンロード
-    blob = bucket.blob(gcs_file.replace('gs://{}/'.format(bucket_name), ''))
-    if mode == 'upload':
-        blob.upload_from_filename(local_file)
-    elif mode == 'download':
-        blob.download_to_filename(local_file)
+    return params
 
 
 def get_dict(args):
-    """全ワードのデータセットを読み込み、dictionaryを生成"""
+    """全ワードのデータセットを読み込み、dictionaryを生成（キャッシュがあればそれを使う）"""
     print('Generating dictionary....')
+    store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+
+    # マスターデータのハッシュが一致するdictionaryを探す
+    digest = None
+    if args['dict_cache_size'] > 0:
+        digest = read_hash(store, args['preprocess_output'])
+    if digest is not None:
+        dict_word = load_dictionary(store, args['output'], digest, args['tmp_dir'])
+        if dict_word is not None:
+            print('Using cached dictionary ({})'.format(digest[:12]))
+            return dict_word
 
     cols = ['names']
-    gcs_csv = os.path.join(args['preprocess_output'], args['dict_file'] + '.csv')
-    data_raw = read_gcs(args['project'], args['bucket'], gcs_csv, cols)
+    gcs_file = os.path.join(args['preprocess_output'], artifact_file(args['dict_file'], args['artifact_format']))
+    data_raw = handoff.get_frame(gcs_file, cols)
+    if data_raw is None:
+        data_raw = read_frame(store, gcs_file, cols, args['artifact_format'])
     
+    from gensim import corpora
     words = data_raw.values.tolist()
     dict_word = corpora.Dictionary(words)
 
+    # キャッシュに保存
+    if digest is not None:
+        save_dictionary(store, args['output'], digest, dict_word, args['tmp_dir'], keep=args['dict_cache_size'])
+
     return dict_word
 
 
-def get_word(dict_word, args):
+def get_deck(dict_deck, args):
     """
     デッキのデータセットを読み込む
-    - data_word: 使用ワードのデータセット
-    - data_uid: data_wordに紐づくidのリスト
-    - corpus_word: data_wordのコーパス
+    - data_deck: 使用ワードのデータセット
+    - data_uid: data_deckに紐づくidのリスト
+    - corpus_deck: data_deckのコーパス
+      (corpus_mode='stream'の場合はディスク上に書き出してmemory-mapしたコーパス)
+    corpus_mode='stream'の場合、メモリに残すのはコーパスとidだけで、data_deckはNoneを返す
+    （結果はwrite_result_batchesでデータセットを読み直して書き出す）
     """
     print('Loading dataset....')
+    store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
 
-    # csvファイルを読み込む
+    # ファイルを読み込む
     cols = ['id', 'hero0', 'hero1', 'hero2', 'hero3']
-    gcs_csv = os.path.join(args['preprocess_output'], args['dataset_file'] + '.csv')
-    data_raw = read_gcs(args['project'], args['bucket'], gcs_csv, cols)
+    gcs_file = os.path.join(args['preprocess_output'], artifact_file(args['dataset_file'], args['artifact_format']))
+
+    # 全ワードのdictionaryを参照しながらコーパスに変換
+    lookup = build_lookup(dict_deck)
+
+    if args['corpus_mode'] == 'stream':
+        # chunk_rows行ずつコーパスへ変換してディスクに書き出し、idだけを残す
+        import numpy as np
+        import pandas as pd
+        ids = []
+
+        def iter_matrices():
+            for _, batch in iter_deck_batches(args, store):
+                ids.append(batch['id'].values)
+                yield encode_decks(batch.drop('id', axis=1), lookup)
+
+        if not os.path.isdir(args['tmp_dir']):
+            os.mkdir(args['tmp_dir'])
+        corpus_file = os.path.join(args['tmp_dir'], 'corpus')
+        corpus_deck = MmapCorpus.serialize_csr(corpus_file, iter_matrices())
+        data_uid = pd.Series(np.concatenate(ids) if ids else np.array([], dtype=np.int64), name='id')
+        return None, data_uid, corpus_deck
+
+    # 同一プロセスの前のステップから受け取ったデータがあればそれを使う
+    data_raw = handoff.get_frame(gcs_file, cols)
+    if data_raw is None:
+        data_raw = read_frame(store, gcs_file, cols, args['artifact_format'])
 
     # idのリスト, デッキ内容のリストに分ける
     data_uid = data_raw['id']
-    data_word = data_raw.drop('id', axis=1)
-
-    # 全ワードのdictionaryを参照しながらコーパスに変換
-    words = data_word.values.tolist()
-    corpus_word = [dict_word.doc2bow(deck) for deck in decks]
+    data_deck = data_raw.drop('id', axis=1)
+    corpus_deck = to_corpus(encode_decks(data_deck, lookup))
 
     return data_deck, data_uid, corpus_deck
 
 
-def main(args):
-    """LDAでデッキごとにトピック番号を割り当てる"""
-    # 実行時刻を取得
-    execution_time = get_current_time()
-
-    # 全ワードのマスターデータを読み込みdictionaryを取得
-    dict_deck = get_dict(args)
-
-    # 使用ワードのデータセットを読み込む
-    data_deck, data_uid, corpus_deck = get_deck(dict_deck, args)
-
-    # ディレクトリを指定
-    if not os.path.isdir(args['tmp_dir']):
-        os.mkdir(args['tmp_dir'])
-    model_file = os.path.join(args['tmp_dir'], 'model')
-
-    PREV_MODEL_DIR = os.path.join(args['output'], 'workflow_' + args['prev_date'], 'model')
-    MODEL_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'model')
-    gcs_file_prev = os.path.join(PREV_MODEL_DIR, 'model')
-    gcs_file_new = os.path.join(MODEL_DIR, 'model')
-    suffixes = ['', '.expElogbeta.npy', '.id2word', '.state']
-
-    # LDAモデルを学習
-    if args['learning_type'] == 'reset':
-        print('Running the model....')
-
-        # モデルを学習（リセット）
-        lda = models.ldamulticore.LdaMulticore(
-            corpus=corpus_deck, 
-            workers=args['workers'], 
-            id2word=dict_deck, 
-            num_topics=args['num_topics'], 
-            chunksize=args['chunk_size'], 
-            passes=args['num_pass'], 
-            minimum_probability=0., 
-            random_state=1
-        )
-        lda.save(model_file)
-
-        # 学習済みモデルをGCSにアップロード
-        for suffix in suffixes:
-            load_gcs(args['project'], args['bucket'], model_file + suffix, gcs_file_new + suffix, 'upload')
-
-    elif args['learning_type'] == 'update':
-        print('Updating the model....')
-        
-        # 前日のモデルをGCSからダウンロード
-        for suffix in suffixes:
-            load_gcs(args['project'], args['bucket'], model_file + suffix, gcs_file_prev + suffix, 'download')
-
-        # モデル更新
-        lda = models.LdaModel.load(model_file)
-        lda.update(corpus_deck)
-        lda.save(model_file)
-
-        # 更新済みモデルをGCSにアップロード
-        for suffix in suffixes:
-            load_gcs(args['project'], args['bucket'], model_file + suffix, gcs_file_new + suffix, 'upload')
-    
+def iter_deck_batches(args, store, skip=0):
+    """
+    - データセットをchunk_rows行ずつのmicro-batchとしてストレージから順に読み込む
+    - 同一プロセスの前のステップから受け取ったデータがあればそれを分割する
+    - skip: 読み飛ばすmicro-batchの数（途中から再開する場合）
+    """
+    cols = ['id', 'hero0', 'hero1', 'hero2', 'hero3']
+    gcs_file = os.path.join(args['preprocess_output'], artifact_file(args['dataset_file'], args['artifact_format']))
+    data_raw = handoff.get_frame(gcs_file, cols)
+    if data_raw is not None:
+        batches = (data_raw.iloc[i:i + args['chunk_rows']] for i in range(0, len(data_raw), args['chunk_rows']))
+    else:
+        batches = read_frame(store, gcs_file, cols, args['artifact_format'], chunksize=args['chunk_rows'])
 
-    # 保存先
-    OUTPUT_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'train')
-    
-    # pyLDAvisでトピック情報を可視化
-    print('Saving pyLDAvis file....')
+    for i, batch in enumerate(batches):
+        if i >= skip:
+            yield i, batch
 
-    # ディレクトリを指定
-    if not os.path.isdir(args['tmp_dir']):
-        os.mkdir(args['tmp_dir'])
-    vis_file = os.path.join(args['tmp_dir'], 'pyLDAvis.html')
-    gcs_file = os.path.join(OUTPUT_DIR, 'pyLDAvis.html')
-    
-    # pyLDAvisを出力
-    vis = pyLDAvis.gensim.prepare(lda, corpus_deck, dict_deck)
-    pyLDAvis.save_html(vis, vis_file)
-    
-    # GCSにアップロード
-    load_gcs(args['project'], args['bucket'], vis_file, gcs_file, 'upload')
-
-
-    # topicNoを結合
-    print('Concatenating dataset and allocated topic distribution....')
-    data_deck_topic = data_deck.copy()
-    topic_cols = ['topic{}'.format(i) for i in range(args['num_topics'])]
-    topic_prob = np.array([[y for (x,y) in lda[corpus_deck[i]]] for i in range(len(corpus_deck))])
-    for i, topic_col in enumerate(topic_cols):
-        data_deck_topic[topic_col] = topic_prob[:, i]
-
-    # カラムを並べ替え
-    print('Saving result file....')
-    data_topic = pd.concat([data_uid, data_deck_topic], axis=1)
-    cols = ['date']
-    cols.extend(data_topic.columns)
-    data_topic['date'] = args['date']
-    data_topic = data_topic.loc[:, cols]
-    data_topic['execution_time'] = execution_time
-    data_topic['version'] = args['pipeline_version']
-
-    # csvを保存
-    if not os.path.isdir(args['tmp_dir']):
-        os.mkdir(args['tmp_dir'])
-    res_file = os.path.join(args['tmp_dir'], '{}.csv'.format(args['table']))
-    gcs_file = os.path.join(OUTPUT_DIR, '{}.csv'.format(args['table']))
-    data_topic.to_csv(res_file, header=False, index=False)
 
-    # GCSにアップロード
-    load_gcs(args['project'], args['bucket'], res_file, gcs_file, 'upload')
+def stream_update(args, store, dict_deck, lda, model_dir):
+    """
+    - micro-batchごとにオンラインLDAでモデルを更新（メモリ使用量はmicro-batchの大きさで決まる）
+    - checkpoint_every batchごとにモデルと進捗を保存し、失敗した場合は次の実行で続きから再開する
+    """
+    progress_dir = os.path.join(model_dir, STREAM_DIR)
+    dataset = os.path.join(args['preprocess_output'], artifact_file(args['dataset_file'], args['artifact_format']))
+    state = {'prev_date': args['prev_date'], 'dataset': dataset, 'chunk_rows': args['chunk_rows']}
+
+    # 同じ条件で途中まで進んだ更新があれば、そのモデルから再開
+    done = 0
+    progress = load_progress(store, progress_dir)
+    if progress is not None and all(progress.get(k) == v for k, v in state.items()):
+        done = progress['batches']
+        print('Resuming the streaming update from micro-batch {}....'.format(done))
+        lda = load_model(store, progress_dir, args['tmp_dir'], mmap='c', local_name='resume_' + CHECKPOINT_FILE)
+        lda = with_precision(lda, args)
+
+    if args.get('decay') is not None:
+        lda.decay = args['decay']
+    if args.get('offset') is not None:
+        lda.offset = args['offset']
+
+    lookup = build_lookup(dict_deck)
+    for i, batch in iter_deck_batches(args, store, skip=done):
+        lda.update(to_corpus(encode_decks(batch.drop('id', axis=1), lookup)))
+        metrics.add('rows_processed', len(batch))
+        done = i + 1
+        if done % args['checkpoint_every'] == 0:
+            save_progress(store, lda, progress_dir, args['tmp_dir'], dict(state, batches=done))
+    print('{} micro-batches applied'.format(done))
+
+    clear_progress(store, progress_dir)
+    return lda
+
+
+def pass_model(args, store, dict_deck, pass_no, mmap='r'):
+    """分散学習でpass_no番目のpassが終わった時点のモデル（-1の場合は初期モデル）"""
+    if pass_no < 0:
+        return distributed.init_model(dict_deck, args['num_topics'], args['chunk_size'], dtype=model_dtype(args))
+    model_dir = os.path.join(distributed.pass_dir(args['output'], args['date'], pass_no), distributed.MODEL_DIR)
+    return with_precision(load_model(store, model_dir, args['tmp_dir'], mmap=mmap), args)
+
+
+def split_shards(args, store, dict_deck):
+    """
+    - 分散学習のsplit: データセットを1回だけ読み込み、shardごとに担当するblock（chunk_size行ずつ）を
+      エンコード済みのコーパスとして保存する
+    - 各passのshardは自分のコーパスだけをダウンロードするので、データセットの読み込みとエンコードはここだけになる
+    """
+    from contextlib import ExitStack
+    lookup = build_lookup(dict_deck)
+    prefixes = [os.path.join(args['tmp_dir'], distributed.shard_prefix(shard)) for shard in range(args['num_shards'])]
+    offset = 0
+    with ExitStack() as stack:
+        writers = [stack.enter_context(CsrWriter(prefix)) for prefix in prefixes]
+        for _, batch in iter_deck_batches(args, store):
+            matrix = encode_decks(batch.drop('id', axis=1), lookup)
+            for shard, writer in enumerate(writers):
+                for start, stop in distributed.assigned_rows(offset, len(batch), args['chunk_size'],
+                                                             shard, args['num_shards']):
+                    writer.write(matrix[start:stop])
+            metrics.add('rows_processed', len(batch))
+            offset += len(batch)
+    print('Split {} documents into {} shards'.format(offset, args['num_shards']))
+
+    remote_dir = distributed.shard_dir(args['output'], args['date'])
+    handoff.upload_many(store, [(local_file, os.path.join(remote_dir, os.path.basename(local_file)))
+                                for prefix in prefixes for local_file in MmapCorpus.files(prefix)])
+
+
+def shard_estep(args, store, dict_deck):
+    """
+    - 分散学習のshard: splitで保存した自分のコーパスについて前のpassのモデルでE-stepを行う
+    - 統計量はpassのディレクトリに保存し、reducerが合算する
+    """
+    lda = pass_model(args, store, dict_deck, args['pass_no'] - 1)
+    prefix = os.path.join(args['tmp_dir'], distributed.shard_prefix(args['shard']))
+    remote_dir = distributed.shard_dir(args['output'], args['date'])
+    store.download_many([(local_file, os.path.join(remote_dir, os.path.basename(local_file)))
+                         for local_file in MmapCorpus.files(prefix)])
+    corpus = MmapCorpus(prefix)
+
+    state = distributed.accumulate(lda, corpus, args['chunk_size'], distributed.new_state(lda))
+    metrics.add('rows_processed', len(corpus))
+    print('Shard {}/{}: {} documents in pass {}'.format(
+        args['shard'], args['num_shards'], state.numdocs, args['pass_no']))
+
+    local_file = handoff.local_file(args['tmp_dir'], distributed.state_file(args['shard']))
+    distributed.save_state(state, local_file)
+    remote_dir = distributed.pass_dir(args['output'], args['date'], args['pass_no'])
+    handoff.upload(store, local_file, os.path.join(remote_dir, distributed.state_file(args['shard'])), remove=True)
+
+
+def reduce_mstep(args, store, dict_deck):
+    """分散学習のreducer: 全shardの統計量を合算し、M-stepでモデルを更新"""
+    lda = pass_model(args, store, dict_deck, args['pass_no'] - 1, mmap='c')
+    remote_dir = distributed.pass_dir(args['output'], args['date'], args['pass_no'])
+    files = [(os.path.join(args['tmp_dir'], distributed.state_file(shard)),
+              os.path.join(remote_dir, distributed.state_file(shard)))
+             for shard in range(args['num_shards'])]
+    store.download_many(files)
+    state = distributed.merge_states([distributed.load_state(lda, local_file) for local_file, _ in files])
+    print('Pass {}: merging {} documents from {} shards'.format(args['pass_no'], state.numdocs, args['num_shards']))
+    return distributed.apply_mstep(lda, state, args['pass_no'])
+
+
+def model_dtype(args):
+    """モデルの配列の型（precisionの指定がない場合はgensimの既定のfloat32）"""
+    import numpy as np
+    return np.dtype(args.get('precision') or np.float32)
+
+
+def with_precision(lda, args):
+    """precisionを指定した場合、読み込んだモデルをその型に揃える（旧形式のfloat64のモデルなど）"""
+    if args.get('precision'):
+        return cast_model(lda, args['precision'])
+    return lda
+
+
+def topic_dtype(args):
+    """
+    - 結果のトピック分布の型
+    - precisionの指定がない場合、parquetはfloat32、csvは従来どおりの精度で出力するためfloat64
+    """
+    import numpy as np
+    if args.get('precision'):
+        return np.dtype(args['precision'])
+    return np.float32 if args['artifact_format'] == 'parquet' else np.float64
 
 
-    # output
+def build_result(data_uid, data_deck, topic_prob, args, execution_time):
+    """
+    - idとデッキ内容・トピック分布・実行情報から、TOPIC_RESULTのカラム順のdataframeを1回で作る
+    - 各カラムは元の配列をそのまま使い、実行情報は全行同じ値のcategoryにする
+    - デッキのカラムがcategoryの場合（parquetのデータセット）は文字列にする
+      （row groupごとにカテゴリとコードの型が変わり、chunkごとに書き出すparquetのスキーマが一致しなくなる）
+    """
+    import pandas as pd
+
+    n = len(data_uid)
+    columns = OrderedDict()
+    columns['date'] = constant_column(args['date'], n)
+    columns[data_uid.name] = data_uid.values
+    for col in data_deck.columns:
+        values = data_deck[col]
+        columns[col] = values.astype(object).values if values.dtype.name == 'category' else values.values
+    for i in range(topic_prob.shape[1]):
+        columns['topic{}'.format(i)] = topic_prob[:, i]
+    columns['execution_time'] = constant_column(execution_time, n)
+    columns['version'] = constant_column(args['pipeline_version'], n)
+    return pd.DataFrame(columns, columns=list(columns))
+
+
+def write_result(writer, data_uid, data_deck, topic_prob, args, execution_time):
+    """chunk_rows行ずつTOPIC_RESULTの形にして書き出す（全体のdataframeは作らない）"""
+    for start in range(0, len(data_uid), args['chunk_rows']):
+        stop = start + args['chunk_rows']
+        writer.write(build_result(data_uid.iloc[start:stop], data_deck.iloc[start:stop],
+                                  topic_prob[start:stop], args, execution_time))
+
+
+def write_result_batches(writer, args, store, topic_prob, execution_time):
+    """データセットをchunk_rows行ずつ読み直し、対応する行のトピック分布と合わせて書き出す（corpus_mode='stream'）"""
+    start = 0
+    for _, batch in iter_deck_batches(args, store):
+        stop = start + len(batch)
+        writer.write(build_result(batch['id'], batch.drop('id', axis=1), topic_prob[start:stop], args, execution_time))
+        start = stop
+
+
+def infer_batch(lda, corpus_deck, args):
+    """コーパスのトピック分布を推論（重複を除いて推論した場合はその比率も返す）"""
+    dtype = topic_dtype(args)
+    if args['no_dedup_inference']:
+        topic_prob = infer_topics(lda, corpus_deck, chunk_docs=args['chunk_size'],
+                                  processes=args['infer_workers'], dtype=dtype)
+        return topic_prob, None
+    return infer_topics_dedup(lda, corpus_deck, chunk_docs=args['chunk_size'],
+                              processes=args['infer_workers'], dtype=dtype)
+
+
+def write_results_stream(args, store, lda, dict_deck, res_file, execution_time):
+    """micro-batchごとに推論し、結果をファイルに追記する"""
+    lookup = build_lookup(dict_deck)
+    with FrameWriter(res_file, args['artifact_format']) as writer:
+        for _, batch in iter_deck_batches(args, store):
+            topic_prob, _ = infer_batch(lda, to_corpus(encode_decks(batch.drop('id', axis=1), lookup)), args)
+            writer.write(build_result(batch['id'], batch.drop('id', axis=1), topic_prob, args, execution_time))
+    return writer.rows
+
+
+def sweep_model(args, store, dict_deck, corpus_deck):
+    """
+    - グリッドの各設定を並行して学習し、最も良いモデルを返す
+    - 評価結果はleaderboard.csvとして保存し、argsのパラメータは採用した設定に置き換える
+    """
+    import pandas as pd
+    from gensim import models
+
+    grid = parse_grid(args['sweep_grid'], args)
+    print('Running the parameter sweep ({} settings)....'.format(len(grid)))
+    matrix = as_matrix(corpus_deck, len(dict_deck))
+    results = run_sweep(matrix, dict_deck, grid, args['tmp_dir'], processes=args['workers'],
+                        holdout_ratio=args['holdout_ratio'], metric=args['sweep_metric'], dtype=model_dtype(args))
+
+    # leaderboardを保存
+    leaderboard = pd.DataFrame(results, columns=['rank'] + SWEEP_PARAMS + ['perplexity', 'coherence'])
+    print(leaderboard.to_string(index=False))
+    local_file = handoff.local_file(args['tmp_dir'], 'leaderboard.csv')
+    gcs_file = os.path.join(args['output'], 'workflow_' + args['date'], 'train', 'leaderboard.csv')
+    leaderboard.to_csv(local_file, index=False)
+    handoff.upload(store, local_file, gcs_file, remove=True)
+
+    # 最も良い設定を採用
+    best = results[0]
+    args.update({name: best[name] for name in SWEEP_PARAMS})
+    return models.LdaModel.load(best['model_file'])
+
+
+def write_value(value_file, value):
+    """kfpのfile_outputsとして値を渡す（ローカル実行では書き込めなくてもよい）"""
     try:
-        with open('/output.txt', 'w') as f:
-            f.write(OUTPUT_DIR)
+        with open(value_file, 'w') as f:
+            f.write(value)
     except:
         pass
 
 
-    print('Training done.')
+def write_output(output_dir):
+    """
+    - 出力先と計測値をkfpに渡す
+    - バックグラウンドのアップロードが全て成功してから書き込む（失敗した場合は例外を送出）
+    """
+    with metrics.span('upload_wait'):
+        handoff.flush()
+    write_value('/output.txt', output_dir)
+    metrics.write()
+
+
+def main(args):
+    """LDAでデッキごとにトピック番号を割り当てる"""
+    import pandas as pd
+    from gensim import models
+
+    # アップロードはバックグラウンドで実行し、学習・可視化・推論と並行させる
+    # （write_outputの前に完了を待ち、失敗があればここで例外になる）
+    with handoff.async_uploads(args.get('upload_workers', 4)):
+
+        # 実行時刻を取得
+        execution_time = get_current_time()
+        metrics.start('train')
+
+        # ディレクトリを指定
+        store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
+        if not os.path.isdir(args['tmp_dir']):
+            os.mkdir(args['tmp_dir'])
+
+        # incrementalで抽出したデータセットは前回のwatermarkより後の行だけなので、リセットすると新しい行だけで学習してしまう
+        if (args['learning_type'] == 'reset') and is_delta(store, args['preprocess_output'], DATASET_TABLE):
+            raise ValueError('The dataset was extracted incrementally; "--learning_type reset" needs '
+                             '"--extract_mode full" in preprocess.')
+
+        PREV_MODEL_DIR = os.path.join(args['output'], 'workflow_' + args.get('prev_date', ''), 'model')
+        MODEL_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'model')
+        OUTPUT_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'train')
+
+        # 分散学習の各ステップはshardの一覧と次のpassをkfpに渡す（ステップの出力は全ての役割で共通）
+        dist_role = args.get('dist_role')
+        if dist_role is not None:
+            write_value(distributed.SHARDS_FILE, json.dumps(list(range(args['num_shards']))))
+            write_value(distributed.NEXT_PASS_FILE, distributed.next_pass(args['pass_no'], args['num_pass']))
+
+        # 分散学習のsplitはshardごとのコーパスを保存して終了（出力先は最後のpassのreducerが書く学習結果）
+        if dist_role == 'split':
+            with metrics.span('download'):
+                dict_deck = get_dict(args)
+            with metrics.span('encode'):
+                split_shards(args, store, dict_deck)
+            write_output(OUTPUT_DIR)
+            return
+
+        # 分散学習のshardと最後以外のpassのreducerは、モデルを次のpassに渡して終了
+        last_pass = (dist_role == 'reduce') and (args['pass_no'] == args['num_pass'] - 1)
+        if (dist_role is not None) and not last_pass:
+            PASS_DIR = distributed.pass_dir(args['output'], args['date'], args['pass_no'])
+            with metrics.span('download'):
+                dict_deck = get_dict(args)
+            if dist_role == 'shard':
+                with metrics.span('train'):
+                    shard_estep(args, store, dict_deck)
+            else:
+                with metrics.span('train'):
+                    lda = reduce_mstep(args, store, dict_deck)
+                with metrics.span('upload'):
+                    save_model(store, lda, os.path.join(PASS_DIR, distributed.MODEL_DIR), args['tmp_dir'])
+            write_output(PASS_DIR)
+            return
+
+        # 入力・引数・コードが同じ実行が成功済みであれば省略（分散学習の場合は各passの結果に依存するので使わない）
+        cache = get_cache(store, args, 'train') if dist_role is None else None
+        if cache is not None:
+            inputs = [
+                os.path.join(args['preprocess_output'], artifact_file(args['dict_file'], args['artifact_format'])),
+                os.path.join(args['preprocess_output'], artifact_file(args['dataset_file'], args['artifact_format'])),
+                os.path.join(args['preprocess_output'], HASH_FILE)
+            ]
+            if args['learning_type'] == 'update':
+                inputs.extend([os.path.join(PREV_MODEL_DIR, CHECKPOINT_FILE), os.path.join(PREV_MODEL_DIR, 'model')])
+            cache_key = cache.key(args, inputs, __file__)
+            if cache.lookup(cache_key):
+                print('Step cache hit ({}), skipping training.'.format(cache_key[:12]))
+                metrics.add('step_cache_hit', 1)
+                write_output(OUTPUT_DIR)
+                return
+
+        # 全ワードのマスターデータを読み込みdictionaryを取得
+        with metrics.span('download'):
+            dict_deck = get_dict(args)
+
+        # 使用ワードのデータセットを読み込む（ストリーミング更新の場合はmicro-batchごとに読み込む）
+        streaming = (args['learning_type'] == 'update') & (args['update_mode'] == 'stream')
+        if not streaming:
+            with metrics.span('encode'):
+                data_deck, data_uid, corpus_deck = get_deck(dict_deck, args)
+            metrics.add('rows_processed', len(data_uid))
+
+        # LDAモデルを学習
+        if args['learning_type'] == 'reset':
+            print('Running the model....')
+
+            # モデルを学習（リセット）
+            with metrics.span('train'):
+                if last_pass:
+                    lda = reduce_mstep(args, store, dict_deck)
+                elif args.get('sweep_grid'):
+                    lda = sweep_model(args, store, dict_deck, corpus_deck)
+                else:
+                    with metrics.perplexity_per_pass():
+                        lda = models.ldamulticore.LdaMulticore(
+                            corpus=corpus_deck, 
+                            workers=args['workers'], 
+                            id2word=dict_deck, 
+                            num_topics=args['num_topics'], 
+                            chunksize=args['chunk_size'], 
+                            passes=args['num_pass'], 
+                            eval_every=EVAL_EVERY_PASS, 
+                            minimum_probability=0., 
+                            random_state=1,
+                            dtype=model_dtype(args)
+                        )
+
+            # 学習済みモデルをGCSにアップロード
+            with metrics.span('upload'):
+                save_model(store, lda, MODEL_DIR, args['tmp_dir'])
+
+        elif args['learning_type'] == 'update':
+            print('Updating the model....')
+        
+            # 前日のモデルをGCSからダウンロード（同一プロセスで学習済みの場合はそれを使う）
+            # 配列はcopy-on-writeでmemory-mapし、更新した部分だけメモリに載せる
+            with metrics.span('download'):
+                lda = with_precision(load_model(store, PREV_MODEL_DIR, args['tmp_dir'], mmap='c'), args)
+
+            # モデル更新
+            lda.eval_every = EVAL_EVERY_PASS
+            with metrics.span('train'), metrics.perplexity_per_pass():
+                if streaming:
+                    lda = stream_update(args, store, dict_deck, lda, MODEL_DIR)
+                else:
+                    lda.update(corpus_deck)
+
+            # 更新済みモデルをGCSにアップロード
+            with metrics.span('upload'):
+                save_model(store, lda, MODEL_DIR, args['tmp_dir'])
+    
+
+        # 結果のスキーマはモデルのトピック数に合わせる
+        args['num_topics'] = lda.num_topics
+        write_schema(store, args['tmp_dir'], OUTPUT_DIR, lda.num_topics)
+    
+        # pyLDAvisでトピック情報を可視化（visualize='step'の場合は別ステップで実行）
+        if args['visualize'] == 'inline':
+            print('Saving pyLDAvis file....')
+
+            # ディレクトリを指定
+            if not os.path.isdir(args['tmp_dir']):
+                os.mkdir(args['tmp_dir'])
+            vis_file = handoff.local_file(args['tmp_dir'], 'pyLDAvis.html')
+            gcs_file = os.path.join(OUTPUT_DIR, 'pyLDAvis.html')
+
+            # pyLDAvisを出力
+            import pyLDAvis
+            import pyLDAvis.gensim
+            with metrics.span('visualize'):
+                vis = pyLDAvis.gensim.prepare(lda, corpus_deck, dict_deck)
+                pyLDAvis.save_html(vis, vis_file)
+
+            # GCSにアップロード
+            handoff.upload(store, vis_file, gcs_file, remove=True)
+
+
+        # ファイルを保存（トピックはtopic_dtypeの型・実行情報は辞書エンコードで保存）
+        if not os.path.isdir(args['tmp_dir']):
+            os.mkdir(args['tmp_dir'])
+        res_name = artifact_file(args['table'], args['artifact_format'])
+        res_file = handoff.local_file(args['tmp_dir'], res_name)
+        gcs_file = os.path.join(OUTPUT_DIR, res_name)
+
+        if streaming:
+            # micro-batchごとに推論してファイルに追記
+            print('Allocating topic distribution by micro-batch....')
+            with metrics.span('infer'):
+                rows = write_results_stream(args, store, lda, dict_deck, res_file, execution_time)
+            print('{} rows saved'.format(rows))
+
+            # GCSにアップロード
+            with metrics.span('upload'):
+                handoff.upload(store, res_file, gcs_file, remove=True)
+        else:
+            # topicNoを結合
+            print('Concatenating dataset and allocated topic distribution....')
+            with metrics.span('infer'):
+                topic_prob, dedup_ratio = infer_batch(lda, corpus_deck, args)
+            if dedup_ratio is not None:
+                print('Inference dedup ratio: {:.2f}'.format(dedup_ratio))
+                metrics.add('inference_dedup_ratio', dedup_ratio)
+
+            # chunk_rows行ずつTOPIC_RESULTのカラム順にしてファイルに追記
+            print('Saving result file....')
+            with metrics.span('upload'):
+                with FrameWriter(res_file, args['artifact_format']) as writer:
+                    if data_deck is None:
+                        write_result_batches(writer, args, store, topic_prob, execution_time)
+                    else:
+                        write_result(writer, data_uid, data_deck, topic_prob, args, execution_time)
+
+                # 同一プロセスの次のステップには、全体を1回だけ組み立てて渡す
+                # （corpus_mode='stream'の場合は全体を組み立てず、次のステップがファイルを読み込む）
+                if handoff.is_sharing() and data_deck is not None:
+                    handoff.put(gcs_file, build_result(data_uid, data_deck, topic_prob, args, execution_time))
+
+                # GCSにアップロード
+                handoff.upload(store, res_file, gcs_file, remove=True)
+
+
+        # 成功した実行を登録
+        if cache is not None:
+            outputs = [os.path.join(MODEL_DIR, CHECKPOINT_FILE), os.path.join(OUTPUT_DIR, SCHEMA_FILE), gcs_file]
+            if args.get('sweep_grid') and args['learning_type'] == 'reset':
+                outputs.append(os.path.join(OUTPUT_DIR, 'leaderboard.csv'))
+            if args['visualize'] == 'inline':
+                outputs.append(os.path.join(OUTPUT_DIR, 'pyLDAvis.html'))
+            cache.record(cache_key, outputs)
+
+        # output
+        write_output(OUTPUT_DIR)
+
+
+        print('Training done.')
 
 
 if __name__ == '__main__':
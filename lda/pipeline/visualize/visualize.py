@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import argparse
+from datetime import datetime, date, timedelta
+import warnings
+warnings.filterwarnings('ignore')
+from common import handoff, metrics
+from common.storage import get_storage
+from common.step_cache import get_cache
+from common.artifacts import artifact_file, read_frame, result_columns
+from common.checkpoint import CHECKPOINT_FILE, load_model
+from common.encoder import build_lookup, encode_decks, to_corpus
+
+
+def get_prev_date(days):
+    today = datetime.today()
+    prev_date = today - timedelta(days=days)
+    prev_date_str = datetime.strftime(prev_date, '%Y-%m-%d')
+    return prev_date_str
+
+
+def parse_arguments():
+    """Parse job arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--training_output',
+        help='Training output',
+        required=True
+    )
+    parser.add_argument(
+        '--project',
+        help='GCP project ID',
+        required=True
+    )
+    parser.add_argument(
+        '--bucket',
+        help='GCS bucket name',
+        required=True
+    )
+    parser.add_argument(
+        '--table',
+        help='Table name',
+        required=True
+    )
+    parser.add_argument(
+        '--date',
+        help='Date',
+        required=True
+    )
+    parser.add_argument(
+        '--sample_size',
+        help='Number of documents sampled for the visualization',
+        type=int,
+        default=10000
+    )
+    parser.add_argument(
+        '--seed',
+        help='Random seed of the sampling',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--chunk_rows',
+        help='Number of rows read from the result file at once',
+        type=int,
+        default=100000
+    )
+    parser.add_argument(
+        '--tmp_dir',
+        help='Directory for temporal files',
+        default='/tmp'
+    )
+    parser.add_argument(
+        '--artifact_format',
+        help='File format of the artifacts passed between steps [ "csv" | "parquet" ]',
+        default='csv'
+    )
+    parser.add_argument(
+        '--step_cache',
+        help='Skip the step when the same inputs, arguments and code already succeeded [ "on" | "off" ]',
+        default='on'
+    )
+    parser.add_argument(
+        '--cache_ttl_days',
+        help='Days a step cache entry is kept after its last use',
+        type=int,
+        default=30
+    )
+    parser.add_argument(
+        '--cache_size',
+        help='Number of step cache entries kept per step',
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        '--storage_dir',
+        help='Local directory used instead of GCS (for offline benchmarks)'
+    )
+    parser.add_argument(
+        '--output',
+        help='Output directory',
+        required=True
+    )
+
+    args = parser.parse_args()
+    arguments = args.__dict__
+    params = {k: arg for k, arg in arguments.items() if arg is not None}
+
+    if params['date'] == '':
+        params['date'] = get_prev_date(1)
+    else:
+        pass
+
+    return params
+
+
+def stratified_sample(chunks, topic_cols, sample_size, seed=1):
+    """
+    - 最も確率の高いトピックごとに層別し、各層の件数に比例した行数をランダムに抽出
+    - 各層で乱数の小さい順にsample_size行だけ残しながら読み進めるので、メモリはchunk + 層数 x sample_size行で済む
+    (Input)
+    chunks:      Iterable of dataframes (TOPIC_RESULT)
+    topic_cols:  Topic column names
+    sample_size: Number of rows sampled in total
+    seed:        Random seed
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.RandomState(seed)
+    kept = None
+    counts = {}
+    for chunk in chunks:
+        chunk = chunk.copy()
+        chunk['_stratum'] = chunk[topic_cols].values.argmax(axis=1)
+        chunk['_key'] = rng.random_sample(len(chunk))
+        for stratum, n in chunk['_stratum'].value_counts().items():
+            counts[stratum] = counts.get(stratum, 0) + n
+
+        kept = chunk if kept is None else pd.concat([kept, chunk], ignore_index=True)
+        kept = kept.sort_values('_key').groupby('_stratum').head(sample_size)
+
+    if kept is None:
+        return None
+
+    # 各層の件数に比例して割り当て（件数が1件以上ある層からは最低1行）
+    total = sum(counts.values())
+    samples = []
+    for stratum, group in kept.groupby('_stratum'):
+        n = max(1, int(round(sample_size * counts[stratum] / float(total))))
+        samples.append(group.sort_values('_key').head(n))
+    sample = pd.concat(samples, ignore_index=True)
+    return sample.drop(['_stratum', '_key'], axis=1)
+
+
+def write_output(output_dir):
+    """出力先と計測値をkfpに渡す"""
+    try:
+        with open('/output.txt', 'w') as f:
+            f.write(output_dir)
+    except:
+        pass
+    metrics.write()
+
+
+def main(args):
+    """学習済みモデルと抽出した文書でpyLDAvisのレポートを作成"""
+    metrics.start('visualize')
+    store = get_storage(args['project'], args['bucket'], storage_dir=args.get('storage_dir'))
+    if not os.path.isdir(args['tmp_dir']):
+        os.mkdir(args['tmp_dir'])
+
+    MODEL_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'model')
+    OUTPUT_DIR = os.path.join(args['output'], 'workflow_' + args['date'], 'visualize')
+    result_file = os.path.join(args['training_output'], artifact_file(args['table'], args['artifact_format']))
+
+    # 同じモデルと結果で作成済みであれば省略
+    cache = get_cache(store, args, 'visualize')
+    if cache is not None:
+        cache_key = cache.key(args, [os.path.join(MODEL_DIR, CHECKPOINT_FILE), result_file], __file__)
+        if cache.lookup(cache_key):
+            print('Step cache hit ({}), skipping the visualization.'.format(cache_key[:12]))
+            metrics.add('step_cache_hit', 1)
+            write_output(OUTPUT_DIR)
+            return
+
+    # pyLDAvisの読み込みは重いので、キャッシュを確認してから行う
+    import pyLDAvis
+    import pyLDAvis.gensim
+
+    # モデルを読み込む
+    print('Loading the model....')
+    with metrics.span('download'):
+        lda = load_model(store, MODEL_DIR, args['tmp_dir'], mmap='r')
+
+    # トピックごとに層別して文書を抽出
+    print('Sampling documents....')
+    topic_cols = ['topic{}'.format(i) for i in range(lda.num_topics)]
+    cols = result_columns(lda.num_topics)
+    df = handoff.get_frame(result_file, cols)
+    if df is not None:
+        chunks = [df]
+    else:
+        chunks = read_frame(store, result_file, cols, args['artifact_format'], chunksize=args['chunk_rows'])
+    with metrics.span('download'):
+        sample = stratified_sample(chunks, topic_cols, args['sample_size'], args['seed'])
+    if sample is None or len(sample) == 0:
+        raise ValueError('No documents found in {}'.format(result_file))
+    print('{} documents sampled'.format(len(sample)))
+    metrics.add('rows_processed', len(sample))
+
+    # 抽出した文書をコーパスに変換
+    dict_deck = lda.id2word
+    with metrics.span('encode'):
+        corpus_deck = to_corpus(encode_decks(sample[['name0', 'name1', 'name2', 'name3']], build_lookup(dict_deck)))
+
+    # pyLDAvisを出力
+    print('Saving pyLDAvis file....')
+    vis_file = os.path.join(args['tmp_dir'], 'pyLDAvis.html')
+    gcs_file = os.path.join(OUTPUT_DIR, 'pyLDAvis.html')
+    with metrics.span('visualize'):
+        vis = pyLDAvis.gensim.prepare(lda, corpus_deck, dict_deck)
+        pyLDAvis.save_html(vis, vis_file)
+
+    # GCSにアップロード
+    with metrics.span('upload'):
+        handoff.upload(store, vis_file, gcs_file)
+
+    # 成功した実行を登録
+    if cache is not None:
+        cache.record(cache_key, [gcs_file])
+
+    # output
+    write_output(OUTPUT_DIR)
+
+    print('Visualization done.')
+
+
+if __name__ == '__main__':
+    job_args = parse_arguments()
+    main(job_args)
@@ -21,6 +21,9 @@ DIR_EXEC="`pwd`/${PIPELINE}"
 #DIR_CONTAINER="/${PIPELINE}"
 DIR_CONTAINER=${DIR_EXEC}        # ローカルテスト用
 
+# 共通モジュール(common)を読み込めるようにする
+export PYTHONPATH="${DIR_EXEC}:${PYTHONPATH}"
+
 # GCP settings
 PROJECT="project_id"
 BUCKET="bucket"
@@ -42,6 +45,39 @@ echo "DIR_CONTAINER: ${DIR_CONTAINER}"
 echo ""
 
 
+# FUSED=1 の場合は3つのステップを1つのプロセスで実行
+if [ "${FUSED}" = "1" ]; then
+    python ${PIPELINE}/fused.py \
+        --project            ${PROJECT} \
+        --bucket             ${BUCKET} \
+        --table              ${TABLE} \
+        --prev_date          ${PREV_DATE} \
+        --date               ${DATE} \
+        --tmp_dir            ${DIR_CONTAINER}/${TMP} \
+        --learning_type      update \
+        --pipeline_version   ${PIPELINE} \
+        --output             ${GCS_DIR}
+    exit $?
+fi
+
+
+# BACKFILL_END=yyyy-mm-dd の場合は DATE から BACKFILL_END までの各日を1つのプロセスで順に更新
+if [ -n "${BACKFILL_END}" ]; then
+    python ${PIPELINE}/backfill.py \
+        --project            ${PROJECT} \
+        --bucket             ${BUCKET} \
+        --table              ${TABLE} \
+        --prev_date          ${PREV_DATE} \
+        --start_date         ${DATE} \
+        --end_date           ${BACKFILL_END} \
+        --date_column        ${DATE_COLUMN:-date} \
+        --tmp_dir            ${DIR_CONTAINER}/${TMP} \
+        --pipeline_version   ${PIPELINE} \
+        --output             ${GCS_DIR}
+    exit $?
+fi
+
+
 # Preprocess
 python ${PIPELINE}/preprocess/preprocess.py \
     --project        ${PROJECT} \
@@ -65,6 +101,18 @@ python ${PIPELINE}/train/train.py \
     --output             ${GCS_DIR}
 
 
+# Visualize（postprocessと並行して実行）
+python ${PIPELINE}/visualize/visualize.py \
+    --training_output ${GCS_DIR}/workflow_${DATE}/train \
+    --project         ${PROJECT} \
+    --bucket          ${BUCKET} \
+    --table           ${TABLE} \
+    --date            ${DATE} \
+    --tmp_dir         ${DIR_CONTAINER}/${TMP}/visualize \
+    --output          ${GCS_DIR} &
+VISUALIZE_PID=$!
+
+
 # Postprocess
 python ${PIPELINE}/postprocess/postprocess.py \
     --training_output ${GCS_DIR}/workflow_${DATE}/train \
@@ -72,7 +120,16 @@ python ${PIPELINE}/postprocess/postprocess.py \
     --bucket          ${BUCKET} \
     --table           ${TABLE} \
     --date            ${DATE} \
+    --load_mode       ${LOAD_MODE:-partition} \
     --output          ${GCS_DIR}
+POSTPROCESS_STATUS=$?
+
+wait ${VISUALIZE_PID}
+VISUALIZE_STATUS=$?
+
 
+if [ ${POSTPROCESS_STATUS} -ne 0 ]; then
+    exit ${POSTPROCESS_STATUS}
+fi
 
-exit $?
+exit ${VISUALIZE_STATUS}